@@ -1,9 +1,10 @@
 import click
 import functools
+import os.path as path
 import sys
 
-from butter.gui import run_gui
 import butter.config as config
+import butter.ingest as ingest
 from butter.plugin import db_argument, default_loader
 
 
@@ -48,10 +49,166 @@ def status(loader):
 @click.option('--safe/--no-safe', default=False)
 def gui(loader, safe):
     """Launch the GUI."""
+    from butter.gui import run_gui
     with loader.database() as db:
        run_gui(db=db, safe=safe)
 
 
+@builtin_cmds.command()
+@db_argument('loader')
+@click.option('-j', '--jobs', type=int, default=None, help='Number of processes.')
+def thumbnails(loader, jobs):
+    """Generate missing thumbnails."""
+    with loader.database() as db:
+        n = db.thumbnails.generate(list(db.file_rows()), processes=jobs)
+    print(f'{n} thumbnails generated')
+
+
+@builtin_cmds.command()
+@db_argument('loader')
+@click.option('-j', '--jobs', type=int, default=None, help='Number of processes.')
+@click.option('--timeout', type=int, default=60, help='Seconds allowed per file.')
+@click.option('--retry', is_flag=True, default=False, help='Try again files that failed before.')
+def signatures(loader, jobs, timeout, retry):
+    """Hash missing videos and animated images."""
+    with loader.database() as db:
+        n = db.signatures.generate(processes=jobs, timeout=timeout, retry=retry)
+    print(f'{n} signatures generated')
+
+
+@builtin_cmds.command('dedupe')
+@db_argument('loader')
+@click.option('-t', '--threshold', type=int, default=9, help='Maximal distance between duplicates.')
+@click.option('--restart', is_flag=True, default=False, help='Discard saved progress.')
+@click.option('--list', 'list_only', is_flag=True, default=False, help='Only print the clusters.')
+def dedupe_cmd(loader, threshold, restart, list_only):
+    """Find and resolve near-duplicate pictures."""
+    from butter import dedupe
+    with loader.database() as db:
+        checkpoint = dedupe.Checkpoint(db.local_dedupe, threshold)
+        if restart:
+            checkpoint.reset(None)
+        clusters = dedupe.search(db, checkpoint)
+        print(f'{len(clusters)} clusters of near-duplicates')
+        if list_only:
+            for ids in clusters:
+                print(' '.join(str(id) for id in ids))
+            return
+        try:
+            dedupe.resolve(db, clusters, checkpoint)
+        except (KeyboardInterrupt, EOFError):
+            print(f'Stopped after {checkpoint.resolved} of {len(clusters)} clusters')
+            return
+        checkpoint.remove()
+
+
+@builtin_cmds.command('import')
+@db_argument('loader')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('-m', '--metadata', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='CSV, JSON lines or YAML file of field values by filename.')
+@click.option('-c', '--on-collision', 'policy', type=click.Choice(ingest.POLICIES),
+              default='skip', help='What to do with files colliding with others.')
+@click.option('-t', '--threshold', type=int, default=9, help='Maximal distance of a collision.')
+@click.option('-j', '--jobs', type=int, default=None, help='Number of processes.')
+@click.option('-b', '--batch', type=int, default=ingest.BATCH, help='Number of files per transaction.')
+@click.option('-n', '--dry-run', is_flag=True, default=False, help='Only report what would happen.')
+def import_cmd(loader, directory, metadata, policy, threshold, jobs, batch, dry_run):
+    """Import a directory of files without asking."""
+    try:
+        values = ingest.read_metadata(metadata) if metadata else None
+        files = ingest.find_files(directory, values)
+        if values:
+            for key in ingest.unmatched(directory, values, files):
+                print(f'No file for metadata entry: {key}')
+        with loader.database() as db:
+            importer = ingest.Importer(db, policy=policy, threshold=threshold, processes=jobs, batch=batch)
+            counts = importer.run(files, dry_run=dry_run)
+    except ingest.MetadataError as e:
+        raise click.ClickException(str(e))
+    print(', '.join(f'{n} {key}' for key, n in counts.items()))
+
+
+@builtin_cmds.group('db')
+def db_cmds():
+    """Maintain the database file."""
+    pass
+
+
+@db_cmds.command()
+@db_argument('loader')
+def optimize(loader):
+    """Index the queries of the pickers."""
+    from butter import advisor
+    with loader.database() as db:
+        advisor.optimize(db)
+
+
+@builtin_cmds.group()
+def bench():
+    """Benchmark on a synthetic database."""
+    pass
+
+
+@bench.command()
+@click.argument('root', type=click.Path(file_okay=False))
+@click.option('-s', '--scale', type=click.Choice(['1k', '100k', '1m']), default='1k')
+@click.option('-f', '--fields', type=int, default=8, help='Number of custom fields.')
+@click.option('--staged', type=int, default=16, help='Number of staged files.')
+def generate(root, scale, fields, staged):
+    """Generate a synthetic database in ROOT."""
+    from butter import bench
+    try:
+        bench.generate(root, bench.SCALES[scale], nfields=fields, staged=staged)
+    except FileExistsError:
+        raise click.ClickException(f'{root} already has a database')
+
+
+@bench.command('run')
+@click.argument('root', type=click.Path(exists=True, file_okay=False))
+@click.option('-b', '--baseline', type=click.Path(dir_okay=False), default=None,
+              help='Baseline file, by default baseline.json in ROOT.')
+@click.option('-t', '--tolerance', type=float, default=0.25, help='Allowed slowdown as a fraction.')
+@click.option('--save', is_flag=True, default=False, help='Save the results as the new baseline.')
+def run_bench(root, baseline, tolerance, save):
+    """Run the benchmarks on the database in ROOT."""
+    from butter import bench
+    baseline = baseline or path.join(root, 'baseline.json')
+    results, problems = bench.run(root)
+    regressions = bench.compare(results, bench.load_baseline(baseline), tolerance)
+    for problem in problems:
+        print(problem)
+    if save:
+        bench.save_baseline(baseline, results)
+    if regressions or problems:
+        sys.exit(1)
+
+
+@builtin_cmds.command(context_settings={'ignore_unknown_options': True})
+@click.option('-o', '--output', type=click.Path(dir_okay=False), default='butter-trace.json',
+              help='File to write the Chrome trace to.')
+@click.option('-s', '--sort', default='cumulative', help='Sort order of the profile.')
+@click.option('-n', '--limit', type=int, default=30, help='Number of functions to show.')
+@click.argument('args', nargs=-1, type=click.UNPROCESSED)
+def profile(output, sort, limit, args):
+    """Run a command with tracing and profiling."""
+    import cProfile
+    import pstats
+    from butter import trace
+
+    profiler = cProfile.Profile()
+    trace.enable()
+    try:
+        profiler.runcall(cli.main, args=list(args), prog_name='butter', standalone_mode=False)
+    finally:
+        events = trace.disable()
+        trace.write_chrome(events, output)
+        print()
+        trace.summary(events)
+        pstats.Stats(profiler).sort_stats(sort).print_stats(limit)
+        print(f'Trace written to {output}')
+
+
 @builtin_cmds.command()
 @click.option('--push/--no-push', default=True)
 @click.option('--pull/--no-pull', default=True)
@@ -60,7 +217,11 @@ def gui(loader, safe):
 @db_argument('loader')
 def sync(loader, **kwargs):
     """Synchronize a database."""
-    loader.sync(**kwargs)
+    from butter.transport import TransportError
+    try:
+        loader.sync(**kwargs)
+    except TransportError as e:
+        raise click.ClickException(str(e))
 
 
 @builtin_cmds.command('push-config')
@@ -77,6 +238,9 @@ def pull_config(loader):
     loader.pull_config()
 
 
+cli = click.CommandCollection(name='Butter', sources=[builtin_cmds, plugin_cmds])
+
+
 def main():
     try:
         if len(sys.argv) > 1 and sys.argv[1].startswith('-d'):
@@ -93,7 +257,7 @@ def main():
     if len(sys.argv) == 1:
         sys.argv.append('gui')
 
-    click.CommandCollection(name='Butter', sources=[builtin_cmds, plugin_cmds])()
+    cli()
 
 
 if __name__ == '__main__':
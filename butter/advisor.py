@@ -0,0 +1,195 @@
+"""Index advice for the configured pickers.
+
+Every query the pickers run is explained with EXPLAIN QUERY PLAN, and
+queries for which SQLite scans or sorts the whole pictures table are
+given an index: a partial index over exactly the matching pictures, or
+failing that an index on the columns they filter or sort on. An index
+is only kept if SQLite then uses it and the query gets faster. The
+indexes are recorded in indexes.json next to the database file, and
+are created or dropped to match it whenever the database is loaded.
+"""
+
+from collections import namedtuple
+import re
+from time import perf_counter
+
+from sqlalchemy import Column
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import and_, select, text
+from sqlalchemy.sql.visitors import iterate
+
+from butter.membership import predicate
+from butter.pickers import FilterPicker, TraversePicker, UnionPicker
+
+
+PREFIX = 'ix_auto_'
+
+Query = namedtuple('Query', ['label', 'query', 'candidates'])
+
+
+def index(name, columns, where=None):
+    name = PREFIX + re.sub(r'\W+', '_', name).strip('_').lower()
+    spec = {'name': name, 'columns': [str(c) for c in columns]}
+    if where is not None:
+        spec['where'] = where
+    return spec
+
+
+def index_sql(spec):
+    sql = 'CREATE INDEX {} ON pictures ({})'.format(spec['name'], ', '.join(spec['columns']))
+    if spec.get('where'):
+        sql += ' WHERE {}'.format(spec['where'])
+    return sql
+
+
+def existing(db):
+    """Map the names of the automatic indexes to their SQL."""
+    rows = db.session.execute(text(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'pictures'"
+    ))
+    return {name: sql for name, sql in rows if name.startswith(PREFIX)}
+
+
+def apply(db, specs):
+    """Create the indexes SPECS, and drop the automatic indexes that are
+    not among them or have changed."""
+    current = existing(db)
+    wanted = {spec['name']: index_sql(spec) for spec in specs}
+    for name, sql in current.items():
+        if wanted.get(name) != sql:
+            db.session.execute(text(f'DROP INDEX {name}'))
+    for name, sql in wanted.items():
+        if current.get(name) == sql:
+            continue
+        try:
+            db.session.execute(text(sql))
+        except OperationalError as e:
+            print(f'Unable to create index {name}: {e.orig}')
+
+
+def columns(db, filters):
+    """Names of the columns of pictures that FILTERS refer to."""
+    names = []
+    for elem in iterate(and_(*filters), {}):
+        if isinstance(elem, Column) and elem.table is db.pictures and elem.name not in names:
+            names.append(elem.name)
+    return names
+
+
+def walk(label, picker):
+    if isinstance(picker, UnionPicker):
+        for i, (member, _) in enumerate(picker.pickers):
+            yield from walk(f'{label}.{i}', member)
+    elif isinstance(picker, FilterPicker) and picker.filters:
+        yield label, picker
+
+
+def queries(db):
+    """Return the queries run by the pickers of DB, each with the indexes
+    that could serve it in order of preference."""
+    dialect = db.engine.dialect
+    id = db.pictures.c.id
+    result = []
+
+    order = db.cfg.get('traverse', 'id').lstrip('-')
+    tweak = FilterPicker(db, db.Picture.tweak == True)
+    for name, top in list(db.pickers.items()) + [('tweak', tweak)]:
+        for label, picker in walk(name, top):
+            candidates = []
+            if not picker.materialized:
+                pred = predicate(picker.filters, dialect)
+                if pred is not None:
+                    candidates.append(index(label, ['id'], pred))
+                candidates.append(index(label + '_by', columns(db, picker.filters)))
+            result.append(Query(label, select([id]).where(picker.clause()), candidates))
+
+        if order != 'id' and top is not tweak:
+            column = db.pictures.c[order]
+            query = (select([column, id]).where(top.clause())
+                     .order_by(column, id).limit(TraversePicker.page_size))
+            result.append(Query(f'{name} by {order}', query, [index('order_' + order, [order])]))
+
+    return result
+
+
+def plan(db, query):
+    """Return the details of the query plan of QUERY."""
+    compiled = query.compile(dialect=db.engine.dialect)
+    params = tuple(compiled.params[key] for key in compiled.positiontup)
+    rows = db.session.connection().execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+    return [row[-1] for row in rows]
+
+
+def slow(details):
+    """Whether a query plan scans or sorts the whole pictures table."""
+    return any(
+        re.fullmatch(r'SCAN (TABLE )?pictures', d) or d.startswith('USE TEMP B-TREE FOR ORDER BY')
+        for d in details
+    )
+
+
+def advise(db, queries):
+    """Create indexes for QUERIES that are slow, and return the specs of
+    those that help."""
+    kept = {}
+    for query in queries:
+        if not slow(plan(db, query.query)):
+            continue
+        baseline = timing(db, query)
+        for spec in query.candidates:
+            if spec['name'] in kept or not spec['columns']:
+                continue
+            try:
+                db.session.execute(text(index_sql(spec)))
+            except OperationalError:
+                continue
+            if slow(plan(db, query.query)) or timing(db, query) > 0.8 * baseline:
+                db.session.execute(text('DROP INDEX {}'.format(spec['name'])))
+            else:
+                kept[spec['name']] = spec
+                break
+    return list(kept.values())
+
+
+def timing(db, query, repeat=5):
+    """Return the best time of QUERY, in milliseconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        db.session.execute(query.query).fetchall()
+        best = min(best, perf_counter() - start)
+    return best * 1000
+
+
+def timings(db, queries):
+    return {query.label: timing(db, query) for query in queries}
+
+
+def optimize(db):
+    """Create the indexes the pickers of DB need, record them in
+    indexes.json and update the statistics of the query planner."""
+    found = queries(db)
+    before = timings(db, found)
+
+    db.session.commit()
+    mode = db.session.execute(text('PRAGMA journal_mode')).scalar()
+    print(f'Journal mode: {mode}')
+
+    names = {spec['name'] for query in found for spec in query.candidates}
+    specs = [spec for spec in db.load_indexes() if spec['name'] in names]
+    apply(db, specs)
+    db.session.execute(text('ANALYZE pictures'))
+    created = advise(db, found)
+    for spec in created:
+        print('Created', index_sql(spec))
+    specs.extend(created)
+
+    db.session.execute(text('ANALYZE pictures'))
+    db.session.commit()
+    db.save_indexes(specs)
+
+    after = timings(db, found)
+    width = max([len(label) for label in before] + [5])
+    print(f'{"query":<{width}}  {"before":>10}  {"after":>10}')
+    for label, t in before.items():
+        print(f'{label:<{width}}  {t:>7.2f} ms  {after[label]:>7.2f} ms')
@@ -0,0 +1,264 @@
+"""Benchmarks on synthetic databases.
+
+generate() builds a database with random fields and hashes, tiny image
+files in contents/ and staging/, and a remote in a local directory, all
+under one root directory. run() times the hot paths of butter on it,
+and compare() checks the results against a JSON baseline of an earlier
+run, flagging every benchmark that got slower by more than a given
+tolerance.
+
+Nothing in run() asks for input: collisions are timed with the query
+behind the collision check, without its prompts and GUI.
+
+The startup benchmark runs the command line in a fresh process. It also
+checks that listing the databases stays within a time budget and does
+not import any of the modules in HEAVY.
+"""
+
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime
+import io
+import json
+import os
+import os.path as path
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+from sqlalchemy.sql import text
+from tqdm import tqdm
+import yaml
+
+
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+HEAVY = ['PyQt5', 'PIL', 'imagehash', 'inflect', 'av']
+STARTUP_BUDGET = 0.3
+
+CHUNK = 10000
+
+
+def database_path(root):
+    return path.join(root, 'butter', 'databases', 'bench')
+
+
+def fields(n):
+    return [{'key': f'f{i}', 'type': 'bool' if i % 2 == 0 else 'int'} for i in range(n)]
+
+
+def image(size, rng):
+    """Return a random grayscale PNG of SIZE x SIZE pixels."""
+    from PIL import Image
+    data = bytes(rng.getrandbits(8) for _ in range(size * size))
+    f = io.BytesIO()
+    Image.frombytes('L', (size, size), data).save(f, 'PNG')
+    return f.getvalue()
+
+
+def generate(root, pictures, nfields=8, staged=16, seed=0):
+    """Build a synthetic database with PICTURES pictures and NFIELDS
+    custom fields under ROOT, with STAGED files waiting in staging/."""
+    from butter.db import DatabaseLoader
+
+    nfields = max(nfields, 2)
+    rng = random.Random(seed)
+    db_path = database_path(root)
+    remote = path.join(root, 'remote')
+    if path.exists(db_path):
+        raise FileExistsError(db_path)
+    for dirname in ('contents', 'staging', 'changelog'):
+        os.makedirs(path.join(db_path, dirname))
+    os.makedirs(path.join(remote, 'contents'), exist_ok=True)
+
+    with open(path.join(db_path, 'config.yaml'), 'w') as f:
+        yaml.safe_dump({
+            'fields': fields(nfields),
+            'sync': {'remote': remote, 'sync_config': False},
+            'pickers': [
+                {'first': ['f0 == True']},
+                {'mixed': [[2.0, 'f1 > 5'], ['f0 == False', 'f1 < 2']]},
+            ],
+        }, f, sort_keys=False)
+
+    loader = DatabaseLoader(db_path)
+    with loader.database() as db:
+        # Pictures are made as if they predate the change log: the
+        # triggers are off while they are inserted, and they are logged
+        # in bulk afterwards, so that the push writes them to a segment
+        db.session.execute(text('UPDATE changelog_state SET applying = 1'))
+        now = datetime.now()
+        for start in tqdm(range(0, pictures, CHUNK), desc='Pictures', unit='chunk'):
+            rows = []
+            for id in range(start + 1, min(start + CHUNK, pictures) + 1):
+                row = {
+                    'id': id, 'extension': 'png', 'tweak': False, 'added': now, 'updated': now,
+                    'hash': rng.getrandbits(64) - (1 << 63), 'is_still': True,
+                }
+                for field in fields(nfields):
+                    if field['type'] == 'bool':
+                        row[field['key']] = rng.random() < 0.3
+                    else:
+                        row[field['key']] = rng.randrange(10)
+                rows.append(row)
+            db.session.execute(db.pictures.insert(), rows)
+        db.session.execute(text('UPDATE changelog_state SET applying = 0'))
+        db.changelog.log_all()
+        db.session.commit()
+        db.hash_index.ensure()
+        db.session.commit()
+
+        data = image(8, rng)
+        for id in tqdm(range(1, pictures + 1), desc='Contents', unit='file'):
+            with open(path.join(db.local_contents, f'{id:0>8}.png'), 'wb') as f:
+                f.write(data)
+        for i in range(staged):
+            with open(path.join(db.staging_path, f'staged-{i:03}.png'), 'wb') as f:
+                f.write(image(64, rng))
+
+    loader.sync(pull=False, stage=False)
+    loader.close()
+
+
+def measure(func, repeat):
+    """Return the median time of REPEAT calls to FUNC."""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return statistics.median(times)
+
+
+def startup(root, repeat=5):
+    """Time 'butter list' in a new process, and return the time and the
+    heavy modules imported by loading a database from the command
+    line."""
+    env = dict(os.environ, XDG_CONFIG_HOME=root, XDG_CACHE_HOME=path.join(root, 'cache'))
+    command = [sys.executable, '-m', 'butter', 'list']
+    elapsed = measure(lambda: subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL), repeat)
+    probe = (
+        'import sys\n'
+        'import butter.__main__\n'
+        'from butter.plugin import default_loader\n'
+        'with default_loader().database(): pass\n'
+        'print(" ".join(sys.modules))\n'
+    )
+    result = subprocess.run([sys.executable, '-c', probe], env=env, check=True, capture_output=True, text=True)
+    loaded = {name.split('.')[0] for name in result.stdout.split()}
+    return elapsed, [name for name in HEAVY if name in loaded]
+
+
+def run(root):
+    """Run all benchmarks on the database under ROOT. Returns a dictionary
+    mapping benchmark names to seconds, and a list of problems found by
+    the startup checks."""
+    from butter.db import DatabaseLoader
+    from butter.staging import StagingCache
+
+    results, problems = {}, []
+    db_path = database_path(root)
+
+    elapsed, heavy = startup(root)
+    results['startup'] = elapsed
+    if elapsed > STARTUP_BUDGET:
+        problems.append(f'startup takes {elapsed:.3f}s, over the budget of {STARTUP_BUDGET:.3f}s')
+    if heavy:
+        problems.append('loading a database imports {}'.format(', '.join(heavy)))
+
+    def load():
+        loader = DatabaseLoader(db_path)
+        with loader.database():
+            pass
+        loader.close()
+    results['database (load)'] = measure(load, 3)
+
+    loader = DatabaseLoader(db_path)
+    def enter():
+        with loader.database():
+            pass
+
+    quiet = io.StringIO()
+    with redirect_stdout(quiet), redirect_stderr(quiet):
+        enter()
+        results['database (warm)'] = measure(enter, 1000)
+
+        with loader.database() as db:
+            first, mixed = db.pickers['first'], db.pickers['mixed']
+            first.get(), mixed.get()
+            results['FilterPicker.get'] = measure(first.get, 1000)
+            results['UnionPicker.get'] = measure(mixed.get, 1000)
+
+            filenames = sorted(
+                path.join(loader.staging_path, fn) for fn in os.listdir(loader.staging_path)
+                if fn.startswith('staged-')
+            )
+            staged = StagingCache(loader.staging_cache).analyse(filenames)
+            checks = iter(filenames * 10)
+            def similar():
+                db.similar(staged[next(checks)].hash, 9)
+            results['similar'] = measure(similar, len(filenames) * 10)
+
+            added = []
+            copies = iter(enumerate(filenames))
+            def add():
+                i, fn = next(copies)
+                copy = path.join(loader.staging_path, f'bench-{i:03}.png')
+                shutil.copy(fn, copy)
+                pic = db.Picture()
+                pic.extension, pic.is_still = staged[fn].extension, staged[fn].is_still
+                loader.add_pic(copy, pic, db, staged=staged[fn])
+                added.append(pic)
+            results['add_pic'] = measure(add, len(filenames))
+            with db.files.transaction():
+                for pic in added:
+                    db.delete(pic)
+
+        results['sync'] = measure(lambda: loader.sync(stage=False), 3)
+    loader.close()
+
+    return results, problems
+
+
+def load_baseline(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(filename, results):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(results, f, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+
+def compare(results, baseline, tolerance):
+    """Print RESULTS next to BASELINE, and return the names of the
+    benchmarks that are slower than the baseline by more than the
+    fraction TOLERANCE."""
+    regressions = []
+    width = max(len(name) for name in results)
+    print(f'{"benchmark":<{width}}  {"time":>12}  {"baseline":>12}  {"ratio":>6}')
+    for name, t in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f'{name:<{width}}  {format_time(t):>12}')
+            continue
+        ratio = t / base
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<{width}}  {format_time(t):>12}  {format_time(base):>12}  {ratio:>6.2f}{flag}')
+    return regressions
+
+
+def format_time(t):
+    if t < 1e-3:
+        return f'{t * 1e6:.1f} µs'
+    if t < 1:
+        return f'{t * 1e3:.2f} ms'
+    return f'{t:.2f} s'
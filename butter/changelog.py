@@ -0,0 +1,393 @@
+"""Row-level change log replication of the pictures table.
+
+Triggers on the pictures table record every local insert, update and
+delete in the changelog table, one row per changed field, together
+with the time of the change. Pushing exports the new rows as a segment
+file under changelog/<replica>/, and pulling applies the segments of
+all other replicas with per-field last-writer-wins, using the
+field_clock table to remember when each field was last written.
+
+Segments are plain JSON lines files that are never modified once
+written, so replicas only have to exchange files they have not seen.
+
+Each replica allocates picture ids from its own block, chosen from its
+replica id, so that pictures added concurrently on two replicas never
+share an id. Ids are never reused. Pictures from before the changelog
+keep their ids in block 0.
+
+Deleted pictures leave a tombstone with the time of the delete, and
+older inserts and updates of them are ignored, so that a picture stays
+deleted whatever order the segments of the replicas are applied in.
+
+The names of the files of deleted or renamed pictures are recorded in
+the dead_files table. After pulling, the local copies of those files
+are removed, and pushing removes them from the remote. Deletes carry
+the extension of the picture, so a delete removes exactly the file of
+the picture it deleted.
+"""
+
+import hashlib
+import json
+import os
+import os.path as path
+from uuid import uuid4
+
+from sqlalchemy import BLOB, Column, Integer, String, Table
+from sqlalchemy.sql import text
+
+from butter import triggers
+from butter.manifest import picture_id
+
+
+TIMESTAMP = "strftime('%Y-%m-%dT%H:%M:%f', 'now')"
+REPLICA = "(SELECT replica FROM changelog_state)"
+ENABLED = "(SELECT applying FROM changelog_state) = 0"
+FILENAME = "printf('%08d.%s', {0}.id, {0}.extension)"
+
+ID_BITS = 32
+TAG_BITS = 20
+
+
+def replica_id(filename):
+    try:
+        with open(filename, 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    replica = uuid4().hex
+    with open(filename, 'w') as f:
+        f.write(replica)
+    return replica
+
+
+def replica_tag(replica):
+    """Return the number of the id block of REPLICA, never 0."""
+    digest = hashlib.sha1(replica.encode()).hexdigest()
+    return int(digest[:8], 16) % ((1 << TAG_BITS) - 1) + 1
+
+
+def segments(root):
+    """Yield (first, last, filename) for the segments in ROOT."""
+    if not path.isdir(root):
+        return
+    for fn in sorted(os.listdir(root)):
+        try:
+            first, last = map(int, path.splitext(fn)[0].split('-'))
+        except ValueError:
+            continue
+        yield first, last, path.join(root, fn)
+
+
+class Changelog:
+
+    def __init__(self, db, metadata):
+        self.db = db
+        self.root = db.local_changelog
+        self.replica = replica_id(db.local_replica)
+        self.tag = replica_tag(self.replica)
+        self.log = Table(
+            'changelog', metadata,
+            Column('seq', Integer, primary_key=True),
+            Column('pic', Integer, nullable=False),
+            Column('op', String, nullable=False),
+            Column('field', String),
+            Column('value', BLOB),
+            Column('ts', String, nullable=False),
+            sqlite_autoincrement=True,
+        )
+        self.clock = Table(
+            'field_clock', metadata,
+            Column('pic', Integer, primary_key=True),
+            Column('field', String, primary_key=True),
+            Column('ts', String, nullable=False),
+            Column('replica', String, nullable=False),
+        )
+        self.peers = Table(
+            'changelog_peers', metadata,
+            Column('replica', String, primary_key=True),
+            Column('seq', Integer, nullable=False),
+        )
+        self.state = Table(
+            'changelog_state', metadata,
+            Column('replica', String, primary_key=True),
+            Column('applying', Integer, nullable=False),
+        )
+        self.tombstones = Table(
+            'changelog_tombstones', metadata,
+            Column('pic', Integer, primary_key=True),
+            Column('ts', String, nullable=False),
+            Column('replica', String, nullable=False),
+        )
+        self.allocated = Table(
+            'changelog_ids', metadata,
+            Column('replica', String, primary_key=True),
+            Column('next', Integer, nullable=False),
+        )
+        self.dead_files = Table(
+            'dead_files', metadata,
+            Column('name', String, primary_key=True),
+        )
+
+    @property
+    def session(self):
+        return self.db.session
+
+    @property
+    def fields(self):
+        return [c.name for c in self.db.pictures.c if c.name != 'id']
+
+    def execute(self, sql, **kwargs):
+        return self.session.execute(text(sql), kwargs)
+
+    def install(self):
+        """Create the triggers, logging all existing pictures the first
+        time the changelog is installed in a database."""
+        state = self.execute('SELECT replica FROM changelog_state').fetchall()
+        if state and state[0][0] != self.replica:
+            self.execute('DELETE FROM changelog')
+            self.execute('DELETE FROM changelog_peers')
+            state = []
+        if not state:
+            self.execute('DELETE FROM changelog_state')
+            self.execute('INSERT INTO changelog_state VALUES (:replica, 0)', replica=self.replica)
+            self.log_all()
+
+        def logged(op, field, condition=''):
+            return (
+                f"INSERT INTO changelog (pic, op, field, value, ts) "
+                f"SELECT NEW.id, '{op}', '{field}', NEW.{field}, {TIMESTAMP} {condition};"
+                f"INSERT OR REPLACE INTO field_clock "
+                f"SELECT NEW.id, '{field}', {TIMESTAMP}, {REPLICA} {condition};"
+            )
+
+        wanted = {}
+        body = ''.join(logged('insert', f) for f in self.fields)
+        wanted['changelog_insert'] = (
+            f'CREATE TRIGGER changelog_insert AFTER INSERT ON pictures WHEN {ENABLED} BEGIN {body} END'
+        )
+        body = ''.join(logged('update', f, f'WHERE OLD.{f} IS NOT NEW.{f}') for f in self.fields)
+        wanted['changelog_update'] = (
+            f'CREATE TRIGGER changelog_update AFTER UPDATE ON pictures WHEN {ENABLED} BEGIN {body} END'
+        )
+        wanted['changelog_delete'] = (
+            f"CREATE TRIGGER changelog_delete AFTER DELETE ON pictures WHEN {ENABLED} BEGIN "
+            f"INSERT INTO changelog (pic, op, field, value, ts) "
+            f"VALUES (OLD.id, 'delete', 'extension', OLD.extension, {TIMESTAMP});"
+            f"INSERT OR REPLACE INTO changelog_tombstones VALUES (OLD.id, {TIMESTAMP}, {REPLICA});"
+            f"DELETE FROM field_clock WHERE pic = OLD.id; END"
+        )
+
+        # Also for changes applied from other replicas
+        dead = f"INSERT OR IGNORE INTO dead_files VALUES ({FILENAME.format('OLD')});"
+        wanted['dead_files_delete'] = f'CREATE TRIGGER dead_files_delete AFTER DELETE ON pictures BEGIN {dead} END'
+        wanted['dead_files_rename'] = (
+            f'CREATE TRIGGER dead_files_rename AFTER UPDATE OF extension ON pictures '
+            f'WHEN OLD.extension IS NOT NEW.extension BEGIN {dead} END'
+        )
+        if triggers.install(self.session, wanted) or not state:
+            self.session.commit()
+
+    def log_all(self):
+        """Log every picture as an insert without a time, so that any
+        change made elsewhere wins over it."""
+        for field in self.fields:
+            self.execute(
+                f"INSERT INTO changelog (pic, op, field, value, ts) "
+                f"SELECT id, 'insert', '{field}', {field}, '' FROM pictures"
+            )
+
+    def allocate(self, connection):
+        """Return a new picture id from the block of this replica."""
+        low = self.tag << ID_BITS
+        top = connection.execute(
+            text('SELECT max(id) FROM pictures WHERE id > :low AND id < :high'),
+            low=low, high=low + (1 << ID_BITS),
+        ).scalar()
+        # Ids allocated earlier in the same flush are only in changelog_ids
+        stored = connection.execute(
+            text('SELECT next FROM changelog_ids WHERE replica = :r'), r=self.replica,
+        ).scalar()
+        id = max(low + 1, (top or 0) + 1, stored or 0)
+        connection.execute(text('INSERT OR REPLACE INTO changelog_ids VALUES (:r, :next)'),
+                           r=self.replica, next=id + 1)
+        return id
+
+    def assign_id(self, mapper, connection, pic):
+        """Mapper hook giving new pictures an id from our block."""
+        if pic.id is None:
+            pic.id = self.allocate(connection)
+
+    def foreign(self, id):
+        """Whether ID was allocated by another replica."""
+        return id is not None and id >> ID_BITS not in (0, self.tag)
+
+    def export(self):
+        """Write all unexported local changes to a new segment file.
+        Returns the number of records written."""
+        rows = self.execute('SELECT seq, pic, op, field, value, ts FROM changelog ORDER BY seq').fetchall()
+        if not rows:
+            return 0
+
+        records, inserts = [], {}
+        for seq, pic, op, field, value, ts in rows:
+            last = records[-1] if records else None
+            if op == 'insert' and pic in inserts:
+                inserts[pic]['fields'][field] = value
+            elif op == 'update' and last and (last['pic'], last['op'], last['ts']) == (pic, op, ts):
+                last['fields'][field] = value
+            else:
+                record = {'seq': seq, 'pic': pic, 'op': op, 'ts': ts, 'fields': {}}
+                if field:
+                    record['fields'][field] = value
+                records.append(record)
+                if op == 'insert':
+                    inserts[pic] = record
+                elif op == 'delete':
+                    inserts.pop(pic, None)
+
+        root = path.join(self.root, self.replica)
+        os.makedirs(root, exist_ok=True)
+        filename = path.join(root, f'{rows[0][0]:012}-{rows[-1][0]:012}.jsonl')
+        with open(filename + '.tmp', 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        os.replace(filename + '.tmp', filename)
+
+        self.execute('DELETE FROM changelog WHERE seq <= :seq', seq=rows[-1][0])
+        self.session.commit()
+        return len(records)
+
+    def applied(self, replica):
+        row = self.execute('SELECT seq FROM changelog_peers WHERE replica = :r', r=replica).first()
+        return row[0] if row else 0
+
+    def pull(self):
+        """Apply all new segments written by other replicas. Returns the
+        number of records applied."""
+        if not path.isdir(self.root):
+            return 0
+        count = 0
+        self.execute('UPDATE changelog_state SET applying = 1')
+        try:
+            for replica in sorted(os.listdir(self.root)):
+                if replica == self.replica:
+                    continue
+                seen = self.applied(replica)
+                for first, last, filename in segments(path.join(self.root, replica)):
+                    if last <= seen:
+                        continue
+                    with open(filename, 'r') as f:
+                        for line in f:
+                            record = json.loads(line)
+                            if record['seq'] > seen:
+                                self.apply(replica, record)
+                                count += 1
+                    seen = last
+                self.execute('INSERT OR REPLACE INTO changelog_peers VALUES (:r, :seq)', r=replica, seq=seen)
+        finally:
+            self.execute('UPDATE changelog_state SET applying = 0')
+        if count:
+            self.db.wrote()
+
+        self.cleanup()
+        return count
+
+    def exists(self, pic):
+        return self.execute('SELECT 1 FROM pictures WHERE id = :id', id=pic).first() is not None
+
+    def newer(self, pic, field, ts, replica):
+        row = self.execute(
+            'SELECT ts, replica FROM field_clock WHERE pic = :pic AND field = :field',
+            pic=pic, field=field,
+        ).first()
+        return row is None or (ts, replica) > tuple(row)
+
+    def buried(self, pic, ts, replica):
+        """Whether PIC was deleted by a change at least as recent as (TS,
+        REPLICA). Deletes may be applied before older inserts and updates
+        from other replicas, which must not bring the picture back."""
+        row = self.execute('SELECT ts, replica FROM changelog_tombstones WHERE pic = :pic', pic=pic).first()
+        return row is not None and tuple(row) >= (ts, replica)
+
+    def apply(self, replica, record):
+        pic, op, ts = record['pic'], record['op'], record['ts']
+        fields = {k: v for k, v in record['fields'].items() if k in self.fields}
+
+        if op == 'delete':
+            if not self.buried(pic, ts, replica):
+                self.execute('INSERT OR REPLACE INTO changelog_tombstones VALUES (:pic, :ts, :r)',
+                             pic=pic, ts=ts, r=replica)
+            if self.exists(pic):
+                self.db.hash_index.remove(pic)
+                self.execute('DELETE FROM pictures WHERE id = :id', id=pic)
+                self.execute('DELETE FROM field_clock WHERE pic = :id', id=pic)
+            elif 'extension' in record['fields']:
+                # Its file may have arrived before the delete
+                name = f"{pic:0>8}.{record['fields']['extension']}"
+                self.execute('INSERT OR IGNORE INTO dead_files VALUES (:name)', name=name)
+            return
+
+        if self.buried(pic, ts, replica):
+            return
+        if op == 'insert' and not self.exists(pic):
+            for k in set(self.fields) - set(fields):
+                default = self.db.pictures.c[k].default
+                if default is None or callable(default.arg):
+                    return
+                fields[k] = default.arg
+            columns = ', '.join(['id'] + list(fields))
+            values = ', '.join([':id'] + [f':{k}' for k in fields])
+            self.execute(f'INSERT INTO pictures ({columns}) VALUES ({values})', id=pic, **fields)
+            changed = fields
+        elif self.exists(pic):
+            changed = {k: v for k, v in fields.items() if self.newer(pic, k, ts, replica)}
+            for k, v in changed.items():
+                self.execute(f'UPDATE pictures SET {k} = :v WHERE id = :id', v=v, id=pic)
+        else:
+            return
+
+        for k in changed:
+            self.execute(
+                'INSERT OR REPLACE INTO field_clock VALUES (:pic, :field, :ts, :replica)',
+                pic=pic, field=k, ts=ts, replica=replica,
+            )
+        if changed.keys() & {'hash', 'is_still'} or op == 'insert':
+            row = self.execute('SELECT id, hash, is_still FROM pictures WHERE id = :id', id=pic).first()
+            self.db.hash_index.add(row)
+
+    def dead(self):
+        """Return the names of the files of deleted pictures, leaving out
+        names that belong to a picture again."""
+        rows = self.execute(
+            "SELECT name FROM dead_files WHERE NOT EXISTS ("
+            "SELECT 1 FROM pictures WHERE id = CAST(substr(name, 1, instr(name, '.') - 1) AS INTEGER) "
+            f"AND {FILENAME.format('pictures')} = name)"
+        )
+        return {name for name, in rows}
+
+    def forget(self, names):
+        """Stop tracking the files NAMES, once the remote no longer has them."""
+        if names:
+            self.session.execute(text('DELETE FROM dead_files WHERE name = :name'),
+                                 [{'name': name} for name in names])
+
+    def cleanup(self):
+        """Remove the local files of deleted pictures. The contents of
+        the remote may still have had them."""
+        with self.db.files.transaction():
+            for name in self.dead():
+                filename = path.join(self.db.local_contents, name)
+                if path.exists(filename):
+                    self.db.files.unlink(filename)
+                    self.db.thumbnails.invalidate(picture_id(name))
+
+    def settled(self, filenames):
+        """Return the FILENAMES that are really out of step with the
+        database. Pictures of other replicas get their rows and their
+        files at different times, and files of deleted pictures are
+        removed by cleanup."""
+        dead = {name for name, in self.execute('SELECT name FROM dead_files')}
+        return {
+            fn for fn in filenames
+            if path.basename(fn) not in dead and not self.foreign(picture_id(path.basename(fn)))
+        }
@@ -1,17 +1,22 @@
-import click
 import os
 import os.path as path
-from xdg import XDG_CONFIG_HOME
-
-import butter.plugin as plugin
+from xdg import XDG_CACHE_HOME, XDG_CONFIG_HOME
 
 
 root_path = str(XDG_CONFIG_HOME / 'butter')
 data_path = path.join(root_path, 'databases')
 plugin_path = path.join(root_path, 'plugins')
+cache_path = str(XDG_CACHE_HOME / 'butter')
+
 
-databases = sorted(os.listdir(data_path))
-try:
-    default_database = databases[0]
-except IndexError:
-    default_database = None
+def __getattr__(name):
+    # The list of databases is only read when it is first needed
+    if name == 'databases':
+        value = sorted(os.listdir(data_path))
+    elif name == 'default_database':
+        databases = __getattr__('databases')
+        value = databases[0] if databases else None
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
@@ -1,45 +1,82 @@
 from collections import namedtuple, OrderedDict
 from contextlib import contextmanager
 from datetime import datetime
-import imagehash
-from PIL import Image
-import inflect
+import json
 import os
 import os.path as path
-from subprocess import run, PIPE
-import re
-import numpy as np
-from sqlalchemy import create_engine, Boolean, Column, Integer, MetaData, String, Table, DateTime
+from sqlalchemy import create_engine, event, Boolean, Column, Integer, MetaData, String, Table, DateTime
 from sqlalchemy.orm import mapper, create_session
-from sqlalchemy.sql import func
+from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.sql import func, select, text
 import yaml
 
-from butter import plugin, config, interface
+from butter import advisor, plugin, config, signature, trace
+from butter.changelog import Changelog
+from butter.edits import EditQueue
+from butter.fileops import FileOps
+from butter.hamming import distance, is_imagehash, tonk
+from butter.hashindex import HashIndex
+from butter.manifest import ContentsManifest, stamp
+from butter.membership import PickerMembership
 from butter.pickers import FilterPicker, RandomPicker, UnionPicker
-
-
-def tonk(s):
-    return int(sum(j<<i for i,j in enumerate(s.hash.flatten().astype('i8')[::-1])))
-
-
-def untonk(s):
-    return np.unpackbits(np.array([s], dtype='>i8').view(np.uint8))
-
-
-def rsync_dir(source, destination, say=False):
-    ret = run(['rsync', '-a', '--info=stats2', '--delete', source, destination],
-              check=True, stdout=PIPE)
-    stdout = ret.stdout.decode()
-    nnew = int(re.search(r'Number of created files: (?P<n>\d+)', stdout).group('n'))
-    ndel = int(re.search(r'Number of deleted files: (?P<n>\d+)', stdout).group('n'))
-    if say or nnew > 0:
-        print('{} new'.format(nnew))
-    if say or ndel > 0:
-        print('{} deleted'.format(ndel))
-
-
-def rsync_file(source, destination):
-    run(['rsync', '-a', source, destination], check=True, stdout=PIPE)
+from butter.staging import StagingCache
+from butter.thumbnails import ThumbnailStore
+from butter.transport import make_transport
+
+
+_engines = {}
+
+
+def get_engine(filename):
+    """Return the engine of the SQLite file FILENAME. Engines are shared by
+    the whole process and keep their connections open."""
+    if filename not in _engines:
+        engine = create_engine('sqlite:///{}'.format(filename), poolclass=SingletonThreadPool)
+        event.listen(engine, 'connect', _connected)
+        _engines[filename] = engine
+    return _engines[filename]
+
+
+def _connected(conn, record):
+    # With a write-ahead log, commits survive a crash without waiting
+    # for the disk, which is only synced at checkpoints, and readers do
+    # not block the GUI when it flushes its edits. Filesystems without
+    # shared memory keep the rollback journal.
+    cursor = conn.cursor()
+    mode, = cursor.execute('PRAGMA journal_mode=WAL').fetchone()
+    if mode == 'wal':
+        cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.close()
+
+
+def file_stamp(filename):
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino,) + stamp(filename)
+
+
+def hash_file(fn, is_still):
+    """Return the perceptual hash of a file and its signature, if it is a
+    video or an animated image. Files that cannot be decoded as an
+    image get the hash 0."""
+    with trace.span('signature', file=fn):
+        frames = signature.compute(fn, is_still)
+    if frames:
+        return signature.combine(frames), frames
+    if is_still:
+        import imagehash
+        from PIL import Image
+        with trace.span('phash', file=fn):
+            return tonk(imagehash.phash(Image.open(fn))), None
+    return 0, None
+
+
+def plural(word, n):
+    # inflect is slow to import, so only do it when there is news
+    import inflect
+    return inflect.engine().plural(word, n)
 
 
 class AbstractDatabase:
@@ -50,8 +87,15 @@ class AbstractDatabase:
         db_path = path.join(config.data_path, name)
         self.local_sql = path.join(db_path, 'db.sqlite3')
         self.local_config = path.join(db_path, 'config.yaml')
+        self.local_hashes = path.join(db_path, 'hashes.bin')
+        self.local_changelog = path.join(db_path, 'changelog', '')
+        self.local_replica = path.join(db_path, 'replica')
         self.local_contents = path.join(db_path, 'contents', '')
+        self.local_thumbnails = path.join(db_path, 'thumbnails')
         self.staging_path = path.join(db_path, 'staging')
+        self.staging_cache = path.join(db_path, 'staging.json')
+        self.local_dedupe = path.join(db_path, 'dedupe.json')
+        self.local_indexes = path.join(db_path, 'indexes.json')
 
         self.path = db_path
         self.load_config()
@@ -97,21 +141,38 @@ class DatabaseLoader(AbstractDatabase):
 
     def close(self):
         self.plugin_manager.deactivate_all()
+        self.unload()
+
+    def unload(self):
+        if self.db:
+            self.db.close()
+            self.db.engine.dispose()
+            self.db = None
 
     @contextmanager
     def database(self, *args, commit=True, **kwargs):
+        """Open a session on the database. The database itself is kept
+        loaded between contexts, and is only loaded again if its file or
+        its config has been changed by something else. The session is
+        committed at the end unless nothing has changed."""
+        if self.db and self.db_count == 0 and self.db.stale():
+            self.unload()
         if not self.db:
-            self.db = Database(self.path, self.plugin_manager, *args, **kwargs)
+            with trace.span('db.load'):
+                self.db = Database(self.path, self.plugin_manager, *args, **kwargs)
 
         self.db_count += 1
         yield self.db
         self.db_count -= 1
 
         if self.db_count == 0:
-            if commit:
+            if commit and self.db.pending():
                 self.db.session.commit()
-            self.db.close()
-            self.db = None
+            self.db.session.close()
+
+    @property
+    def transport(self):
+        return make_transport(self.remote, self.cfg.get('sync', {}))
 
     @property
     def remote_config(self):
@@ -125,100 +186,174 @@ class DatabaseLoader(AbstractDatabase):
     def remote_sql(self):
         return path.join(self.remote, 'db.sqlite3')
 
+    @property
+    def remote_changelog(self):
+        return path.join(self.remote, 'changelog', '')
+
     def push_config(self):
-        rsync_file(self.local_config, self.remote_config)
+        self.transport.copy(self.local_config, self.remote_config)
 
     def pull_config(self):
-        rsync_file(self.remote_config, self.local_config)
+        self.transport.copy(self.remote_config, self.local_config)
 
+    @trace.traced('sync.pull')
     def _pull(self, verbose):
+        """Fetch changes and contents from the remote. Returns True if the
+        remote has no change log yet, in which case the whole database
+        file is fetched instead.
+
+        The changes are fetched before the contents, so that the files of
+        the pictures they add are already on the remote. Nothing is
+        deleted here: files of deleted pictures are removed when the
+        changes are applied."""
         print('Fetching data from remote...')
-        rsync_dir(self.remote_contents, self.local_contents, say=verbose)
-        rsync_file(self.remote_sql, self.local_sql)
+        transport = self.transport
+        legacy = False
+        if transport.exists(self.remote_changelog):
+            transport.copy(self.remote_changelog, self.local_changelog)
+        elif transport.exists(self.remote_sql):
+            # Nothing may have the file open while it is replaced
+            self.unload()
+            transport.copy(self.remote_sql, self.local_sql)
+            legacy = True
+        if transport.exists(self.remote_contents):
+            n = transport.copy(self.remote_contents, self.local_contents)
+            if n or verbose:
+                print('{} new {} fetched'.format(n, plural('file', n)))
         if self.cfg['sync']['sync_config']:
-            rsync_file(self.remote_config, self.local_config)
-
-    def _push(self, verbose):
+            transport.copy(self.remote_config, self.local_config)
+        return legacy
+
+    @trace.traced('sync.push')
+    def _push(self, verbose, legacy=False):
+        """Send contents and changes to the remote. The contents go first,
+        so that other replicas find the files of the pictures our changes
+        add. The files of deleted pictures are removed last."""
         print('Sending data to remote...')
-        rsync_dir(self.local_contents, self.remote_contents, say=verbose)
-        rsync_file(self.local_sql, self.remote_sql)
+        with self.database() as db:
+            db.changelog.export()
+            dead = db.changelog.dead()
+            if legacy:
+                db.session.commit()
+                db.checkpoint()
+        transport = self.transport
+        n = transport.copy(self.local_contents, self.remote_contents)
+        if n or verbose:
+            print('{} new {} sent'.format(n, plural('file', n)))
+        # An empty change log still tells others not to use legacy mode
+        os.makedirs(self.local_changelog, exist_ok=True)
+        transport.copy(self.local_changelog, self.remote_changelog)
+        if legacy:
+            transport.copy(self.local_sql, self.remote_sql)
+        transport.remove(self.remote_contents, sorted(dead))
+        if dead or verbose:
+            print('{} {} deleted from remote'.format(len(dead), plural('file', len(dead))))
         if self.cfg['sync']['sync_config']:
-            rsync_file(self.local_config, self.remote_config)
+            transport.copy(self.local_config, self.remote_config)
+        with self.database() as db:
+            db.changelog.forget(dead)
 
     def sync(self, push=True, pull=True, stage=True, verbose=False):
         print(f'Synchronizing {self.name}...')
 
         with self.database(regular=False) as db:
-            p = inflect.engine()
 
-            pre_tweak = {pic.id: (pic.tweak, pic.updated) for pic in db.query()}
+            pre_tweak = {}
+            if pull and self.remote:
+                columns = [db.pictures.c.id, db.pictures.c.tweak, db.pictures.c.updated]
+                pre_tweak = {id: (tweak, updated) for id, tweak, updated in db.session.execute(select(columns))}
             delete_ids = set()
 
-            existing_hd = {path.join(db.local_contents, fn) for fn in os.listdir(db.local_contents)}
-            existing_db = {pic.filename for pic in db.query()}
+            columns = [db.pictures.c.id, db.pictures.c.extension]
+            with trace.span('sync.reconcile'):
+                deleted_on_hd, deleted_in_db = db.manifest.reconcile(lambda: db.session.execute(select(columns)))
+                if self.remote:
+                    deleted_on_hd = db.changelog.settled(deleted_on_hd)
+                    deleted_in_db = db.changelog.settled(deleted_in_db)
 
-            deleted_on_hd = existing_db - existing_hd
             if deleted_on_hd or verbose:
                 n = len(deleted_on_hd)
-                print('{} {} deleted from disk, deleting also from database'.format(n, p.plural('image', n)))
+                print('{} {} deleted from disk, deleting also from database'.format(n, plural('image', n)))
                 for c in deleted_on_hd:
                     delete_ids.add(int(path.splitext(path.basename(c))[0]))
 
-            deleted_in_db = existing_hd - existing_db
             if deleted_in_db or verbose:
                 n = len(deleted_in_db)
-                print('{} {} deleted from database, re-staging'.format(n, p.plural('image', n)))
-                for fn in deleted_in_db:
-                    run(['mv', fn, path.join(self.staging_path, path.basename(fn))], stdout=PIPE, check=True)
+                print('{} {} deleted from database, re-staging'.format(n, plural('image', n)))
+                with db.files.transaction():
+                    for fn in deleted_in_db:
+                        db.files.move(fn, path.join(self.staging_path, path.basename(fn)))
 
+        legacy = False
         if pull and self.remote:
-            self._pull(verbose)
+            legacy = self._pull(verbose)
 
         with self.database(regular=False) as db:
-            if delete_ids:
-                for pic in db.query().filter(db.Picture.id.in_(delete_ids)):
-                    print('Deleting', pic.id)
-                    db.delete(pic)
-                db.session.commit()
+            if pull and self.remote and not legacy:
+                with trace.span('sync.changelog'):
+                    n = db.changelog.pull()
+                if n or verbose:
+                    print('{} {} applied from remote'.format(n, plural('change', n)))
+            elif legacy:
+                db.changelog.cleanup()
 
-            for pic in db.query():
-                if pic.id not in pre_tweak:
-                    continue
-                tweak, updated = pre_tweak[pic.id]
-                if pic.updated < updated:
-                    pic.tweak = tweak
-                    pic.updated = updated
+            if delete_ids:
+                with db.files.transaction():
+                    for pic in db.query().filter(db.Picture.id.in_(delete_ids)):
+                        print('Deleting', pic.id)
+                        db.delete(pic)
+
+            if legacy and pre_tweak:
+                columns = [db.pictures.c.id, db.pictures.c.updated]
+                for id, updated in db.session.execute(select(columns)).fetchall():
+                    if id in pre_tweak and updated < pre_tweak[id][1]:
+                        pic = db.pic_by_id(id)
+                        pic.tweak, pic.updated = pre_tweak[id]
             db.session.commit()
 
             if stage:
-                for fn in os.listdir(self.staging_path):
-                    fn = path.join(self.staging_path, fn)
-                    if not os.path.isfile(fn):
+                filenames = [path.join(self.staging_path, fn) for fn in sorted(os.listdir(self.staging_path))]
+                filenames = [fn for fn in filenames if os.path.isfile(fn)]
+                with trace.span('stage.analyse', files=len(filenames)):
+                    staged = StagingCache(self.staging_cache).analyse(filenames)
+                if filenames:
+                    from butter import interface
+                for fn in filenames:
+                    if staged[fn] is None:
                         continue
                     try:
-                        if not interface.collision_check(db, fn):
-                            continue
-                        pic = interface.populate(db, fn)
+                        with trace.span('stage.collision_check', file=fn):
+                            if not interface.collision_check(db, fn, staged=staged[fn]):
+                                continue
+                        with trace.span('stage.populate', file=fn):
+                            pic = interface.populate(db, fn, staged=staged[fn])
                         if pic:
-                            self.add_pic(fn, pic, db)
+                            self.add_pic(fn, pic, db, staged=staged[fn])
                     except (KeyboardInterrupt, EOFError):
                         break
 
             db.session.flush()
 
         if push and self.remote:
-            self._push(verbose)
+            self._push(verbose, legacy=legacy)
 
-    def add_pic(self, fn, pic, db):
+    @trace.traced('stage.add')
+    def add_pic(self, fn, pic, db, staged=None):
         pic.added = datetime.now()
         pic.updated = datetime.now()
-        if pic.is_still:
-            pic.hash = tonk(imagehash.phash(Image.open(fn)))
+        if staged is not None and (staged.hash is not None or not pic.is_still):
+            # Videos that could not be hashed in the staging pool are not
+            # tried again here
+            pic.hash, frames = staged.hash or 0, staged.signature
         else:
-            pic.hash = 0
-        db.session.add(pic)
-        db.session.commit()
-        run(['mv', fn, pic.filename], stdout=PIPE, check=True)
+            pic.hash, frames = hash_file(fn, pic.is_still)
+        with db.files.transaction():
+            db.session.add(pic)
+            db.session.flush()
+            db.hash_index.add(pic)
+            if frames:
+                db.signatures.set(pic.id, frames)
+            db.files.move(fn, pic.filename)
         self.plugin_manager.add_succeeded(pic)
         print('Committed as {}'.format(path.basename(pic.filename)))
 
@@ -268,9 +403,9 @@ class Picture:
 
     def __sub__(self, other):
         if isinstance(other, Picture):
-            return np.count_nonzero(untonk(self.hash) != untonk(other.hash))
-        elif isinstance(other, imagehash.ImageHash):
-            return np.count_nonzero(untonk(self.hash) != untonk(tonk(other)))
+            return distance(self.hash, other.hash)
+        elif is_imagehash(other):
+            return distance(self.hash, tonk(other))
         return NotImplemented
 
     def assign_field(self, key, value):
@@ -289,16 +424,20 @@ class Picture:
                          for field in self.fields)
 
     def mark_tweak(self, value=True):
-        self.tweak = value
-        self.updated = datetime.now()
-        self.db.session.commit()
+        self.db.edits.set(self, tweak=value, updated=datetime.now())
 
     def replace_with(self, fn):
         _, ext = path.splitext(fn)
-        run(['rm', self.filename], stdout=PIPE, check=True)
-        self.extension = ext[1:]
-        run(['mv', fn, self.filename], stdout=PIPE, check=True)
-        self.db.session.commit()
+        # The file operations commit at once, together with pending edits
+        self.hash, frames = hash_file(fn, self.is_still)
+        with self.db.files.transaction():
+            self.db.files.unlink(self.filename)
+            self.extension = ext[1:]
+            self.db.hash_index.add(self)
+            if frames:
+                self.db.signatures.set(self.id, frames)
+            self.db.files.move(fn, self.filename)
+        self.db.thumbnails.invalidate(self.id)
 
 
 class Database(AbstractDatabase):
@@ -306,20 +445,55 @@ class Database(AbstractDatabase):
     def __init__(self, name, plugin_manager, **kwargs):
         self.plugin_manager = plugin_manager
         super().__init__(name)
+        self.generation = 0
+        self.written = False
         self.setup_db()
         self.make_pickers()
+        self.sql_stamp = file_stamp(self.local_sql)
 
     def __repr__(self):
         return f'Database({self.name})'
 
     def close(self):
-        pass
+        self.edits.flush()
+        self.checkpoint()
+        self.session.close()
+        self.manifest.close()
+
+    def checkpoint(self):
+        """Move the write-ahead log, if any, into the database file.
+        Uncommitted changes are rolled back."""
+        self.session.rollback()
+        self.session.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+        self.session.commit()
 
     def load_config(self):
+        self.config_stamp = file_stamp(self.local_config)
         with open(self.local_config, 'r') as f:
             cfg = yaml.load(f, Loader=yaml.Loader)
         self.cfg = cfg
 
+    def load_indexes(self):
+        """The indexes chosen by the advisor. Older databases recorded
+        them in the config."""
+        try:
+            with open(self.local_indexes, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return self.cfg.get('indexes', [])
+
+    def save_indexes(self, specs):
+        tmp = self.local_indexes + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(specs, f, indent=2)
+        os.replace(tmp, self.local_indexes)
+
+    def stale(self):
+        """Whether the database file or the config has been changed since
+        they were loaded, other than by our own commits."""
+        return (file_stamp(self.local_sql) != self.sql_stamp or
+                file_stamp(self.local_config) != self.config_stamp)
+
     def setup_db(self):
         columns = [
             Column('id', Integer, primary_key=True),
@@ -338,19 +512,71 @@ class Database(AbstractDatabase):
             {'fields': fields, 'db': self, 'root': self.local_contents}
         )
 
-        self.engine = create_engine('sqlite:///{}'.format(self.local_sql))
+        self.engine = get_engine(self.local_sql)
         metadata = MetaData(bind=self.engine)
         table = Table('pictures', metadata, *columns)
+        self.hash_index = HashIndex(self, metadata)
+        self.files = FileOps(self, metadata)
+        self.manifest = ContentsManifest(self)
+        self.changelog = Changelog(self, metadata)
+        self.membership = PickerMembership(self, metadata)
+        self.thumbnails = ThumbnailStore(self)
+        self.edits = EditQueue(self)
+        self.signatures = signature.Signatures(self, metadata)
         metadata.create_all()
         mapper(PictureClass, table)
+        event.listen(PictureClass, 'before_insert', self.changelog.assign_id)
 
         self.Picture = PictureClass
+        self.pictures = table
         self.update_session()
+        advisor.apply(self, self.load_indexes())
+        self.files.recover()
+        self.signatures.install()
+        self.changelog.install()
 
     def update_session(self):
         if hasattr(self, 'session'):
             self.session.close()
         self.session = create_session(bind=self.engine, autocommit=False, autoflush=True)
+        event.listen(self.session, 'after_flush', lambda session, context: self.flushed(session))
+        event.listen(self.session, 'after_commit', lambda session: self.committed())
+        event.listen(self.session, 'after_rollback', lambda session: self.rolled_back())
+
+    def flushed(self, session):
+        # Only pictures are mapped, so any flushed object is a picture
+        if session.new or session.dirty or session.deleted:
+            self.wrote()
+
+    def wrote(self):
+        """Record that pictures have been written in this transaction, so
+        that the pickers reload their ids after it ends."""
+        self.written = True
+
+    def bump(self):
+        if self.written:
+            self.generation += 1
+            self.written = False
+
+    def committed(self):
+        self.bump()
+        self.sql_stamp = file_stamp(self.local_sql)
+        self.hash_index.committed()
+        self.manifest.committed()
+        self.edits.committed()
+
+    def pending(self):
+        """Whether the session has anything to commit: objects not yet
+        flushed, or statements that have opened a transaction."""
+        session = self.session
+        if session.new or session.dirty or session.deleted:
+            return True
+        return session.connection().connection.connection.in_transaction
+
+    def rolled_back(self):
+        self.bump()
+        self.hash_index.rolled_back()
+        self.edits.rolled_back()
 
     def query(self):
         return self.session.query(self.Picture)
@@ -365,12 +591,52 @@ class Database(AbstractDatabase):
         return {p.id: p.updated for p in self.tweak_pics()}
 
     def delete(self, pic):
-        if path.exists(pic.filename):
-            run(['rm', pic.filename], check=True)
-        self.session.delete(pic)
-        self.session.commit()
-
-    def picker(self, filters=[]):
+        with self.files.transaction():
+            self.files.unlink(pic.filename)
+            self.hash_index.remove(pic.id)
+            self.session.delete(pic)
+        self.thumbnails.invalidate(pic.id)
+
+    def file_rows(self, ids=None, chunk=500):
+        """Yield (id, filename, is_still) for all pictures, or those with
+        the given IDS in order of id, without loading them."""
+        c = self.pictures.c
+        query = select([c.id, c.extension, c.is_still])
+        if ids is None:
+            queries = [query]
+        else:
+            ids = sorted(ids)
+            queries = (
+                query.where(c.id.in_(ids[i:i+chunk])).order_by(c.id)
+                for i in range(0, len(ids), chunk)
+            )
+        for part in queries:
+            for id, ext, is_still in self.session.execute(part):
+                yield id, path.join(self.local_contents, f'{id:0>8}.{ext}'), is_still
+
+    def _pics_by_distance(self, found):
+        pics = {pic.id: pic for pic in self.query().filter(self.Picture.id.in_([id for _, id in found]))}
+        return [pics[id] for _, id in found if id in pics]
+
+    def similar(self, hash, threshold, frames=None):
+        """Return all pictures within THRESHOLD of HASH, closest first.
+        With the signature FRAMES of a video or animation, pictures whose
+        own signatures are farther than THRESHOLD from it are left out."""
+        if is_imagehash(hash):
+            hash = tonk(hash)
+        found = self.hash_index.similar(hash, threshold)
+        if frames and found:
+            near = set(self.signatures.near(frames, [id for _, id in found], threshold))
+            found = [(d, id) for d, id in found if id in near]
+        return self._pics_by_distance(found)
+
+    def nearest(self, hash, k):
+        """Return the K pictures closest to HASH, closest first."""
+        if is_imagehash(hash):
+            hash = tonk(hash)
+        return self._pics_by_distance(self.hash_index.nearest(hash, k))
+
+    def picker(self, filters=[], name=None):
         if not filters:
             if hasattr(self, 'default_picker'):
                 return self.default_picker
@@ -386,7 +652,7 @@ class Database(AbstractDatabase):
             return picker
 
         filters = [eval(s, None, self.Picture.__dict__) for s in filters]
-        return FilterPicker(self, *filters)
+        return FilterPicker(self, *filters, name=name)
 
     def make_pickers(self):
         self.pickers = OrderedDict()
@@ -394,4 +660,8 @@ class Database(AbstractDatabase):
             return
         for spec in self.cfg['pickers']:
             name, filters = next(iter(spec.items()))
-            self.pickers[name] = self.picker(filters)
+            self.pickers[name] = self.picker(filters, name=name)
+        self.membership.install({
+            name: p.filters for name, p in self.pickers.items()
+            if isinstance(p, FilterPicker) and p.filters
+        })
@@ -0,0 +1,149 @@
+"""Near-duplicate clusters over the whole collection.
+
+All picture hashes are compared with each other block by block with
+the Hamming kernel. Pairs of videos or animations are also compared by
+their signatures, and pictures within the threshold of each other are
+joined into clusters with union-find. Each cluster is then shown in the
+PickOne program, to keep one of its pictures or drop some of them.
+
+Progress is saved to a checkpoint file after every row of blocks and
+every resolved cluster, so that a search over a large collection can be
+interrupted and resumed. An unfinished search is only resumed if the
+hashes have not changed in the meantime.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+from sqlalchemy.sql import and_, select
+from tqdm import tqdm
+
+from butter.hamming import HashArray
+
+
+CHUNK = 2048
+
+
+class UnionFind:
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        parent = self.parent
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            a, b = min(a, b), max(a, b)
+            self.parent[b] = a
+
+    def groups(self):
+        """Return all sets of two or more elements, as sorted lists, in
+        order of their smallest element."""
+        groups = {}
+        for x in self.parent:
+            groups.setdefault(self.find(x), []).append(x)
+        return sorted(sorted(group) for group in groups.values() if len(group) > 1)
+
+
+class Checkpoint:
+    """The progress of a search with a given threshold, persisted as JSON."""
+
+    def __init__(self, filename, threshold):
+        self.filename = filename
+        self.threshold = threshold
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+            if data['threshold'] != threshold:
+                raise ValueError
+            self.key, self.next, self.done = data['key'], data['next'], data['done']
+            self.pairs, self.resolved = data['pairs'], data['resolved']
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            self.reset(None)
+
+    def reset(self, key):
+        self.key, self.next, self.done = key, 0, False
+        self.pairs, self.resolved = [], 0
+
+    def save(self):
+        data = {
+            'threshold': self.threshold, 'key': self.key, 'next': self.next, 'done': self.done,
+            'pairs': self.pairs, 'resolved': self.resolved,
+        }
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.filename)
+
+    def remove(self):
+        try:
+            os.unlink(self.filename)
+        except FileNotFoundError:
+            pass
+
+
+def collection(db):
+    """Return the hashes of all pictures ordered by id, leaving out
+    videos without a hash."""
+    array = db.hash_index.array()
+    c = db.pictures.c
+    unhashed = [id for id, in db.session.execute(select([c.id]).where(and_(c.is_still == False, c.hash == 0)))]
+    order = np.argsort(array.ids, kind='stable')
+    order = order[~np.isin(array.ids[order], unhashed)]
+    return HashArray(array.ids[order], array.hashes[order].view(np.int64))
+
+
+def fingerprint(array):
+    digest = hashlib.sha1(array.ids.tobytes())
+    digest.update(array.hashes.tobytes())
+    return digest.hexdigest()
+
+
+def search(db, checkpoint, chunk=CHUNK):
+    """Find all pairs of pictures within the threshold of CHECKPOINT,
+    continuing where it left off. Returns the clusters as sorted lists
+    of ids."""
+    if not checkpoint.done:
+        array = collection(db)
+        key = fingerprint(array)
+        if checkpoint.key != key:
+            checkpoint.reset(key)
+        n = len(array)
+        rows = (n + chunk - 1) // chunk
+        blocks = lambda a: rows - a // chunk
+        with tqdm(total=rows * (rows + 1) // 2, desc='Comparing', unit='block') as bar:
+            bar.update(sum(blocks(a) for a in range(0, checkpoint.next, chunk)))
+            for a in range(checkpoint.next, n, chunk):
+                found = [(i, j) for _, i, j in array.pairs(checkpoint.threshold, chunk, start=a, stop=a+chunk)]
+                checkpoint.pairs.extend(db.signatures.confirm(found, checkpoint.threshold))
+                checkpoint.next = a + chunk
+                checkpoint.save()
+                bar.update(blocks(a))
+        checkpoint.done = True
+        checkpoint.save()
+
+    clusters = UnionFind()
+    for i, j in checkpoint.pairs:
+        clusters.union(i, j)
+    return clusters.groups()
+
+
+def resolve(db, clusters, checkpoint):
+    """Show each unresolved cluster in the PickOne program."""
+    from butter import gui, programs
+    for k in range(checkpoint.resolved, len(clusters)):
+        pics = db.query().filter(db.Picture.id.in_(clusters[k])).order_by(db.Picture.id).all()
+        if len(pics) > 1:
+            input(f'Cluster {k+1}/{len(clusters)}: {len(pics)} pictures...')
+            gui.run_gui(program=programs.PickOne.factory(*pics))
+        checkpoint.resolved = k + 1
+        checkpoint.save()
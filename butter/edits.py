@@ -0,0 +1,54 @@
+"""Write-behind queue for edits to pictures.
+
+Edits are applied to the pictures right away, but while the queue is
+deferred they are not committed. They are coalesced per picture and
+written in one transaction when the queue is flushed, which the GUI
+does on a timer, when the program changes and when it closes. If the
+session is rolled back in the meantime, the pending edits are applied
+again on the next flush.
+"""
+
+from collections import OrderedDict
+
+
+class EditQueue:
+
+    def __init__(self, db):
+        self.db = db
+        self.pending = OrderedDict()
+        self.deferred = False
+        self.reapply = False
+
+    def __len__(self):
+        return len(self.pending)
+
+    def set(self, pic, **values):
+        """Assign VALUES to the fields of PIC, and commit unless the
+        queue is deferred."""
+        for key, value in values.items():
+            setattr(pic, key, value)
+        self.pending.setdefault(pic.id, {}).update(values)
+        if not self.deferred:
+            self.flush()
+
+    def flush(self):
+        """Commit the pending edits."""
+        if not self.pending:
+            return
+        if self.reapply:
+            for id, values in self.pending.items():
+                pic = self.db.pic_by_id(id)
+                if pic is None:
+                    continue
+                for key, value in values.items():
+                    setattr(pic, key, value)
+            self.reapply = False
+        self.db.session.commit()
+
+    def committed(self):
+        if not self.reapply:
+            self.pending.clear()
+
+    def rolled_back(self):
+        if self.pending:
+            self.reapply = True
@@ -0,0 +1,119 @@
+"""File operations that commit together with the database.
+
+Moves and deletions requested inside a transaction are queued. On
+commit, the queue is first written to a journal file together with a
+transaction id, the id is inserted into the database as part of the
+same commit, and only then are the operations carried out. After a
+crash, the journal is replayed if its id made it into the database and
+discarded otherwise, so the database and the contents directory never
+disagree on anything but the pending operations.
+"""
+
+from contextlib import contextmanager
+import errno
+import json
+import os
+import os.path as path
+import shutil
+from uuid import uuid4
+
+from sqlalchemy import Column, String, Table
+
+
+def move(source, target):
+    try:
+        os.replace(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source, target)
+
+
+def affected(ops):
+    for op, *args in ops:
+        yield from args
+
+
+def apply(ops):
+    for op, *args in ops:
+        if op == 'move':
+            source, target = args
+            if path.exists(source):
+                move(source, target)
+        elif op == 'unlink':
+            filename, = args
+            if path.exists(filename):
+                os.unlink(filename)
+
+
+class FileOps:
+
+    def __init__(self, db, metadata):
+        self.db = db
+        self.filename = path.join(db.path, 'journal.json')
+        self.table = Table('journal', metadata, Column('id', String, primary_key=True))
+        self.ops = []
+        self.depth = 0
+
+    @property
+    def session(self):
+        return self.db.session
+
+    @contextmanager
+    def transaction(self):
+        """Group database changes and file operations into one commit.
+        Transactions nest; only the outermost one commits."""
+        self.depth += 1
+        try:
+            yield
+        except BaseException:
+            self.depth -= 1
+            if self.depth == 0:
+                self.ops = []
+                self.session.rollback()
+            raise
+        self.depth -= 1
+        if self.depth == 0:
+            self.commit()
+
+    def commit(self):
+        ops, self.ops = self.ops, []
+        if not ops:
+            self.session.commit()
+            return
+        txid = uuid4().hex
+        with open(self.filename, 'w') as f:
+            json.dump({'id': txid, 'ops': ops}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        self.session.execute(self.table.delete())
+        self.session.execute(self.table.insert(), [{'id': txid}])
+        self.session.commit()
+        with self.db.manifest.updating(affected(ops)):
+            apply(ops)
+        os.unlink(self.filename)
+
+    def move(self, source, target):
+        with self.transaction():
+            self.ops.append(('move', source, target))
+
+    def unlink(self, filename):
+        with self.transaction():
+            self.ops.append(('unlink', filename))
+
+    def recover(self):
+        """Finish or discard the operations of an interrupted commit."""
+        try:
+            with open(self.filename, 'r') as f:
+                journal = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            journal = None
+        if journal is not None:
+            query = self.table.select().where(self.table.c.id == journal['id'])
+            if self.session.execute(query).first() is not None:
+                print(f"Completing {len(journal['ops'])} interrupted file operations")
+                with self.db.manifest.updating(affected(journal['ops'])):
+                    apply(journal['ops'])
+        os.unlink(self.filename)
@@ -13,6 +13,8 @@ from ..programs import Slideshow
 
 class MainWindow(Main, QMainWindow):
 
+    flush_delay = 2000
+
     def __init__(self, db=None, program=None, safe=False):
         Main.__init__(self, db=db, safe=safe)
         QMainWindow.__init__(self)
@@ -27,6 +29,8 @@ class MainWindow(Main, QMainWindow):
 
         if db:
             self.picker_dialog = PickerDialog(self.db)
+            db.edits.deferred = True
+            self.start_timer(self.flush_delay, methodcaller('flush_edits'))
 
         if program is None and db is not None:
             program = db.plugin_manager.get_default_program()
@@ -39,6 +43,16 @@ class MainWindow(Main, QMainWindow):
         self.current_pic = pic
         self.main.load(pic)
 
+    def _show_grid(self, rows, index):
+        self.current_pic = None
+        self.main.show_grid(rows, index, self.db.thumbnails)
+
+    def grid_columns(self):
+        return self.main.grid.columns()
+
+    def _prefetch(self, pics):
+        self.main.prefetch([pic.filename for pic in pics if pic.is_still])
+
     def status_message(self, value=None):
         if value is None:
             value = self.program.message
@@ -110,6 +124,9 @@ class MainWindow(Main, QMainWindow):
 
     def close(self):
         self.main.halt()
+        if self.db:
+            self.flush_edits()
+            self.db.edits.deferred = False
         super().close()
 
     @property
@@ -0,0 +1,168 @@
+"""Decode-ahead cache of images for the GUI.
+
+Images are decoded to QImage on a pool of worker threads, so that the
+UI thread only has to convert an already decoded image to a pixmap.
+Decoded images are kept in an LRU cache bounded by their size in
+bytes, and dropped when the file has been modified since. Requests for
+images that are no longer wanted are dropped from the queue before
+they are started.
+
+When the cache has a target size, images are decoded directly at the
+smallest size that still covers it (for JPEG this uses DCT scaling),
+so that the full resolution is only decoded when it is shown.
+"""
+
+from collections import OrderedDict
+import os
+
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QImage, QImageIOHandler, QImageReader
+
+from .. import trace
+
+
+BUDGET = 256 << 20
+
+
+def mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def decode(filename, target=None):
+    """Decode FILENAME, scaled down to fit TARGET if it is larger.
+    Returns the image and whether it was scaled."""
+    reader = QImageReader(filename)
+    reader.setAutoTransform(True)
+    full = reader.size()
+    scaled = False
+    if target is not None and full.isValid():
+        if reader.transformation() & QImageIOHandler.TransformationRotate90:
+            target = target.transposed()
+        fitted = full.scaled(target, Qt.KeepAspectRatio)
+        if 0 < fitted.width() < full.width():
+            reader.setScaledSize(fitted)
+            scaled = True
+    return reader.read(), scaled
+
+
+def covers(image, target):
+    """Whether IMAGE is large enough to be shown at TARGET."""
+    if target is None:
+        return False
+    fitted = image.size().scaled(target, Qt.KeepAspectRatio)
+    return fitted.width() <= image.width()
+
+
+class DecodeJob(QRunnable):
+
+    def __init__(self, cache, filename, target):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.cache = cache
+        self.filename = filename
+        self.target = target
+
+    def run(self):
+        stamp = mtime(self.filename)
+        with trace.span('gui.decode', file=self.filename):
+            image, scaled = decode(self.filename, self.target)
+        self.cache.decoded.emit(self.filename, image, (stamp, scaled))
+
+
+class ImageCache(QObject):
+
+    decoded = pyqtSignal(str, QImage, object)
+
+    def __init__(self, budget=BUDGET, workers=2):
+        super().__init__()
+        self.budget = budget
+        self.images = OrderedDict()
+        self.size = 0
+        self.target = None
+        self.jobs = {}
+        self.waiting = {}
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(workers)
+        self.decoded.connect(self.finished)
+
+    def __contains__(self, filename):
+        return self.lookup(filename) is not None
+
+    def lookup(self, filename):
+        entry = self.images.get(filename)
+        if entry is None:
+            return None
+        stamp, image, scaled = entry
+        if scaled and not covers(image, self.target):
+            return None
+        if stamp != mtime(filename):
+            self.discard(filename)
+            return None
+        self.images.move_to_end(filename)
+        return image
+
+    def get(self, filename, callback):
+        """Call CALLBACK with the decoded image of FILENAME: immediately
+        if it is cached, otherwise as soon as it has been decoded. Only
+        the last callback registered for an image is called."""
+        image = self.lookup(filename)
+        if image is not None:
+            callback(image)
+            return
+        self.waiting = {filename: callback}
+        job = self.jobs.get(filename)
+        if job is not None and self.pool.tryTake(job):
+            del self.jobs[filename]
+        self.submit(filename, priority=1)
+
+    def cancel(self):
+        self.waiting = {}
+
+    def prefetch(self, filenames):
+        """Decode FILENAMES in the background, cancelling queued requests
+        for other images."""
+        wanted = set(filenames) | self.waiting.keys()
+        for filename, job in list(self.jobs.items()):
+            if filename not in wanted and self.pool.tryTake(job):
+                del self.jobs[filename]
+        for filename in filenames:
+            if self.lookup(filename) is None:
+                self.submit(filename)
+
+    def submit(self, filename, priority=0):
+        if filename in self.jobs:
+            return
+        job = DecodeJob(self, filename, self.target)
+        self.jobs[filename] = job
+        self.pool.start(job, priority)
+
+    def finished(self, filename, image, info):
+        self.jobs.pop(filename, None)
+        if not image.isNull():
+            self.insert(filename, image, *info)
+        callback = self.waiting.pop(filename, None)
+        if callback:
+            callback(image)
+
+    def insert(self, filename, image, stamp, scaled):
+        self.discard(filename)
+        self.images[filename] = (stamp, image, scaled)
+        self.size += image.sizeInBytes()
+        while self.size > self.budget and len(self.images) > 1:
+            _, (_, evicted, _) = self.images.popitem(last=False)
+            self.size -= evicted.sizeInBytes()
+
+    def discard(self, filename):
+        entry = self.images.pop(filename, None)
+        if entry is not None:
+            self.size -= entry[1].sizeInBytes()
+
+    def clear(self):
+        self.pool.clear()
+        self.jobs = {}
+        self.waiting = {}
+        self.images.clear()
+        self.size = 0
@@ -0,0 +1,150 @@
+"""Scrollable grid of thumbnails.
+
+The grid is a list view in icon mode with uniform item sizes, so Qt
+only asks the model for the thumbnails of the visible cells. These are
+loaded, or made if they do not exist yet, on a pool of worker threads,
+and queued requests for cells that have been scrolled past are
+cancelled.
+"""
+
+from collections import OrderedDict
+import os
+
+from PyQt5.QtCore import (
+    Qt, QAbstractListModel, QModelIndex, QRunnable, QSize, QThreadPool, pyqtSignal,
+)
+from PyQt5.QtGui import QColor, QImage, QPixmap
+from PyQt5.QtWidgets import QAbstractItemView, QListView
+
+from .. import trace
+from ..thumbnails import SIZE
+
+
+CACHED = 2048
+MARGIN = 32
+
+
+class ThumbnailJob(QRunnable):
+
+    def __init__(self, model, row):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.model = model
+        self.row = row
+        self.id, self.source, self.is_still = model.rows[row]
+
+    def run(self):
+        with trace.span('gui.thumbnail', id=self.id):
+            fn = self.model.store.get(self.id, self.source, self.is_still)
+            image = QImage(fn) if fn else QImage()
+        self.model.loaded.emit(self.row, self.id, image)
+
+
+class ThumbnailModel(QAbstractListModel):
+
+    loaded = pyqtSignal(int, int, QImage)
+
+    def __init__(self, rows, store):
+        super().__init__()
+        self.rows = rows
+        self.store = store
+        self.pixmaps = OrderedDict()
+        self.jobs = {}
+        self.priority = 0
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(os.cpu_count() or 2)
+        self.loaded.connect(self.finished)
+
+        self.placeholder = QPixmap(SIZE, SIZE)
+        self.placeholder.fill(QColor(30, 30, 30))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        id, _, _ = self.rows[index.row()]
+        if role == Qt.ToolTipRole:
+            return f'{id:08}'
+        if role != Qt.DecorationRole:
+            return None
+        pixmap = self.pixmaps.get(id)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(id)
+            return pixmap
+        self.request(index.row())
+        return self.placeholder
+
+    def request(self, row):
+        if row in self.jobs:
+            return
+        # Later requests are for cells that have just become visible
+        self.priority += 1
+        job = ThumbnailJob(self, row)
+        self.jobs[row] = job
+        self.pool.start(job, self.priority)
+
+    def prune(self, first, last):
+        """Cancel queued requests for rows outside FIRST to LAST."""
+        for row, job in list(self.jobs.items()):
+            if not first - MARGIN <= row <= last + MARGIN and self.pool.tryTake(job):
+                del self.jobs[row]
+
+    def finished(self, row, id, image):
+        self.jobs.pop(row, None)
+        if image.isNull():
+            return
+        self.pixmaps[id] = QPixmap.fromImage(image)
+        while len(self.pixmaps) > CACHED:
+            self.pixmaps.popitem(last=False)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def close(self):
+        self.pool.clear()
+        self.pool.waitForDone()
+
+
+class ThumbnailGrid(QListView):
+
+    def __init__(self):
+        super(ThumbnailGrid, self).__init__()
+        self.setViewMode(QListView.IconMode)
+        self.setMovement(QListView.Static)
+        self.setResizeMode(QListView.Adjust)
+        self.setUniformItemSizes(True)
+        self.setIconSize(QSize(SIZE, SIZE))
+        self.setGridSize(QSize(SIZE + 8, SIZE + 8))
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.setFocusPolicy(Qt.NoFocus)
+        self.setStyleSheet('background-color: black; selection-background-color: rgb(80, 80, 160);')
+        self.rows = None
+        self.verticalScrollBar().valueChanged.connect(self.prune)
+
+    def set_rows(self, rows, store):
+        if rows is self.rows:
+            return
+        old = self.model()
+        self.rows = rows
+        self.setModel(ThumbnailModel(rows, store))
+        if old is not None:
+            old.close()
+
+    def columns(self):
+        return max(1, self.viewport().width() // self.gridSize().width())
+
+    def set_current(self, row):
+        index = self.model().index(row)
+        self.setCurrentIndex(index)
+        self.scrollTo(index)
+
+    def prune(self):
+        model = self.model()
+        if model is None:
+            return
+        first = self.indexAt(self.viewport().rect().topLeft())
+        last = self.indexAt(self.viewport().rect().bottomRight())
+        first = first.row() if first.isValid() else 0
+        last = last.row() if last.isValid() else len(self.rows)
+        model.prune(first, last)
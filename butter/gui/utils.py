@@ -1,9 +1,9 @@
+from collections import OrderedDict
 from string import ascii_lowercase
 import sys
-from os import path
 
 from PyQt5.QtCore import Qt, QUrl
-from PyQt5.QtGui import QFont, QPixmap
+from PyQt5.QtGui import QFont, QImage, QPixmap
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent
 from PyQt5.QtMultimediaWidgets import QVideoWidget
 from PyQt5.QtWidgets import (
@@ -12,7 +12,11 @@ from PyQt5.QtWidgets import (
     QGraphicsBlurEffect,
 )
 
+from .. import trace
 from ..pickers import UnionPicker
+from ..probe import probe
+from .cache import ImageCache
+from .grid import ThumbnailGrid
 
 
 KEY_MAP = {
@@ -56,33 +60,56 @@ def key_to_text(event):
 
 class ImageView(QLabel):
 
-    def __init__(self):
+    def __init__(self, cache=None):
         super(ImageView, self).__init__()
         self.setMinimumSize(1,1)
         self.setAlignment(Qt.Alignment(0x84))
 
-        self.orig_pixmap = None
+        self.cache = cache or ImageCache()
+        self.filename = None
+        self.image = None
+        self.pixmaps = OrderedDict()
 
     def load(self, pic):
+        self.cache.cancel()
         if not pic:
-            self.orig_pixmap = QPixmap()
-        else:
-            if isinstance(pic, str):
-                fn = pic
-            else:
-                fn = pic.filename
-            self.orig_pixmap = QPixmap(fn)
+            self.filename = None
+            self.set_image(QImage())
+            return
+        self.filename = pic if isinstance(pic, str) else pic.filename
+        self.cache.target = self.size()
+        self.cache.get(self.filename, self.set_image)
+
+    def set_image(self, image):
+        self.image = image
+        self.pixmaps.clear()
         self.resize()
 
     def resize(self):
-        if not self.orig_pixmap:
+        if self.image is None:
             return
-        if not self.orig_pixmap.isNull():
-            pixmap = self.orig_pixmap.scaled(self.width(), self.height(), 1, 1)
-        else:
-            pixmap = self.orig_pixmap
+        if self.image.isNull():
+            self.setPixmap(QPixmap())
+            return
+
+        size = self.size()
+        key = (size.width(), size.height())
+        pixmap = self.pixmaps.get(key)
+        if pixmap is None:
+            with trace.span('gui.scale'):
+                scaled = self.image.scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+                pixmap = QPixmap.fromImage(scaled)
+            self.pixmaps[key] = pixmap
+            while len(self.pixmaps) > 4:
+                self.pixmaps.popitem(last=False)
         self.setPixmap(pixmap)
 
+        # Decode again at a higher resolution if the view has grown
+        if self.filename and size != self.cache.target:
+            self.cache.target = size
+            if self.filename not in self.cache:
+                self.cache.get(self.filename, self.set_image)
+
     def resizeEvent(self, event):
         self.resize()
 
@@ -95,11 +122,15 @@ class MainWidget(QWidget):
         self._blur = QGraphicsBlurEffect()
         self._blur.setBlurRadius(0)
 
-        self.image = ImageView()
+        self.cache = ImageCache()
+        self.image = ImageView(self.cache)
         self.image.setGraphicsEffect(self._blur)
 
         self.video = QVideoWidget()
 
+        self.grid = ThumbnailGrid()
+        self.grid.hide()
+
         self.label = QLabel()
         self.label.setMaximumHeight(25)
         self.label.setStyleSheet('color: rgb(200, 200, 200);')
@@ -112,6 +143,7 @@ class MainWidget(QWidget):
         self.setLayout(QVBoxLayout())
         self.layout().addWidget(self.image)
         self.layout().addWidget(self.video)
+        self.layout().addWidget(self.grid)
         self.layout().addWidget(self.label)
 
         self.mplayer = QMediaPlayer(None, QMediaPlayer.VideoSurface)
@@ -147,18 +179,22 @@ class MainWidget(QWidget):
     def blur(self, value):
         self._blur.setBlurRadius(value)
 
+    @trace.traced('gui.load')
     def load(self, pic, *args, **kwargs):
         if isinstance(pic, str):
-            still = path.splitext(pic)[1].lower()[1:] not in ('webm', 'mp4')
+            info = probe(pic)
+            still = info.is_still if info else True
         else:
             still = pic.is_still if pic else True
 
+        self.grid.hide()
         if still:
-            self.image.load(pic, *args, **kwargs)
+            self.image.load(pic)
             self.video.hide()
             self.image.show()
             self.mplayer.stop()
         else:
+            self.cache.cancel()
             url = pic if isinstance(pic, str) else pic.filename
             self.mplayer.setMedia(QMediaContent(QUrl.fromLocalFile(url)))
             self.mplayer.setMuted(True)
@@ -168,6 +204,19 @@ class MainWidget(QWidget):
 
         self.overlay.setVisible(False)
 
+    def show_grid(self, rows, index, store):
+        self.cache.cancel()
+        self.mplayer.stop()
+        self.image.hide()
+        self.video.hide()
+        self.grid.set_rows(rows, store)
+        self.grid.show()
+        self.grid.set_current(index)
+        self.overlay.setVisible(False)
+
+    def prefetch(self, filenames):
+        self.cache.prefetch(filenames)
+
     def message(self, msg):
         self.label.setText('<div align="center">{}</div>'.format(msg))
 
@@ -208,7 +257,7 @@ class PickerWidget(QWidget):
         layout = QHBoxLayout()
         self.setLayout(layout)
 
-        checkbox = QCheckBox(name)
+        checkbox = QCheckBox(f'{name} ({picker.count()})')
         checkbox.setSizePolicy(QSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed))
         checkbox.setMinimumWidth(100)
         checkbox.stateChanged.connect(self.check)
@@ -0,0 +1,127 @@
+"""Vectorized Hamming distances between 64-bit perceptual hashes.
+
+Hashes are stored in the database as signed 64-bit integers. Here they
+are handled as contiguous uint64 arrays so that distances from one hash
+to a whole collection are a single XOR and popcount.
+"""
+
+import sys
+
+import numpy as np
+
+
+MASK = 0xffffffffffffffff
+
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def tonk(s):
+    """Pack an ImageHash into a signed 64-bit integer."""
+    return int(np.packbits(s.hash.flatten().astype(bool)).view('>i8')[0])
+
+
+def is_imagehash(obj):
+    # Nothing can be an ImageHash unless imagehash has been imported
+    imagehash = sys.modules.get('imagehash')
+    return imagehash is not None and isinstance(obj, imagehash.ImageHash)
+
+
+def untonk(s):
+    """Unpack a packed hash into an array of 64 bits."""
+    return np.unpackbits(np.array([s], dtype='>i8').view(np.uint8))
+
+
+def distance(a, b):
+    return bin((a ^ b) & MASK).count('1')
+
+
+def as_array(hashes):
+    """Convert a sequence of packed hashes to a contiguous uint64 array."""
+    return np.ascontiguousarray(np.asarray(hashes, dtype=np.int64).view(np.uint64))
+
+
+def popcount(x):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    return _POPCOUNT8[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def distances(hashes, query):
+    """Return the distances from QUERY to every element of HASHES."""
+    return popcount(hashes ^ np.uint64(query & MASK))
+
+
+class HashArray:
+    """A collection of (id, hash) pairs held as two parallel arrays."""
+
+    def __init__(self, ids, hashes):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.hashes = as_array(hashes)
+
+    @classmethod
+    def from_rows(cls, rows):
+        rows = np.array(list(rows), dtype=np.int64).reshape(-1, 2)
+        return cls(rows[:, 0], rows[:, 1])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def distances(self, query, start=0, stop=None):
+        """Return the distances from QUERY to the hashes in the given chunk."""
+        return distances(self.hashes[start:stop], query)
+
+    def within(self, query, threshold):
+        """Return a list of (distance, id) pairs within THRESHOLD of QUERY,
+        sorted by distance."""
+        dist = self.distances(query)
+        idx = np.flatnonzero(dist <= threshold)
+        idx = idx[np.argsort(dist[idx], kind='stable')]
+        return [(int(dist[i]), int(self.ids[i])) for i in idx]
+
+    def nearest(self, query, k):
+        """Return a list of the K (distance, id) pairs closest to QUERY."""
+        dist = self.distances(query)
+        if k < len(dist):
+            idx = np.argpartition(dist, k)[:k]
+        else:
+            idx = np.arange(len(dist))
+        idx = idx[np.lexsort((self.ids[idx], dist[idx]))]
+        return [(int(dist[i]), int(self.ids[i])) for i in idx]
+
+    def pairs(self, threshold, chunk=2048, start=0, stop=None):
+        """Yield all (distance, id, id) pairs within THRESHOLD of each other.
+
+        The collection is compared block by block, CHUNK hashes at a time,
+        beginning with the block at index START and ending before the
+        block at index STOP."""
+        n = len(self)
+        for a in range(start, n if stop is None else min(stop, n), chunk):
+            left = self.hashes[a:a+chunk]
+            for b in range(a, n, chunk):
+                dist = popcount(left[:, None] ^ self.hashes[None, b:b+chunk])
+                for i, j in zip(*np.nonzero(dist <= threshold)):
+                    if a + i < b + j:
+                        yield int(dist[i, j]), int(self.ids[a+i]), int(self.ids[b+j])
+
+
+def benchmark(n=100000, repeat=5):
+    """Compare the legacy per-picture distance loop with the kernel."""
+    from timeit import timeit
+
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(np.iinfo(np.int64).min, np.iinfo(np.int64).max, n, dtype=np.int64)
+    array = HashArray(np.arange(n), hashes)
+    query = int(hashes[0])
+    legacy = [int(h) for h in hashes[:n//100]]
+
+    def legacy_loop():
+        return [np.count_nonzero(untonk(h) != untonk(query)) for h in legacy]
+
+    slow = timeit(legacy_loop, number=repeat) / repeat * 100
+    fast = timeit(lambda: array.distances(query), number=repeat) / repeat
+    print(f'{n} hashes: legacy {slow*1000:.1f} ms (extrapolated), kernel {fast*1000:.2f} ms, '
+          f'speed-up {slow/fast:.0f}x')
+
+
+if __name__ == '__main__':
+    benchmark()
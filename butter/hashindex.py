@@ -0,0 +1,165 @@
+from itertools import combinations
+
+from sqlalchemy import Column, Index, Integer, Table
+from sqlalchemy.sql import func, select
+
+from butter.hamming import HashArray, MASK
+from butter.sidecar import HashSidecar
+
+
+NBANDS = 4
+BAND_BITS = 16
+BAND_MASK = (1 << BAND_BITS) - 1
+MAX_BAND_RADIUS = 2
+
+
+def bands(h):
+    h &= MASK
+    return [(h >> (BAND_BITS * i)) & BAND_MASK for i in range(NBANDS)]
+
+
+def neighbours(key, radius):
+    """Yield all band keys within the given Hamming radius of KEY."""
+    yield key
+    for r in range(1, radius + 1):
+        for bits in combinations(range(BAND_BITS), r):
+            mask = 0
+            for b in bits:
+                mask |= 1 << b
+            yield key ^ mask
+
+
+class HashIndex:
+    """Multi-index hashing over picture hashes.
+
+    Each hash is split into NBANDS disjoint bands, each stored in its
+    own indexed column. If two hashes are within distance r, at least
+    one band differs in at most r // NBANDS bits, so a threshold query
+    only has to look up a small set of band keys.
+
+    The same hashes are mirrored in a memory-mapped sidecar file, which
+    answers queries with the vectorized kernel without touching SQLite.
+    The band columns are used when the sidecar is unavailable, after
+    they have been compared with the hashes of every picture.
+    """
+
+    def __init__(self, db, metadata):
+        self.db = db
+        self.sidecar = HashSidecar(db.local_hashes, db.local_sql)
+        self.table = Table(
+            'hash_index', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('hash', Integer, nullable=False),
+            *(Column(f'b{i}', Integer, nullable=False) for i in range(NBANDS)),
+        )
+        for i in range(NBANDS):
+            Index(f'ix_hash_index_b{i}', self.table.c[f'b{i}'])
+        self.checked = False
+        self._array = None
+
+    @property
+    def session(self):
+        return self.db.session
+
+    def row(self, id, hash):
+        row = {'id': id, 'hash': hash}
+        row.update({f'b{i}': b for i, b in enumerate(bands(hash))})
+        return row
+
+    def add(self, pic):
+        self.ensure()
+        self._array = None
+        self.session.execute(self.table.delete().where(self.table.c.id == pic.id))
+        self.session.execute(self.table.insert(), [self.row(pic.id, pic.hash)])
+        self.sidecar.append(pic.id, pic.hash, pic.is_still)
+
+    def remove(self, id):
+        self._array = None
+        self.session.execute(self.table.delete().where(self.table.c.id == id))
+        self.sidecar.remove(id)
+
+    def committed(self):
+        self.sidecar.restamp()
+
+    def rolled_back(self):
+        if self.sidecar.dirty:
+            self.sidecar.invalidate()
+            self.checked = False
+        self._array = None
+
+    def ensure(self):
+        """Rebuild the index if it disagrees with the pictures table, e.g.
+        after the database file has been replaced by a pull."""
+        if self.checked:
+            return
+        if not self.sidecar.valid:
+            if self.stale():
+                self.rebuild()
+            self.rebuild_sidecar()
+        self.checked = True
+
+    def stale(self):
+        """Whether any picture is missing from the index, has a different
+        hash in it, or the index has rows of deleted pictures."""
+        pictures, table = self.db.pictures, self.table
+        ours = self.session.execute(select([func.count()]).select_from(table)).scalar()
+        theirs = self.session.execute(select([func.count()]).select_from(pictures)).scalar()
+        if ours != theirs:
+            return True
+        join = pictures.outerjoin(table, table.c.id == pictures.c.id)
+        mismatch = select([pictures.c.id]).select_from(join).where(table.c.hash.is_distinct_from(pictures.c.hash))
+        return self.session.execute(mismatch.limit(1)).first() is not None
+
+    def rebuild(self):
+        pictures = self.db.pictures
+        rows = self.session.execute(select([pictures.c.id, pictures.c.hash])).fetchall()
+        self.session.execute(self.table.delete())
+        if rows:
+            self.session.execute(self.table.insert(), [self.row(id, hash) for id, hash in rows])
+        self.session.flush()
+        self._array = None
+
+    def rebuild_sidecar(self):
+        pictures = self.db.pictures
+        rows = self.session.execute(select([pictures.c.id, pictures.c.hash, pictures.c.is_still]))
+        try:
+            self.sidecar.rebuild(tuple(row) for row in rows)
+        except OSError:
+            self.sidecar.invalidate()
+        self._array = None
+
+    def array(self):
+        """Return all indexed hashes as a HashArray."""
+        self.ensure()
+        if self._array is None:
+            if self.sidecar.valid:
+                self._array = self.sidecar.array()
+            else:
+                rows = self.session.execute(select([self.table.c.id, self.table.c.hash]))
+                self._array = HashArray.from_rows(tuple(row) for row in rows)
+        return self._array
+
+    def candidates(self, hash, radius):
+        """Return a HashArray of all hashes sharing at least one band with
+        HASH up to RADIUS bits."""
+        rows = set()
+        for i, key in enumerate(bands(hash)):
+            keys = list(neighbours(key, radius))
+            col = self.table.c[f'b{i}']
+            for chunk in range(0, len(keys), 500):
+                query = select([self.table.c.id, self.table.c.hash]).where(col.in_(keys[chunk:chunk+500]))
+                rows.update(tuple(row) for row in self.session.execute(query))
+        return HashArray.from_rows(rows)
+
+    def similar(self, hash, threshold):
+        """Return a list of (distance, id) pairs within THRESHOLD of HASH,
+        sorted by distance."""
+        self.ensure()
+        radius = threshold // NBANDS
+        if radius > MAX_BAND_RADIUS or self.sidecar.valid or self._array is not None:
+            return self.array().within(hash, threshold)
+        return self.candidates(hash, radius).within(hash, threshold)
+
+    def nearest(self, hash, k):
+        """Return a list of the K (distance, id) pairs closest to HASH."""
+        return self.array().nearest(hash, k)
@@ -0,0 +1,283 @@
+"""Non-interactive import of a directory of files.
+
+Field values come from a sidecar file keyed by filename, relative to
+the imported directory or just the base name:
+
+- CSV, with a 'filename' column and one column per field
+- JSON lines, one object per file with a 'filename' key
+- YAML, either a mapping from filenames to field values or a list of
+  mappings with a 'filename' key
+
+Files are probed, hashed and checked for collisions with the database
+in a process pool; every worker gets a copy of the hashes of the
+collection when it starts. Files colliding with the database or with
+an earlier file of the same import are handled by a policy:
+
+- skip: leave the file where it is
+- delete: delete the file
+- replace: delete the colliding pictures in the database and import
+  the file; a file colliding with an earlier file of the import is
+  skipped
+- add: import the file anyway
+
+The accepted files are inserted in large transactions, with the moves
+into the contents directory journaled by FileOps.
+
+The command line reads POLICIES and BATCH from here, so the heavier
+dependencies are only imported where they are used.
+"""
+
+import csv
+from datetime import datetime
+import json
+import os
+import os.path as path
+
+from butter import trace
+
+
+POLICIES = ['skip', 'delete', 'replace', 'add']
+BATCH = 1000
+
+TRUE = {'1', 'true', 'yes', 'y', 't'}
+FALSE = {'0', 'false', 'no', 'n', 'f', ''}
+
+
+class MetadataError(Exception):
+    pass
+
+
+def read_metadata(filename):
+    """Return a dictionary mapping filenames to dictionaries of field
+    values read from a CSV, JSON lines or YAML file."""
+    import yaml
+    ext = path.splitext(filename)[1].lower()
+    with open(filename, 'r', newline='') as f:
+        if ext == '.csv':
+            rows = list(csv.DictReader(f))
+        elif ext in ('.jsonl', '.ndjson'):
+            rows = [json.loads(line) for line in f if line.strip()]
+        elif ext in ('.yaml', '.yml'):
+            data = yaml.safe_load(f) or []
+            if isinstance(data, dict):
+                rows = [dict(values or {}, filename=fn) for fn, values in data.items()]
+            else:
+                rows = data
+        else:
+            raise MetadataError(f'Unknown metadata format: {filename}')
+
+    metadata = {}
+    for row in rows:
+        row = dict(row)
+        try:
+            fn = row.pop('filename')
+        except KeyError:
+            raise MetadataError(f"Metadata entry without 'filename': {row}")
+        metadata[path.normpath(fn)] = row
+    return metadata
+
+
+def convert(field, value):
+    """Convert VALUE to the type of FIELD. Strings, as read from CSV, are
+    parsed."""
+    if isinstance(value, str):
+        value = value.strip()
+        if field.py_type is bool:
+            if value.lower() not in TRUE | FALSE:
+                raise MetadataError(f"Invalid value for '{field.key}': '{value}'")
+            return value.lower() in TRUE
+        if value == '':
+            return field.default_value
+    try:
+        return field.py_type(value)
+    except (TypeError, ValueError):
+        raise MetadataError(f"Invalid value for '{field.key}': '{value}'")
+
+
+def resolve_fields(fields, values):
+    """Return a dictionary mapping field keys to converted values."""
+    resolved = {}
+    for key, value in values.items():
+        for field in fields:
+            if field.matches(key.strip()):
+                resolved[field.key] = convert(field, value)
+                break
+        else:
+            raise MetadataError(f"No such field: '{key}'")
+    return resolved
+
+
+def metadata_key(root, filename, metadata):
+    """Return the key of METADATA for FILENAME in ROOT: its path relative
+    to ROOT or its base name. Returns None if it has none."""
+    rel = path.relpath(filename, root)
+    if rel in metadata:
+        return rel
+    if path.basename(filename) in metadata:
+        return path.basename(filename)
+    return None
+
+
+def find_files(root, metadata=None):
+    """Return a list of (filename, field values) of the files to import.
+    With METADATA, only the files it lists are imported."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            full = path.join(dirpath, fn)
+            if metadata is None:
+                found.append((full, {}))
+                continue
+            key = metadata_key(root, full, metadata)
+            if key is not None:
+                found.append((full, metadata[key]))
+    return found
+
+
+def unmatched(root, metadata, files):
+    """Return the keys of METADATA that match none of FILES in ROOT."""
+    used = {metadata_key(root, fn, metadata) for fn, _ in files}
+    return sorted(set(metadata) - used)
+
+
+_existing = None
+_threshold = None
+
+
+def _init(ids, hashes, threshold):
+    global _existing, _threshold
+    from butter.hamming import HashArray
+    _existing = HashArray(ids, hashes)
+    _threshold = threshold
+
+
+def _analyse(filename):
+    from butter.staging import analyse
+    staged = analyse(filename)
+    if staged is None or staged.hash is None:
+        return staged, []
+    return staged, [id for _, id in _existing.within(staged.hash, _threshold)]
+
+
+class Importer:
+
+    def __init__(self, db, policy='skip', threshold=9, processes=None, batch=BATCH):
+        self.db = db
+        self.policy = policy
+        self.threshold = threshold
+        self.processes = processes
+        self.batch = batch
+        self.counts = dict.fromkeys(['imported', 'replaced', 'skipped', 'deleted', 'failed'], 0)
+        self.rejected = []
+
+    def reject(self, filename, reason):
+        self.rejected.append((filename, reason))
+        key = {'unknown': 'failed', 'skip': 'skipped', 'collision': 'deleted'}[reason]
+        self.counts[key] += 1
+
+    def analyse(self, files):
+        """Yield (filename, values, staged file, colliding ids) for every
+        file, computed in a process pool."""
+        from concurrent.futures import ProcessPoolExecutor
+        import numpy as np
+        from tqdm import tqdm
+        from butter.dedupe import collection
+        existing = collection(self.db)
+        initargs = (existing.ids, existing.hashes.view(np.int64), self.threshold)
+        with ProcessPoolExecutor(max_workers=self.processes, initializer=_init, initargs=initargs) as pool:
+            results = pool.map(_analyse, [fn for fn, _ in files], chunksize=4)
+            for (fn, values), (staged, collisions) in tqdm(
+                zip(files, results), total=len(files), desc='Analysing', unit='file',
+            ):
+                yield fn, values, staged, collisions
+
+    def plan(self, files):
+        """Apply the collision policy, and return a list of (filename,
+        field values, staged file, ids to replace) of the files to
+        import."""
+        import numpy as np
+        from butter.hamming import MASK, distances
+        accepted = []
+        hashes, count = np.zeros(len(files), dtype=np.uint64), 0
+        for fn, values, staged, collisions in self.analyse(files):
+            if staged is None or not staged.extension:
+                self.reject(fn, 'unknown')
+                continue
+            if staged.hash is None and staged.is_still:
+                self.reject(fn, 'unknown')
+                continue
+            if collisions and staged.signature:
+                collisions = self.db.signatures.near(staged.signature, collisions, self.threshold)
+            ours = False
+            if staged.hash is not None and count:
+                ours = bool((distances(hashes[:count], staged.hash) <= self.threshold).any())
+            if (collisions or ours) and self.policy != 'add':
+                if self.policy == 'delete':
+                    self.reject(fn, 'collision')
+                    continue
+                if self.policy == 'skip' or ours:
+                    self.reject(fn, 'skip')
+                    continue
+            else:
+                collisions = []
+            if staged.hash is not None:
+                hashes[count] = staged.hash & MASK
+                count += 1
+            accepted.append((fn, values, staged, collisions))
+        return accepted
+
+    def insert(self, accepted):
+        """Insert the accepted files, BATCH files per transaction."""
+        from tqdm import tqdm
+        db = self.db
+        replaced = set()
+        for start in tqdm(range(0, len(accepted), self.batch), desc='Inserting', unit='batch'):
+            batch = accepted[start:start+self.batch]
+            now = datetime.now()
+            with trace.span('import.insert', files=len(batch)), db.files.transaction():
+                doomed = {id for _, _, _, ids in batch for id in ids} - replaced
+                if doomed:
+                    for pic in db.query().filter(db.Picture.id.in_(doomed)):
+                        db.delete(pic)
+                        self.counts['replaced'] += 1
+                    replaced |= doomed
+                pics = []
+                for fn, values, staged, _ in batch:
+                    pic = db.Picture()
+                    for key, value in values.items():
+                        setattr(pic, key, value)
+                    pic.extension, pic.is_still = staged.extension, staged.is_still
+                    pic.hash = staged.hash if staged.hash is not None else 0
+                    pic.added = pic.updated = now
+                    db.session.add(pic)
+                    pics.append(pic)
+                db.session.flush()
+                for pic, (fn, _, staged, _) in zip(pics, batch):
+                    db.hash_index.add(pic)
+                    if staged.signature:
+                        db.signatures.set(pic.id, staged.signature)
+                    db.files.move(fn, pic.filename)
+            for pic in pics:
+                db.plugin_manager.add_succeeded(pic)
+            self.counts['imported'] += len(pics)
+
+    def run(self, files, dry_run=False):
+        """Import FILES, a list of (filename, field values). Returns a
+        dictionary of counts."""
+        fields = self.db.Picture.fields
+        files = [(fn, resolve_fields(fields, values)) for fn, values in files]
+        with trace.span('import.plan', files=len(files)):
+            accepted = self.plan(files)
+        if dry_run:
+            self.counts['imported'] = len(accepted)
+            self.counts['replaced'] = len({id for _, _, _, ids in accepted for id in ids})
+            return self.counts
+        with self.db.files.transaction():
+            for fn, reason in self.rejected:
+                if reason == 'collision':
+                    self.db.files.unlink(fn)
+        for fn, reason in self.rejected:
+            self.db.plugin_manager.add_failed(fn, reason=reason)
+        self.insert(accepted)
+        return self.counts
@@ -1,70 +1,62 @@
-import imagehash
 import os.path as path
 from os import unlink
-from PIL import Image
-from subprocess import run, PIPE
 
-from butter import gui, programs
+from butter import gui, programs, trace
+from butter.probe import probe
 
 
-def collision_check(db, filename, threshold=9):
-    try:
-        this_hash = imagehash.phash(Image.open(filename))
-    except OSError:
+def collision_check(db, filename, threshold=9, staged=None):
+    if staged is not None:
+        this_hash = staged.hash
+    else:
+        import imagehash
+        from PIL import Image
+        try:
+            with trace.span('phash', file=filename):
+                this_hash = imagehash.phash(Image.open(filename))
+        except OSError:
+            this_hash = None
+    if this_hash is None:
         return True
 
-    collisions = [pic for pic in db.query() if pic - this_hash <= threshold]
+    with trace.span('similar'):
+        collisions = db.similar(this_hash, threshold, frames=staged.signature if staged else None)
 
     if collisions:
         input(f'{len(collisions)} collisions found...')
         gui.run_gui(program=programs.Images.factory(filename, *collisions))
         choice = input('(r) replace, (d) delete, (s) skip, (a) add anyway ').strip().lower()[0]
         if choice == 'd':
-            run(['rm', filename])
+            db.files.unlink(filename)
             db.plugin_manager.add_failed(filename, reason='collision')
             return False
         if choice == 's':
             db.plugin_manager.add_failed(filename, reason='skip')
             return False
         if choice == 'r':
-            for pic in collisions:
-                db.delete(pic)
-            db.session.commit()
+            with db.files.transaction():
+                for pic in collisions:
+                    db.delete(pic)
             return True
 
     return True
 
 
-def get_extension(filename):
-    data = run(['file', filename], stdout=PIPE).stdout.decode()
-    if 'JPEG' in data:
-        return '.jpg'
-    elif 'PNG' in data:
-        return '.png'
-    elif 'GIF' in data:
-        return '.gif'
-    elif 'Web/P' in data:
-        return '.webp'
-    elif 'WebM' in data:
-        return '.webm'
-    elif 'MP4' in data:
-        return '.mp4'
-    return None
-
-
-def populate(db, filename):
+def populate(db, filename, staged=None):
     print(f'Staged: {filename}')
 
     gui.run_gui(program=programs.Images.factory(filename))
 
-    extension = get_extension(filename)
-    if not extension:
+    if staged is None:
+        with trace.span('probe', file=filename):
+            staged = probe(filename)
+    if staged is None or not staged.extension:
         print('Unable to decide filetype')
         return None
 
     pic = db.Picture()
-    pic.extension = extension[1:]
-    pic.is_still = pic.extension not in ('webm', 'mp4')
+    pic.extension = staged.extension
+    pic.is_still = staged.is_still
     modified = False
     while True:
         s = input('>>> ').strip()
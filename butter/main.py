@@ -16,7 +16,12 @@ class Main:
         except IndexError:
             return None
 
+    def flush_edits(self):
+        if self.db is not None:
+            self.db.edits.flush()
+
     def push(self, program):
+        self.flush_edits()
         if self.program:
             self.program.make_uncurrent(self)
         self.programs.append(program)
@@ -24,6 +29,7 @@ class Main:
 
     def pop(self, program, **kwargs):
         assert program is self.program
+        self.flush_edits()
         self.retval = kwargs
         self.programs.pop()
         if self.program:
@@ -38,6 +44,25 @@ class Main:
     def _show_image(self, pic):
         raise NotImplementedError
 
+    def show_grid(self, rows, index):
+        if self.safe:
+            return
+        self._show_grid(rows, index)
+
+    def _show_grid(self, rows, index):
+        raise NotImplementedError
+
+    def grid_columns(self):
+        raise NotImplementedError
+
+    def prefetch(self, pics):
+        if self.safe:
+            return
+        self._prefetch(pics)
+
+    def _prefetch(self, pics):
+        pass
+
     def status_message(self, msg):
         return self._status_message
 
@@ -0,0 +1,131 @@
+"""Persistent manifest of the contents directory.
+
+The manifest mirrors the files in contents/ together with the mtime of
+the directory when it was last scanned, and the generation stamp of the
+SQLite file when its pictures were last verified to match. Butter
+updates it whenever it moves files in or out of contents/, so that a
+sync where neither stamp changed can skip reconciliation altogether.
+"""
+
+from contextlib import contextmanager
+import os
+import os.path as path
+import sqlite3
+
+
+def stamp(filename):
+    """Return the size and mtime of an SQLite file, taking into account
+    its write-ahead log if it has one."""
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return 0, 0
+    size, mtime = st.st_size, st.st_mtime_ns
+    try:
+        wal = os.stat(filename + '-wal')
+    except FileNotFoundError:
+        return size, mtime
+    if wal.st_size:
+        size, mtime = size + wal.st_size, max(mtime, wal.st_mtime_ns)
+    return size, mtime
+
+
+def picture_id(name):
+    try:
+        return int(path.splitext(name)[0])
+    except ValueError:
+        return None
+
+
+class ContentsManifest:
+
+    def __init__(self, db):
+        self.db = db
+        self.root = db.local_contents
+        self.conn = sqlite3.connect(path.join(db.path, 'manifest.sqlite3'))
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY, id INTEGER, extension TEXT, size INTEGER, mtime INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+        ''')
+        self.consistent = self.get_stamp('db') == stamp(db.local_sql)
+
+    def close(self):
+        self.conn.close()
+
+    def get_stamp(self, key):
+        rows = dict(self.conn.execute('SELECT key, value FROM meta WHERE key LIKE ?', (key + '_%',)))
+        return rows.get(key + '_size'), rows.get(key + '_mtime')
+
+    def set_stamp(self, key, value):
+        size, mtime = value
+        self.conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                              [(key + '_size', size), (key + '_mtime', mtime)])
+
+    def dir_stamp(self):
+        return 0, os.stat(self.root).st_mtime_ns
+
+    def entry(self, name):
+        try:
+            st = os.stat(path.join(self.root, name))
+        except FileNotFoundError:
+            return None
+        ext = path.splitext(name)[1][1:]
+        return name, picture_id(name), ext, st.st_size, st.st_mtime_ns
+
+    @contextmanager
+    def updating(self, filenames):
+        """Update the entries of FILENAMES after butter has created or
+        removed them in the body of the with statement."""
+        fresh = self.get_stamp('dir') == self.dir_stamp()
+        yield
+        with self.conn:
+            for fn in filenames:
+                if path.dirname(fn) != path.dirname(self.root):
+                    continue
+                name = path.basename(fn)
+                entry = self.entry(name)
+                if entry is None:
+                    self.conn.execute('DELETE FROM files WHERE name = ?', (name,))
+                else:
+                    self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', entry)
+            if fresh:
+                self.set_stamp('dir', self.dir_stamp())
+
+    def scan(self):
+        """Bring the entries up to date with the contents directory."""
+        if self.get_stamp('dir') == self.dir_stamp():
+            return
+        dir_stamp = self.dir_stamp()
+        on_disk = set(os.listdir(self.root))
+        known = {name for name, in self.conn.execute('SELECT name FROM files')}
+        with self.conn:
+            self.conn.executemany('DELETE FROM files WHERE name = ?', ((n,) for n in known - on_disk))
+            entries = (self.entry(name) for name in on_disk - known)
+            self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                  (e for e in entries if e is not None))
+            self.set_stamp('dir', dir_stamp)
+
+    def committed(self):
+        if self.consistent:
+            with self.conn:
+                self.set_stamp('db', stamp(self.db.local_sql))
+
+    def reconcile(self, rows):
+        """Compare the contents directory with the database.
+
+        ROWS is a callable returning (id, extension) pairs for all
+        pictures, called only if the database changed since it was last
+        verified. Returns the filenames missing on disk and the filenames
+        missing in the database."""
+        dir_changed = self.get_stamp('dir') != self.dir_stamp()
+        if not dir_changed and self.consistent:
+            return set(), set()
+        self.scan()
+        existing_hd = {path.join(self.root, name) for name, in self.conn.execute('SELECT name FROM files')}
+        existing_db = {path.join(self.root, f'{id:0>8}.{ext}') for id, ext in rows()}
+        deleted_on_hd = existing_db - existing_hd
+        deleted_in_db = existing_hd - existing_db
+        self.consistent = not deleted_on_hd and not deleted_in_db
+        return deleted_on_hd, deleted_in_db
@@ -0,0 +1,107 @@
+"""Materialized membership of the named pickers.
+
+The filters of each named picker are compiled to an SQL predicate, and
+the ids of the matching pictures are stored in the picker_members
+table. Triggers on the pictures table re-evaluate the predicates for
+every inserted or updated row and drop deleted rows, so the table is
+always current and a picker only needs an index lookup to find its
+pictures. The predicates are stored in picker_defs, and the members of
+a picker are recomputed and its triggers rebuilt only when its
+definition changes.
+"""
+
+from sqlalchemy import Column, Integer, String, Table
+from sqlalchemy.exc import CompileError
+from sqlalchemy.sql import and_, select, text
+
+from butter import triggers
+
+
+def predicate(filters, dialect):
+    """Compile FILTERS to SQL, or return None if they cannot be written
+    with literal values."""
+    try:
+        return str(and_(*filters).compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    except (CompileError, NotImplementedError):
+        return None
+
+
+def quote(name):
+    return "'{}'".format(name.replace("'", "''"))
+
+
+class PickerMembership:
+
+    def __init__(self, db, metadata):
+        self.db = db
+        self.members = Table(
+            'picker_members', metadata,
+            Column('picker', String, primary_key=True),
+            Column('id', Integer, primary_key=True, index=True),
+        )
+        self.defs = Table(
+            'picker_defs', metadata,
+            Column('name', String, primary_key=True),
+            Column('predicate', String, nullable=False),
+        )
+        self.names = set()
+
+    @property
+    def session(self):
+        return self.db.session
+
+    def execute(self, sql, **kwargs):
+        return self.session.execute(text(sql), kwargs)
+
+    def install(self, pickers):
+        """Materialize PICKERS, a dictionary mapping names to lists of
+        filters. Pickers whose filters cannot be compiled are skipped."""
+        dialect = self.db.engine.dialect
+        predicates = {}
+        for name, filters in pickers.items():
+            pred = predicate(filters, dialect)
+            if pred is not None:
+                predicates[name] = pred
+        if not predicates and not self.execute('SELECT 1 FROM picker_defs').first():
+            return
+
+        existing = dict(self.execute('SELECT name, predicate FROM picker_defs').fetchall())
+        for name in existing.keys() - predicates.keys():
+            self.execute('DELETE FROM picker_members WHERE picker = :name', name=name)
+            self.execute('DELETE FROM picker_defs WHERE name = :name', name=name)
+        for name, pred in predicates.items():
+            if existing.get(name) == pred:
+                continue
+            self.execute('DELETE FROM picker_members WHERE picker = :name', name=name)
+            self.execute(
+                f'INSERT INTO picker_members SELECT :name, id FROM pictures WHERE {pred}',
+                name=name,
+            )
+            self.execute('INSERT OR REPLACE INTO picker_defs VALUES (:name, :pred)', name=name, pred=pred)
+
+        wanted = dict.fromkeys(['picker_insert', 'picker_update', 'picker_delete'])
+        if predicates:
+            body = ''.join(
+                f"INSERT OR IGNORE INTO picker_members SELECT {quote(name)}, id FROM pictures "
+                f"WHERE pictures.id = NEW.id AND ({pred});"
+                for name, pred in predicates.items()
+            )
+            wanted['picker_insert'] = f'CREATE TRIGGER picker_insert AFTER INSERT ON pictures BEGIN {body} END'
+            wanted['picker_update'] = (
+                f'CREATE TRIGGER picker_update AFTER UPDATE ON pictures BEGIN '
+                f'DELETE FROM picker_members WHERE id = OLD.id; {body} END'
+            )
+            wanted['picker_delete'] = (
+                'CREATE TRIGGER picker_delete AFTER DELETE ON pictures BEGIN '
+                'DELETE FROM picker_members WHERE id = OLD.id; END'
+            )
+        if triggers.install(self.session, wanted) or existing != predicates:
+            self.session.commit()
+        self.names = set(predicates)
+
+    def ids(self, name):
+        return select([self.members.c.id]).where(self.members.c.picker == name)
+
+    def counts(self):
+        rows = self.execute('SELECT picker, count(*) FROM picker_members GROUP BY picker')
+        return dict(rows.fetchall())
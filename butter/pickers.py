@@ -1,25 +1,126 @@
-from itertools import repeat
-from random import uniform, random
+"""Pickers choose pictures at random.
 
-from sqlalchemy.sql import func
+A FilterPicker caches the ids of its matching pictures and reloads them
+only when pictures have been written since, so that picking is a
+constant-time lookup once the cache is warm. The pictures themselves
+are drawn in batches and loaded with one query per batch. Named pickers from the
+configuration read their ids from the materialized membership table.
+A UnionPicker chooses one of its non-empty members by their frequencies
+using the alias method.
+
+A TraversePicker walks through the pictures of another picker in order,
+fetching their ids a page at a time with keyset pagination.
+"""
+
+from collections import defaultdict, deque
+from random import random, randrange
+
+import numpy as np
+from sqlalchemy import inspect
+from sqlalchemy.sql import and_, or_, select
+
+
+PREFETCH = 32
+
+
+class AliasTable:
+    """Constant-time sampling from a discrete distribution (Vose's
+    alias method)."""
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=float)
+        n = len(weights)
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        if n == 0:
+            return
+
+        scaled = weights * n / weights.sum()
+        small = [i for i, w in enumerate(scaled) if w < 1.0]
+        large = [i for i, w in enumerate(scaled) if w >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self):
+        i = randrange(len(self.prob))
+        return i if random() < self.prob[i] else int(self.alias[i])
 
 
 class FilterPicker:
 
-    def __init__(self, db, *filters):
+    def __init__(self, db, *filters, name=None):
         self.filters = filters
         self.db = db
+        self.name = name
+        self._ids = None
+        self._generation = None
+        self._batch = []
+        self._batch_generation = None
+
+    @property
+    def materialized(self):
+        return self.name in self.db.membership.names
+
+    def ids(self):
+        """Return the ids of all matching pictures."""
+        if self._generation != self.db.generation:
+            if self.materialized:
+                query = self.db.session.execute(self.db.membership.ids(self.name))
+            else:
+                query = self.db.session.query(self.db.Picture.id).filter(*self.filters)
+            self._ids = np.fromiter((id for id, in query), dtype=np.int64)
+            self._generation = self.db.generation
+        return self._ids
+
+    def count(self):
+        return len(self.ids())
 
     def get(self):
-        return self.db.query().filter(*self.filters).order_by(func.random()).first()
+        ids = self.ids()
+        if not len(ids):
+            return None
+        while self._batch and self._batch_generation == self._generation:
+            pic = self._batch.pop()
+            # Skip pictures deleted since, or detached by the session closing
+            if inspect(pic).persistent and pic not in self.db.session.deleted:
+                return pic
+        self.prefetch(ids)
+        if not self._batch:
+            # Deleted without a commit yet
+            self._generation = None
+        return self.get()
+
+    def prefetch(self, ids):
+        """Draw PREFETCH random ids and load their pictures."""
+        drawn = ids[np.random.randint(len(ids), size=PREFETCH)].tolist()
+        query = self.db.query().filter(self.db.Picture.id.in_(set(drawn)))
+        pics = {pic.id: pic for pic in query}
+        self._batch = [pics[id] for id in drawn if id in pics]
+        self._batch_generation = self._generation
+
+    def clause(self):
+        if self.materialized:
+            return self.db.Picture.id.in_(self.db.membership.ids(self.name))
+        return and_(*self.filters)
 
     def get_all(self):
-        return self.db.query().filter(*self.filters)
+        return self.db.query().filter(self.clause())
 
     def get_dist(self):
-        pics = list(self.get_all())
-        prob = 1 / len(pics)
-        yield from zip(pics, repeat(prob))
+        """Yield (id, probability) pairs for all matching pictures."""
+        ids = self.ids()
+        if not len(ids):
+            return
+        prob = 1 / len(ids)
+        for id in ids.tolist():
+            yield id, prob
 
 
 class RandomPicker(FilterPicker):
@@ -30,14 +131,88 @@ class RandomPicker(FilterPicker):
 
 class TraversePicker:
 
-    def __init__(self, picker):
-        self.pics = iter(picker.get_all())
+    page_size = 200
+
+    def __init__(self, picker, order='id'):
+        self.picker = picker
+        self.db = picker.db
+        self.descending = order.startswith('-')
+        self.column = self.db.pictures.c[order.lstrip('-')]
+        self.page = deque()
+        self.last = None
+        self.offset = 0
+        self.done = False
+
+    def ids(self):
+        return self.picker.ids()
+
+    def fetch(self):
+        """Fetch the ids of the next page."""
+        if not hasattr(self.picker, 'clause'):
+            ids = self.picker.ids()[self.offset:self.offset+self.page_size].tolist()
+            self.offset += len(ids)
+            self.page.extend(ids)
+            self.done = len(ids) < self.page_size
+            return
+
+        id = self.db.pictures.c.id
+        query = select([self.column.label('key'), id]).where(self.picker.clause())
+        if self.last is not None:
+            key, last = self.last
+            if self.descending:
+                query = query.where(or_(self.column < key, and_(self.column == key, id < last)))
+            else:
+                query = query.where(or_(self.column > key, and_(self.column == key, id > last)))
+        order = (self.column.desc(), id.desc()) if self.descending else (self.column, id)
+        rows = self.db.session.execute(query.order_by(*order).limit(self.page_size)).fetchall()
+        if rows:
+            self.last = tuple(rows[-1])
+        self.page.extend(id for _, id in rows)
+        self.done = len(rows) < self.page_size
 
     def get(self):
-        try:
-            return next(self.pics)
-        except:
+        while self.page or not self.done:
+            if not self.page:
+                self.fetch()
+                continue
+            pic = self.db.pic_by_id(self.page.popleft())
+            if pic is not None:
+                return pic
+        return None
+
+
+class ListPicker:
+    """Pick from a fixed list of ids. The pictures are traversed in the
+    order of the list."""
+
+    def __init__(self, db, ids):
+        self.db = db
+        self._ids = np.asarray(ids, dtype=np.int64)
+
+    def ids(self):
+        return self._ids
+
+    def count(self):
+        return len(self._ids)
+
+    def get(self):
+        if not len(self._ids):
             return None
+        return self.db.pic_by_id(int(self._ids[randrange(len(self._ids))]))
+
+    def get_all(self):
+        ids = self._ids.tolist()
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start+500]
+            pics = {pic.id: pic for pic in self.db.query().filter(self.db.Picture.id.in_(chunk))}
+            yield from (pics[id] for id in chunk if id in pics)
+
+    def get_dist(self):
+        if not len(self._ids):
+            return
+        prob = 1 / len(self._ids)
+        for id in self._ids.tolist():
+            yield id, prob
 
 
 class UnionPicker:
@@ -45,28 +220,58 @@ class UnionPicker:
     def __init__(self, db):
         self.pickers = []
         self.db = db
+        self._table = None
+        self._generation = None
 
     def add(self, picker, frequency=1.0):
         self.pickers.append((picker, float(frequency)))
+        self._generation = None
 
-    def get(self):
-        max = sum(f for _, f in self.pickers)
-        r = uniform(0.0, max)
+    def members(self):
+        """Return the (picker, frequency) pairs that can be picked from,
+        together with an alias table over them."""
+        if self._generation != self.db.generation:
+            members = [(p, f) for p, f in self.pickers if f > 0.0 and p.count() > 0]
+            self._members = members
+            self._table = AliasTable([f for _, f in members])
+            self._generation = self.db.generation
+        return self._members, self._table
 
-        for p, f in self.pickers:
-            r -= f
-            if r <= 0.0:
-                break
+    def ids(self):
+        members, _ = self.members()
+        if not members:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate([p.ids() for p, _ in members]))
+
+    def count(self):
+        return len(self.ids())
+
+    def probabilities(self):
+        """Return (picker, probability) for each member."""
+        members, _ = self.members()
+        total = sum(f for _, f in members)
+        return [(p, f / total) for p, f in members]
+
+    def get(self):
+        members, table = self.members()
+        if not members:
+            return None
+        picker, _ = members[table.sample()]
+        return picker.get()
 
-        return p.get()
+    def clause(self):
+        return or_(*(p.clause() for p, f in self.pickers if f > 0.0))
 
-    def get_all(self, probs=False):
+    def get_all(self):
         for p, f in self.pickers:
             if f > 0.0:
-                yield from p.get_all(probs)
+                yield from p.get_all()
 
     def get_dist(self):
-        for p, f in self.pickers:
-            if f > 0.0:
-                for pic, prob in p.get_dist():
-                    yield (pic, prob * f)
+        """Yield (id, probability) pairs, combining the probabilities of
+        pictures matched by several members."""
+        probs = defaultdict(float)
+        for picker, weight in self.probabilities():
+            for id, prob in picker.get_dist():
+                probs[id] += prob * weight
+        yield from probs.items()
@@ -1,15 +1,31 @@
+from configparser import ConfigParser
 import functools
+from glob import glob
+import importlib.util
+import json
+import os
+import os.path as path
+import sys
+
+import click
 from click import command, option, argument
 
-import yapsy.PluginManager as yapsy
+from butter import trace
+
+
+_loaders = {}
 
 
 def default_loader():
+    """Return the loader of the default database. Only one loader is
+    made per database and process."""
     from butter.config import default_database
-    from butter.db import DatabaseLoader
-    if default_database is not None:
-        return DatabaseLoader(default_database)
-    return None
+    if default_database is None:
+        return None
+    if default_database not in _loaders:
+        from butter.db import DatabaseLoader
+        _loaders[default_database] = DatabaseLoader(default_database)
+    return _loaders[default_database]
 
 
 def db_argument(name):
@@ -43,64 +59,206 @@ class PluginBase:
         return self.loader.database(*args, **kwargs)
 
 
-class PluginManager(yapsy.PluginManager):
+def _info(filename):
+    """Read the name and module of a plugin from its .yapsy-plugin file."""
+    parser = ConfigParser()
+    parser.read(filename)
+    return parser.get('Core', 'Name'), parser.get('Core', 'Module')
 
-    def __init__(self, loader):
-        from butter.config import plugin_path
 
-        super().__init__(categories_filter={
-            'all': PluginBase,
-        })
-        self._commands = {}
-        self.setPluginPlaces([plugin_path])
-        self.collectPlugins()
+def _module_files(base):
+    if path.isdir(base):
+        return sorted(
+            path.join(dirpath, fn)
+            for dirpath, _, filenames in os.walk(base)
+            for fn in filenames if fn.endswith('.py')
+        )
+    if path.exists(base + '.py'):
+        return [base + '.py']
+    return []
+
+
+def _import(base):
+    name = 'butter_plugin_' + path.basename(base)
+    if path.isdir(base):
+        spec = importlib.util.spec_from_file_location(
+            name, path.join(base, '__init__.py'), submodule_search_locations=[base],
+        )
+    else:
+        spec = importlib.util.spec_from_file_location(name, base + '.py')
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class PluginManifest:
+    """The plugins in the plugin directory, in the format of yapsy, with
+    the commands and hooks each of them provides. The manifest is cached
+    in a JSON file, and a plugin is only imported to refresh its entry
+    if the mtime of one of its files changed."""
+
+    def __init__(self, root, filename):
+        self.root = root
+        self.filename = filename
+        self.objects = {}
+
+        try:
+            with open(filename, 'r') as f:
+                cached = json.load(f)
+        except (FileNotFoundError, ValueError):
+            cached = {}
+
+        self.entries = {}
+        for info in sorted(glob(path.join(root, '*.yapsy-plugin'))):
+            name, module = _info(info)
+            base = path.join(root, module)
+            files = [info] + _module_files(base)
+            stamp = {fn: os.stat(fn).st_mtime_ns for fn in files}
+            entry = cached.get(name)
+            if entry is None or entry['stamp'] != stamp:
+                entry = self.inspect(name, base, stamp)
+            if entry is not None:
+                self.entries[name] = entry
+
+        if self.entries != cached:
+            os.makedirs(path.dirname(filename), exist_ok=True)
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(filename + '.tmp', filename)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __getitem__(self, name):
+        return self.entries[name]
 
+    def inspect(self, name, base, stamp):
+        try:
+            obj = self.instantiate(base)
+        except Exception as e:
+            print(f'Unable to load plugin {name}: {e}')
+            return None
+        self.objects[name] = obj
+        cls = type(obj)
+        return {
+            'module': base,
+            'stamp': stamp,
+            'commands': [[cmd.name, cmd.get_short_help_str()] for cmd in obj.commands],
+            'hooks': [h for h in _DISPATCHES + _GETTERS if getattr(cls, h) is not getattr(PluginBase, h)],
+        }
+
+    def instantiate(self, base):
+        module = _import(base)
+        classes = [
+            v for v in vars(module).values()
+            if isinstance(v, type) and issubclass(v, PluginBase) and v is not PluginBase
+        ]
+        classes.sort(key=lambda cls: cls.__module__ != module.__name__)
+        return classes[0]()
+
+    def load(self, name):
+        """Import plugin NAME and return an instance of it."""
+        if name not in self.objects:
+            self.objects[name] = self.instantiate(self.entries[name]['module'])
+        return self.objects[name]
+
+
+class LazyCommand(click.Command):
+    """Stand-in for a plugin command, which imports and activates the
+    plugin only when the command is invoked."""
+
+    def __init__(self, manager, plugin, name, short_help):
+        super().__init__(name, short_help=short_help)
+        self.manager = manager
+        self.plugin = plugin
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        obj = self.manager[self.plugin]
+        command = next(cmd for cmd in obj.commands if cmd.name == self.name)
+        return command.make_context(info_name, args, parent=parent, **extra)
+
+
+class PluginManager:
+
+    def __init__(self, loader):
+        self._manifest = None
+        self._enabled = []
         self._plugins = {}
-        self._commands = {}
         self.loader = loader
 
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            from butter.config import cache_path, plugin_path
+            self._manifest = PluginManifest(plugin_path, path.join(cache_path, 'plugins.json'))
+        return self._manifest
+
     def __iter__(self):
         yield from self._plugins.values()
 
     def __getitem__(self, name):
+        """Return the active plugin NAME, activating it if needed."""
+        if name not in self._plugins:
+            with trace.span('plugin.load', plugin=name):
+                obj = self.manifest.load(name)
+                obj.manager = self
+                obj.activate()
+            self._plugins[name] = obj
         return self._plugins[name]
 
     def activate(self, name):
-        if name in self._plugins:
+        """Enable plugin NAME. It is imported and activated when one of its
+        commands or hooks is first used."""
+        if name in self._enabled:
             return
-        obj = self.getPluginByName(name, 'all')
-        if obj is None:
+        if name not in self.manifest:
             print(f'Unable to find plugin: {name}')
             return
-        obj.plugin_object.manager = self
-        obj = self._plugins[name] = self.activatePluginByName(name, 'all')
-        for cmd in obj.commands:
-            self._commands[cmd.name] = cmd
+        self._enabled.append(name)
+
+    def hooked(self, hook):
+        for name in self._enabled:
+            if hook in self.manifest[name]['hooks']:
+                yield self[name]
 
     def deactivate_all(self):
         for obj in self:
             obj.deactivate()
 
     def list_commands(self):
-        return list(self._commands.keys())
+        return [cmd for name in self._enabled for cmd, _ in self.manifest[name]['commands']]
 
     def command(self, name):
-        return self._commands[name]
+        for plugin in self._enabled:
+            for cmd, short_help in self.manifest[plugin]['commands']:
+                if cmd == name:
+                    return LazyCommand(self, plugin, cmd, short_help)
+        raise KeyError(name)
 
 
+# Hooks that plugins may define:
+# - add_failed(filename, reason): FILENAME was not added. REASON is
+#   'collision' if it collided with pictures in the database and was
+#   deleted, 'skip' if it was left in place instead, and 'unknown' if
+#   it could not be identified or decoded as a picture or video.
+# - add_succeeded(pic): PIC was added.
+# - get_default_program(): a program for the GUI to start with.
 _DISPATCHES = ['add_failed', 'add_succeeded']
 _GETTERS = ['get_default_program']
 
 def src_dispatcher(name):
     def inner(self, *args, **kwargs):
-        for obj in self:
-            getattr(obj, name)(*args, **kwargs)
+        for obj in self.hooked(name):
+            with trace.span(f'plugin.{name}', plugin=type(obj).__name__):
+                getattr(obj, name)(*args, **kwargs)
     return inner
 
 def src_getter(name):
     def inner(self, *args, **kwargs):
-        for obj in self:
-            ret = getattr(obj, name)(*args, **kwargs)
+        for obj in self.hooked(name):
+            with trace.span(f'plugin.{name}', plugin=type(obj).__name__):
+                ret = getattr(obj, name)(*args, **kwargs)
             if ret:
                 return ret
         return None
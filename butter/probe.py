@@ -0,0 +1,241 @@
+"""Identify media files from their headers.
+
+Only the first few kilobytes of a file are read, plus whatever boxes or
+segments need to be skipped over to find the dimensions.
+"""
+
+from collections import namedtuple
+import struct
+
+
+Probe = namedtuple('Probe', ['format', 'extension', 'is_still', 'animated', 'width', 'height'])
+
+VIDEO_EXTENSIONS = {'webm', 'mp4', 'mkv'}
+
+MAX_SCAN = 1 << 20
+
+
+def _probe(format, extension, animated=False, width=None, height=None):
+    return Probe(format, extension, extension not in VIDEO_EXTENSIONS, animated, width, height)
+
+
+def probe_jpeg(f, size):
+    f.seek(2)
+    while f.tell() < MAX_SCAN:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            break
+        code = marker[1]
+        if code == 0xff:
+            f.seek(-1, 1)
+            continue
+        if code in (0x01, 0xd8) or 0xd0 <= code <= 0xd7:
+            continue
+        if code in (0xd9, 0xda):
+            break
+        length, = struct.unpack('>H', f.read(2))
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack('>xHH', f.read(5))
+            return _probe('JPEG', 'jpg', width=width, height=height)
+        f.seek(length - 2, 1)
+    return _probe('JPEG', 'jpg')
+
+
+def probe_png(f, size):
+    f.seek(8)
+    width = height = None
+    animated = False
+    while f.tell() < MAX_SCAN:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, kind = struct.unpack('>I4s', header)
+        if kind == b'IHDR':
+            width, height = struct.unpack('>II', f.read(8))
+            length -= 8
+        elif kind == b'acTL':
+            animated = True
+        elif kind in (b'IDAT', b'IEND'):
+            break
+        f.seek(length + 4, 1)
+    return _probe('PNG', 'png', animated, width, height)
+
+
+def _skip_gif_blocks(f):
+    while True:
+        size = f.read(1)
+        if not size or size[0] == 0:
+            return
+        f.seek(size[0], 1)
+
+
+def probe_gif(f, size):
+    f.seek(6)
+    width, height, flags = struct.unpack('<HHB', f.read(5))
+    f.seek(2, 1)
+    if flags & 0x80:
+        f.seek(3 << ((flags & 0x07) + 1), 1)
+    frames = 0
+    while frames < 2:
+        block = f.read(1)
+        if block == b'\x21':
+            f.seek(1, 1)
+            _skip_gif_blocks(f)
+        elif block == b'\x2c':
+            frames += 1
+            flags = f.read(9)[-1:]
+            if not flags:
+                break
+            if flags[0] & 0x80:
+                f.seek(3 << ((flags[0] & 0x07) + 1), 1)
+            f.seek(1, 1)
+            _skip_gif_blocks(f)
+        else:
+            break
+    return _probe('GIF', 'gif', frames > 1, width, height)
+
+
+def probe_webp(f, size):
+    f.seek(12)
+    kind, _ = struct.unpack('<4sI', f.read(8))
+    data = f.read(10)
+    width = height = None
+    animated = False
+    if kind == b'VP8 ' and len(data) >= 10:
+        width, height = struct.unpack('<HH', data[6:10])
+        width, height = width & 0x3fff, height & 0x3fff
+    elif kind == b'VP8L' and len(data) >= 5 and data[0] == 0x2f:
+        bits, = struct.unpack('<I', data[1:5])
+        width, height = (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    elif kind == b'VP8X' and len(data) >= 10:
+        animated = bool(data[0] & 0x02)
+        width = int.from_bytes(data[4:7], 'little') + 1
+        height = int.from_bytes(data[7:10], 'little') + 1
+    return _probe('WebP', 'webp', animated, width, height)
+
+
+EBML_MASTERS = {0x18538067, 0x1654ae6b, 0xae, 0xe0}
+
+
+def _ebml_vint(data, pos, mask=True):
+    first = data[pos]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8 or pos + length > len(data):
+        raise ValueError
+    value = first & (0xff >> length) if mask else first
+    for b in data[pos+1:pos+length]:
+        value = (value << 8) | b
+    return value, pos + length, value == (1 << (7 * length)) - 1
+
+
+def probe_ebml(f, size):
+    data = f.read(65536)
+    doctype, width, height = None, None, None
+    pos = 0
+    try:
+        while pos < len(data) and (width is None or height is None):
+            id, pos, _ = _ebml_vint(data, pos, mask=False)
+            length, pos, unknown = _ebml_vint(data, pos)
+            if id == 0x1a45dfa3 or id in EBML_MASTERS:
+                continue
+            value = data[pos:pos+length]
+            if id == 0x4282:
+                doctype = value.decode('ascii', 'replace').rstrip('\0')
+            elif id == 0xb0:
+                width = int.from_bytes(value, 'big')
+            elif id == 0xba:
+                height = int.from_bytes(value, 'big')
+            elif id == 0x1f43b675 or unknown:
+                break
+            pos += length
+    except ValueError:
+        pass
+    if doctype == 'webm':
+        return _probe('WebM', 'webm', True, width, height)
+    return _probe('Matroska', 'mkv', True, width, height)
+
+
+BMFF_CONTAINERS = {b'moov', b'trak', b'iprp', b'ipco'}
+
+
+def _bmff_boxes(f, end):
+    while f.tell() + 8 <= end:
+        start = f.tell()
+        size, kind = struct.unpack('>I4s', f.read(8))
+        if size == 1:
+            size, = struct.unpack('>Q', f.read(8))
+        elif size == 0:
+            size = end - start
+        if size < 8:
+            return
+        yield kind, start, start + size
+        f.seek(start + size)
+
+
+def _bmff_dimensions(f, end):
+    for kind, start, stop in _bmff_boxes(f, end):
+        header = f.tell()
+        if kind in BMFF_CONTAINERS or kind == b'meta':
+            if kind == b'meta':
+                f.seek(4, 1)
+            yield from _bmff_dimensions(f, stop)
+        elif kind == b'tkhd':
+            f.seek(stop - 8)
+            width, height = struct.unpack('>II', f.read(8))
+            yield width >> 16, height >> 16
+        elif kind == b'ispe':
+            f.seek(header + 4)
+            yield struct.unpack('>II', f.read(8))
+        f.seek(stop)
+
+
+def probe_bmff(f, size):
+    length, _, major = struct.unpack('>I4s4s', f.read(12))
+    f.seek(16)
+    brands = {major} | {f.read(4) for _ in range(max(0, (length - 16) // 4))}
+    f.seek(0)
+    dims = max(_bmff_dimensions(f, size), key=lambda d: d[0] * d[1], default=(None, None))
+    if brands & {b'avif', b'avis'}:
+        return _probe('AVIF', 'avif', b'avis' in brands, *dims)
+    if brands & {b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1'}:
+        return _probe('HEIC', 'heic', bool(brands & {b'hevc', b'hevx', b'msf1'}), *dims)
+    return _probe('MP4', 'mp4', True, *dims)
+
+
+def detect(head):
+    """Return the probing function, format name and extension for a file
+    starting with HEAD."""
+    if head.startswith(b'\xff\xd8\xff'):
+        return probe_jpeg, 'JPEG', 'jpg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return probe_png, 'PNG', 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return probe_gif, 'GIF', 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return probe_webp, 'WebP', 'webp'
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return probe_ebml, 'Matroska', 'mkv'
+    if head[4:8] == b'ftyp' and head[8:12] != b'qt  ':
+        return probe_bmff, 'MP4', 'mp4'
+    return None
+
+
+def probe(filename):
+    """Return a Probe describing FILENAME, or None if it is not a
+    recognized media file."""
+    try:
+        with open(filename, 'rb') as f:
+            kind = detect(f.read(32))
+            if kind is None:
+                return None
+            func, format, extension = kind
+            size = f.seek(0, 2)
+            f.seek(0)
+            try:
+                return func(f, size)
+            except (struct.error, IndexError):
+                return _probe(format, extension)
+    except OSError:
+        return None
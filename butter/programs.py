@@ -1,8 +1,10 @@
-from collections import namedtuple
+from collections import deque, namedtuple
 from os.path import basename
 from random import choice
 
-from .pickers import TraversePicker
+from sqlalchemy.orm import object_session
+
+from .pickers import ListPicker, TraversePicker
 
 
 BoundFunction = namedtuple('BoundFunction', ['keys', 'fn'])
@@ -80,13 +82,40 @@ class Program(metaclass=ProgramMeta):
 
 class FromPicker(Program):
 
+    prefetch = 4
+
     def __init__(self, m, picker=None):
         super(FromPicker, self).__init__(m)
         self.picker = picker or m.db.picker()
 
+    @property
+    def picker(self):
+        return self._picker
+
+    @picker.setter
+    def picker(self, value):
+        self._picker = value
+        self.upcoming = deque()
+
+    def next_pic(self, m):
+        """Return the next picture, picking a few more ahead of time so
+        that they can be decoded in the background."""
+        while len(self.upcoming) <= self.prefetch:
+            pic = self.picker.get()
+            if pic is None:
+                break
+            self.upcoming.append(pic)
+        pic = None
+        while self.upcoming and pic is None:
+            pic = self.upcoming.popleft()
+            if object_session(pic) is None:
+                pic = None
+        m.prefetch(self.upcoming)
+        return pic
+
     @bind()
     def pic(self, m, set_msg=True, pic=None):
-        pic = pic or self.picker.get()
+        pic = pic or self.next_pic(m)
         if pic is None:
             m.pop(self)
             return
@@ -97,38 +126,60 @@ class FromPicker(Program):
 
     @bind('E')
     def traverse(self, m):
-        traverse = TraversePicker(self.picker)
+        traverse = TraversePicker(self.picker, order=m.db.cfg.get('traverse', 'id'))
         Traverse(m, traverse)
 
+    @bind('g')
+    def browse(self, m):
+        Browse(m, self.picker)
+
 
 class Traverse(FromPicker):
 
+    history_size = 1000
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.history = []
+        self.history = deque(maxlen=self.history_size)
         self.index = -1
+        self.shown = None
 
     @bind('E')
     def untraverse(self, m):
         m.pop(self)
 
+    def show(self, m, pic):
+        # Let the session forget the picture we move away from
+        if self.shown is not None and self.shown is not pic and self.shown not in m.db.session.dirty:
+            m.db.session.expire(self.shown)
+        self.shown = pic
+        return super().pic(m, pic=pic)
+
+    def from_history(self, m, step):
+        while 0 <= self.index + step < len(self.history):
+            self.index += step
+            pic = m.db.pic_by_id(self.history[self.index])
+            if pic is not None:
+                return pic
+        return None
+
     @bind('BSP')
     def prev(self, m):
-        if self.index < 1:
-            return None
-        self.index -= 1
-        super().pic(m, pic=self.history[self.index])
+        pic = self.from_history(m, -1)
+        if pic is not None:
+            self.show(m, pic)
 
     @bind()
-    def pic(self, *args, **kwargs):
-        if self.index == len(self.history) - 1:
-            pic = super().pic(*args, **kwargs)
-            self.history.append(pic)
-            self.index += 1
-        else:
-            self.index += 1
-            pic = self.history[self.index]
-            return super().pic(*args, **kwargs, pic=pic)
+    def pic(self, m, *args, **kwargs):
+        pic = self.from_history(m, 1)
+        if pic is None:
+            pic = self.next_pic(m)
+            if pic is None:
+                m.pop(self)
+                return
+            self.history.append(pic.id)
+            self.index = len(self.history) - 1
+        return self.show(m, pic)
 
 
 class Slideshow(FromPicker):
@@ -175,6 +226,67 @@ class Slideshow(FromPicker):
             self.timer.setInterval(self.delay)
 
 
+class Browse(Program):
+
+    def __init__(self, m, picker):
+        super(Browse, self).__init__(m)
+        if hasattr(picker, 'ids'):
+            ids = picker.ids().tolist()
+        else:
+            ids = [pic.id for pic in picker.get_all()]
+        self.rows = list(m.db.file_rows(ids))
+        self.index = 0
+        self.show(m)
+
+    def show(self, m):
+        if not self.rows:
+            m.pop(self)
+            return
+        self.index = max(0, min(self.index, len(self.rows) - 1))
+        m.show_grid(self.rows, self.index)
+        self.message = '({}/{}) {:08}'.format(self.index + 1, len(self.rows), self.rows[self.index][0])
+
+    def make_current(self, m):
+        self.show(m)
+
+    def unpause(self, m):
+        self.show(m)
+
+    def move(self, m, delta):
+        self.index += delta
+        self.show(m)
+
+    @bind('l', 'RIGHT')
+    def right(self, m):
+        self.move(m, 1)
+
+    @bind('h', 'LEFT')
+    def left(self, m):
+        self.move(m, -1)
+
+    @bind('j', 'DOWN')
+    def down(self, m):
+        self.move(m, m.grid_columns())
+
+    @bind('k', 'UP')
+    def up(self, m):
+        self.move(m, -m.grid_columns())
+
+    @bind('SPC')
+    def page(self, m):
+        self.move(m, 4 * m.grid_columns())
+
+    @bind('RET')
+    def enter(self, m):
+        ids = [id for id, _, _ in self.rows[self.index:]]
+        traverse = Traverse(m, TraversePicker(ListPicker(m.db, ids)))
+        traverse.pic(m)
+
+    @bind('g')
+    def leave(self, m):
+        m.pop(self)
+
+
 class Images(Program):
 
     _index = 0
@@ -250,9 +362,11 @@ class PickOne(Images):
 
     @bind('RET')
     def pick(self, m):
-        for i, pic in enumerate(self.images):
-            if i != self.index:
-                pic.db.delete(pic)
+        db = self.images[self.index].db
+        with db.files.transaction():
+            for i, pic in enumerate(self.images):
+                if i != self.index:
+                    db.delete(pic)
         self.quit(m)
 
     @bind('d')
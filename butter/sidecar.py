@@ -0,0 +1,205 @@
+"""Memory-mapped (id, hash, is_still) records stored next to db.sqlite3.
+
+The file starts with a fixed header holding a magic string, the
+generation stamp of the SQLite file it was last synchronized with and
+the number of records. Deleted records are only flagged, and new
+records are kept in memory until the next commit, when they are
+appended to the file all at once. The file is compacted at a commit if
+more than a quarter of its records are deleted. While there are
+uncommitted changes the stamp is cleared, so a crash before the commit
+leads to a rebuild rather than stale records.
+"""
+
+import os
+import struct
+
+import numpy as np
+
+from butter.hamming import HashArray
+from butter.manifest import stamp
+
+
+HEADER = struct.Struct('<8sqqq')
+MAGIC = b'BTRHASH\x01'
+
+RECORD = np.dtype([('id', '<i8'), ('hash', '<i8'), ('flags', 'u1'), ('pad', 'V7')])
+
+DIRTY = (-1, -1)
+
+STILL = 1
+DELETED = 2
+
+COMPACT_MIN = 1024
+
+
+class HashSidecar:
+
+    def __init__(self, filename, sql):
+        self.filename = filename
+        self.sql = sql
+        self.records = None
+        self.pending = {}
+        self.deleted = 0
+        self._order = None
+        self.valid = False
+        self.dirty = False
+        self.open()
+
+    def stamp(self):
+        return stamp(self.sql)
+
+    def read_header(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read(HEADER.size)
+        except FileNotFoundError:
+            return None
+        if len(data) < HEADER.size:
+            return None
+        magic, size, mtime, count = HEADER.unpack(data)
+        if magic != MAGIC:
+            return None
+        return (size, mtime), count
+
+    def open(self):
+        """Map the records if the file matches the current SQLite file."""
+        header = self.read_header()
+        self.valid = header is not None and header[0] == self.stamp()
+        if self.valid:
+            self.map(header[1])
+        return self.valid
+
+    def map(self, count):
+        if count == 0:
+            self.records = np.zeros(0, dtype=RECORD)
+        else:
+            self.records = np.memmap(self.filename, dtype=RECORD, mode='r+',
+                                     offset=HEADER.size, shape=(count,))
+        self.deleted = int(np.count_nonzero(self.records['flags'] & DELETED))
+        self._order = None
+
+    def write_header(self, f, count):
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, *(DIRTY if self.dirty else self.stamp()), count))
+
+    def mark_dirty(self):
+        """Clear the stamp before the first change after a commit. Returns
+        False, and gives up on the file, if it has disappeared."""
+        if self.dirty:
+            return True
+        self.dirty = True
+        try:
+            with open(self.filename, 'r+b') as f:
+                self.write_header(f, len(self.records))
+        except FileNotFoundError:
+            self.invalidate()
+            return False
+        return True
+
+    def write(self, records):
+        """Replace the file with RECORDS."""
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            self.write_header(f, len(records))
+            f.write(records.tobytes())
+        self.records = None
+        os.replace(tmp, self.filename)
+        self.map(len(records))
+
+    def rebuild(self, rows):
+        """Rewrite the file from (id, hash, is_still) rows."""
+        rows = list(rows)
+        records = np.zeros(len(rows), dtype=RECORD)
+        if rows:
+            ids, hashes, still = zip(*rows)
+            records['id'] = ids
+            records['hash'] = hashes
+            records['flags'] = np.where(still, STILL, 0)
+        self.dirty = True
+        self.pending = {}
+        self.write(records)
+        self.valid = True
+
+    def restamp(self):
+        """Write the pending records and record that the file agrees with
+        the current SQLite file."""
+        if not self.valid:
+            return
+        try:
+            if self.deleted > max(COMPACT_MIN, len(self.records) // 4):
+                self.write(np.concatenate([self.live(), self.pending_records()]))
+            elif self.pending:
+                self.flush_pending()
+            elif self.dirty and isinstance(self.records, np.memmap):
+                self.records.flush()
+            self.pending = {}
+            self.dirty = False
+            with open(self.filename, 'r+b') as f:
+                self.write_header(f, len(self.records))
+        except FileNotFoundError:
+            self.invalidate()
+
+    def flush_pending(self):
+        new = self.pending_records()
+        count = len(self.records) + len(new)
+        if isinstance(self.records, np.memmap):
+            self.records.flush()
+        self.records = None
+        with open(self.filename, 'r+b') as f:
+            f.seek(HEADER.size + (count - len(new)) * RECORD.itemsize)
+            f.write(new.tobytes())
+            self.write_header(f, count)
+        self.map(count)
+
+    def invalidate(self):
+        self.valid = False
+        self.dirty = False
+        self.records = None
+        self.pending = {}
+        self._order = None
+
+    def find(self, id):
+        """Return the indices of the records of ID in the file."""
+        if self._order is None:
+            self._order = np.argsort(self.records['id'], kind='stable')
+            self._sorted = self.records['id'][self._order]
+        lo = np.searchsorted(self._sorted, id, side='left')
+        hi = np.searchsorted(self._sorted, id, side='right')
+        return self._order[lo:hi]
+
+    def append(self, id, hash, is_still):
+        if not self.valid:
+            return
+        self.remove(id)
+        if self.valid:
+            self.pending[id] = (hash, STILL if is_still else 0)
+
+    def remove(self, id):
+        if not self.valid or not self.mark_dirty():
+            return
+        self.pending.pop(id, None)
+        flags = self.records['flags']
+        for i in self.find(id):
+            if not flags[i] & DELETED:
+                flags[i] |= DELETED
+                self.deleted += 1
+
+    def live(self):
+        return self.records[(self.records['flags'] & DELETED) == 0]
+
+    def pending_records(self):
+        records = np.zeros(len(self.pending), dtype=RECORD)
+        if self.pending:
+            records['id'] = list(self.pending)
+            hashes, flags = zip(*self.pending.values())
+            records['hash'] = hashes
+            records['flags'] = flags
+        return records
+
+    def array(self, still=None):
+        """Return the live records as a HashArray, optionally restricted
+        to still or non-still pictures."""
+        records = np.concatenate([self.live(), self.pending_records()]) if self.pending else self.live()
+        if still is not None:
+            records = records[((records['flags'] & STILL) != 0) == still]
+        return HashArray(records['id'], records['hash'])
@@ -0,0 +1,373 @@
+"""Perceptual signatures of videos and animated images.
+
+A signature is the list of perceptual hashes of a few frames spread
+evenly over a file: the frames of an animated GIF, WebP or PNG, or the
+frames of a video at evenly spaced timestamps, found by seeking to the
+nearest keyframe and decoding forward. Sampling by time rather than by
+keyframe keeps signatures of the same video comparable across encodes
+with different keyframe intervals.
+
+The bitwise majority of the frame hashes is stored as the hash of the
+picture, so that videos and animations take part in collision checks
+like stills. The signatures themselves are kept in the signatures table.
+Candidates found by the hash are then compared frame by frame, so that
+two videos whose majority hashes agree by chance are not taken for
+duplicates.
+
+Decoding a broken or huge file can take arbitrarily long, so each file
+gets a deadline, enforced with SIGALRM where it is available. Files are
+meant to be processed in a pool of worker processes, where every task
+runs in the main thread of its worker. The signal is only handled
+between Python bytecodes, so a single long call into a C decoder (PIL
+or FFmpeg decoding one frame) runs to completion before the deadline
+takes effect. The deadline bounds the total time spent on a file, not
+the time of any one frame. FFmpeg is also given the deadline as its
+own I/O timeout.
+
+A worker stuck in one such call is caught by the parent instead: a file
+still in progress GRACE seconds after its deadline has passed gets no
+signature, and the workers are killed and replaced. Files that get no
+signature are recorded with the mtime of their file, and skipped by
+later runs until the file changes.
+"""
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+import os
+import signal
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import Column, Integer, LargeBinary, Table
+from sqlalchemy.sql import select, text
+from tqdm import tqdm
+
+from butter import triggers
+from butter.hamming import distance as hash_distance, tonk, untonk
+from butter.probe import probe
+
+
+FRAMES = 8
+TIMEOUT = 60
+GRACE = 5
+ANIMATABLE = {'gif', 'webp', 'png'}
+
+
+class Timeout(Exception):
+    pass
+
+
+@contextmanager
+def deadline(seconds):
+    """Raise Timeout in the body if it runs for longer than SECONDS.
+    Does nothing outside the main thread or without SIGALRM. A call into
+    C code is not interrupted; Timeout is raised once it returns."""
+    if not seconds or not hasattr(signal, 'SIGALRM') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    def expired(signum, frame):
+        raise Timeout()
+    previous = signal.signal(signal.SIGALRM, expired)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def spread(n, count):
+    """Return up to COUNT indices spread evenly over range(N)."""
+    if n <= count:
+        return list(range(n))
+    return sorted({int((i + 0.5) * n / count) for i in range(count)})
+
+
+def animation_frames(filename, count=FRAMES):
+    """Return COUNT frames of an animated image, or None if it is not
+    animated."""
+    from PIL import Image
+    with Image.open(filename) as img:
+        n = getattr(img, 'n_frames', 1)
+        if n < 2:
+            return None
+        frames = []
+        for i in spread(n, count):
+            img.seek(i)
+            frames.append(img.convert('RGB'))
+        return frames
+
+
+def video_frames(filename, count=FRAMES, timeout=None):
+    """Return up to COUNT frames of a video, at evenly spaced times.
+    FFmpeg gives up on reads that take longer than TIMEOUT seconds."""
+    import av
+    with av.open(filename, timeout=timeout) as container:
+        stream = container.streams.video[0]
+        if stream.duration:
+            duration = float(stream.duration * stream.time_base)
+        elif container.duration:
+            duration = container.duration / av.time_base
+        else:
+            duration = None
+
+        if not duration or not stream.time_base:
+            # Without a duration there is nothing to seek to, so take the
+            # first keyframes instead
+            stream.codec_context.skip_frame = 'NONKEY'
+            frames = []
+            for frame in container.decode(stream):
+                frames.append(frame.to_image())
+                if len(frames) == count:
+                    break
+            return frames
+
+        frames, seen = [], set()
+        for i in range(count):
+            target = (i + 0.5) * duration / count
+            container.seek(int(target / stream.time_base), stream=stream)
+            for frame in container.decode(stream):
+                if frame.time is None or frame.time >= target:
+                    break
+            else:
+                continue
+            if frame.pts not in seen:
+                seen.add(frame.pts)
+                frames.append(frame.to_image())
+        return frames
+
+
+def compute(filename, is_still, count=FRAMES, timeout=TIMEOUT):
+    """Return the signature of a file as a list of packed hashes, or None
+    if it has none: if it is a still that is not animated, or it cannot
+    be decoded within TIMEOUT seconds."""
+    import imagehash
+    errors = (Timeout, OSError, ValueError, EOFError)
+    if not is_still:
+        try:
+            import av
+        except ImportError:
+            return None
+        errors += (av.error.FFmpegError, IndexError)
+    try:
+        with deadline(timeout):
+            if is_still:
+                frames = animation_frames(filename, count)
+            else:
+                frames = video_frames(filename, count, timeout)
+            if not frames:
+                return None
+            return [tonk(imagehash.phash(frame)) for frame in frames]
+    except errors:
+        return None
+
+
+def _compute(args):
+    id, filename, is_still, timeout = args
+    return compute(filename, is_still, timeout=timeout)
+
+
+def _kill(pool):
+    """Shut down POOL without waiting for its workers, which may be stuck
+    in C code."""
+    for process in list((pool._processes or {}).values()):
+        process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def supervise(tasks, processes=None, timeout=TIMEOUT):
+    """Compute the signatures of TASKS of (id, filename, is_still,
+    timeout) in a process pool, and yield (task, signature) as they
+    finish. No more tasks are submitted than there are workers, so each
+    one is running from when it is submitted. A task that has not
+    finished GRACE seconds after TIMEOUT gets no signature, and the pool
+    is killed. So do the tasks in progress when a worker dies. The other
+    tasks in progress are then started again in a new pool."""
+    processes = processes or os.cpu_count() or 1
+    queue = deque(tasks)
+    while queue:
+        pool = ProcessPoolExecutor(max_workers=processes)
+        running, dead = {}, False
+        try:
+            while queue or running:
+                while queue and len(running) < processes:
+                    task = queue.popleft()
+                    end = time.monotonic() + timeout + GRACE if timeout else None
+                    running[pool.submit(_compute, task)] = task, end
+                ends = [end for _, end in running.values() if end is not None]
+                left = max(0, min(ends) - time.monotonic()) if ends else None
+                done, _ = wait(running, timeout=left, return_when=FIRST_COMPLETED)
+                now = time.monotonic()
+                for future, (task, end) in list(running.items()):
+                    if future in done:
+                        error = future.exception()
+                        dead = dead or isinstance(error, BrokenProcessPool)
+                    elif end is not None and end <= now:
+                        error, dead = Timeout(), True
+                    else:
+                        continue
+                    del running[future]
+                    yield task, None if error else future.result()
+                if dead:
+                    queue.extendleft(task for task, _ in running.values())
+                    break
+        finally:
+            if dead or running:
+                _kill(pool)
+            else:
+                pool.shutdown()
+
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def combine(hashes):
+    """Return the bitwise majority of a list of packed hashes."""
+    bits = np.array([untonk(h) for h in hashes])
+    majority = bits.sum(axis=0) * 2 > len(hashes)
+    return int(np.packbits(majority).view('>i8')[0])
+
+
+def distance(a, b):
+    """Return the mean distance from each frame of signature A to the
+    closest frame of signature B."""
+    return sum(min(hash_distance(x, y) for y in b) for x in a) / len(a)
+
+
+def matches(a, b, threshold):
+    """Whether signatures A and B are within THRESHOLD of each other in
+    either direction, so that a clip matches the video it was cut from.
+    A missing signature rules nothing out."""
+    if not a or not b:
+        return True
+    return min(distance(a, b), distance(b, a)) <= threshold
+
+
+def pack(hashes):
+    return np.array(hashes, dtype='<i8').tobytes()
+
+
+def unpack(data):
+    return np.frombuffer(data, dtype='<i8').tolist()
+
+
+class Signatures:
+    """The signatures of pictures, keyed by picture id, and the files that
+    failed to get one, with their mtimes. Rows are dropped with their
+    pictures by a trigger."""
+
+    def __init__(self, db, metadata):
+        self.db = db
+        self.table = Table(
+            'signatures', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('frames', LargeBinary, nullable=False),
+        )
+        self.failures = Table(
+            'signature_failures', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('mtime', Integer, nullable=False),
+        )
+
+    @property
+    def session(self):
+        return self.db.session
+
+    def install(self):
+        wanted = {'signatures_delete': (
+            'CREATE TRIGGER signatures_delete AFTER DELETE ON pictures BEGIN '
+            'DELETE FROM signatures WHERE id = OLD.id; '
+            'DELETE FROM signature_failures WHERE id = OLD.id; END'
+        )}
+        if triggers.install(self.session, wanted):
+            self.session.commit()
+
+    def set(self, id, hashes):
+        self.session.execute(self.table.delete().where(self.table.c.id == id))
+        self.session.execute(self.table.insert(), [{'id': id, 'frames': pack(hashes)}])
+
+    def fail(self, id, filename):
+        """Record that the file of picture ID got no signature."""
+        mtime = _mtime(filename)
+        self.session.execute(self.failures.delete().where(self.failures.c.id == id))
+        if mtime is not None:
+            self.session.execute(self.failures.insert(), [{'id': id, 'mtime': mtime}])
+
+    def get(self, id):
+        """Return the signature of picture ID, or None."""
+        data = self.session.execute(select([self.table.c.frames]).where(self.table.c.id == id)).scalar()
+        return None if data is None else unpack(data)
+
+    def get_many(self, ids):
+        """Return a dictionary mapping those of IDS that have a signature
+        to their signatures."""
+        ids, found = list(ids), {}
+        for start in range(0, len(ids), 500):
+            query = select([self.table.c.id, self.table.c.frames]).where(self.table.c.id.in_(ids[start:start+500]))
+            found.update((id, unpack(data)) for id, data in self.session.execute(query))
+        return found
+
+    def near(self, frames, ids, threshold):
+        """Return those of IDS whose signatures do not rule out a match
+        with the signature FRAMES within THRESHOLD."""
+        known = self.get_many(ids)
+        return [id for id in ids if matches(frames, known.get(id), threshold)]
+
+    def confirm(self, pairs, threshold):
+        """Return the PAIRS of ids whose signatures do not rule out a
+        match within THRESHOLD."""
+        known = self.get_many({id for pair in pairs for id in pair})
+        return [(i, j) for i, j in pairs if matches(known.get(i), known.get(j), threshold)]
+
+    def missing(self):
+        """Yield (id, filename, is_still) for all videos and animated
+        images without a signature, except those whose files failed to
+        get one and have not changed since. Animations are recognized by
+        probing the files, which finds animated PNGs by their acTL
+        chunk."""
+        known = {id for id, in self.session.execute(select([self.table.c.id]))}
+        failed = dict(self.session.execute(select([self.failures.c.id, self.failures.c.mtime])).fetchall())
+        for id, filename, is_still in self.db.file_rows():
+            if id in known:
+                continue
+            if id in failed and failed[id] == _mtime(filename):
+                continue
+            if not is_still:
+                yield id, filename, is_still
+            elif filename.rsplit('.', 1)[-1] in ANIMATABLE:
+                info = probe(filename)
+                if info is not None and info.animated:
+                    yield id, filename, is_still
+
+    def generate(self, processes=None, timeout=TIMEOUT, batch=100, retry=False):
+        """Compute the missing signatures in parallel, and update the
+        hashes of the pictures they belong to. With RETRY, files that
+        failed before are tried again even if they have not changed.
+        Returns the number of signatures made."""
+        if retry:
+            self.session.execute(self.failures.delete())
+        todo = [(id, filename, is_still, timeout) for id, filename, is_still in self.missing()]
+        made = 0
+        results = supervise(todo, processes, timeout)
+        for n, ((id, filename, _, _), hashes) in enumerate(
+            tqdm(results, total=len(todo), desc='Signatures', unit='file'), 1,
+        ):
+            if not hashes:
+                self.fail(id, filename)
+            else:
+                pic = self.db.pic_by_id(id)
+                pic.hash = combine(hashes)
+                self.db.hash_index.add(pic)
+                self.set(id, hashes)
+                made += 1
+            if n % batch == 0:
+                self.session.commit()
+        self.session.commit()
+        return made
@@ -0,0 +1,99 @@
+"""Precomputed analysis of files in the staging directory."""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import os.path as path
+
+from tqdm import tqdm
+
+from butter import signature
+from butter.hamming import tonk
+from butter.probe import probe
+
+
+StagedFile = namedtuple('StagedFile', [
+    'filename', 'size', 'mtime', 'extension', 'is_still', 'animated', 'hash', 'width', 'height',
+    'signature',
+])
+
+
+def analyse(filename):
+    """Compute file type, perceptual hash and dimensions of a file, and
+    the signature of a video or animated image. Runs in worker
+    processes, so a file that cannot be decoded just gets no hash."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    info = probe(filename)
+    if info is None:
+        extension, is_still, animated, width, height = None, True, False, None, None
+    else:
+        extension, is_still, animated, width, height = info[1:]
+    import imagehash
+    from PIL import Image
+
+    hash = None
+    try:
+        with Image.open(filename) as img:
+            width, height = width or img.width, height or img.height
+            hash = tonk(imagehash.phash(img))
+    except Exception:
+        pass
+    frames = None
+    if not is_still or animated:
+        try:
+            frames = signature.compute(filename, is_still)
+        except Exception:
+            frames = None
+        if frames:
+            hash = signature.combine(frames)
+    return StagedFile(
+        filename, st.st_size, st.st_mtime_ns, extension, is_still, animated, hash, width, height, frames,
+    )
+
+
+class StagingCache:
+    """Analysis results keyed by (path, size, mtime), persisted as JSON."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename, 'r') as f:
+                self.entries = {fn: StagedFile(fn, *data) for fn, data in json.load(f).items()}
+        except (FileNotFoundError, ValueError, TypeError):
+            self.entries = {}
+
+    def save(self):
+        data = {fn: list(entry[1:]) for fn, entry in self.entries.items() if path.exists(fn)}
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.filename)
+
+    def get(self, filename):
+        entry = self.entries.get(filename)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        if (entry.size, entry.mtime) != (st.st_size, st.st_mtime_ns):
+            return None
+        return entry
+
+    def analyse(self, filenames, processes=None):
+        """Return a dictionary mapping each filename to its analysis,
+        computing missing entries in a process pool."""
+        missing = [fn for fn in filenames if self.get(fn) is None]
+        if missing:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                results = pool.map(analyse, missing, chunksize=8)
+                for entry in tqdm(results, total=len(missing), desc='Hashing', unit='file'):
+                    if entry is not None:
+                        self.entries[entry.filename] = entry
+            self.save()
+        return {fn: self.get(fn) for fn in filenames}
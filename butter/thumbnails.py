@@ -0,0 +1,102 @@
+"""Thumbnails of pictures, stored under the database directory.
+
+Thumbnails are small JPEG files named after the id of the picture and
+the mtime of its file, so a thumbnail is never shown for a file that
+has changed since it was made. Videos get a thumbnail of their first
+frame if PyAV is installed.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import os
+import os.path as path
+
+from tqdm import tqdm
+
+
+SIZE = 256
+
+
+def poster(filename):
+    try:
+        import av
+    except ImportError:
+        return None
+    try:
+        with av.open(filename) as container:
+            for frame in container.decode(video=0):
+                return frame.to_image()
+    except (av.error.FFmpegError, IndexError):
+        return None
+
+
+def make(source, target, is_still, size=SIZE):
+    """Write a thumbnail of SOURCE to TARGET. Returns whether it could
+    be made; any failure to decode SOURCE counts as not."""
+    from PIL import Image
+    try:
+        if is_still:
+            with Image.open(source) as original:
+                original.draft('RGB', (size, size))
+                image = original.convert('RGB')
+        else:
+            image = poster(source)
+    except Exception:
+        return False
+    if image is None:
+        return False
+    image.thumbnail((size, size))
+    image.save(target + '.tmp', 'JPEG', quality=85)
+    os.replace(target + '.tmp', target)
+    return True
+
+
+def _make(args):
+    return make(*args)
+
+
+class ThumbnailStore:
+
+    def __init__(self, db):
+        self.root = db.local_thumbnails
+
+    def filename(self, id, source):
+        """Return the thumbnail filename of picture ID with file SOURCE,
+        or None if SOURCE does not exist."""
+        try:
+            mtime = os.stat(source).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        return path.join(self.root, f'{id:0>8}-{mtime}.jpg')
+
+    def get(self, id, source, is_still):
+        """Return the thumbnail filename of a picture, making it if it
+        does not exist. Returns None if no thumbnail can be made."""
+        target = self.filename(id, source)
+        if target is None:
+            return None
+        if path.exists(target):
+            return target
+        self.invalidate(id)
+        os.makedirs(self.root, exist_ok=True)
+        return target if make(source, target, is_still) else None
+
+    def invalidate(self, id):
+        for fn in glob(path.join(self.root, f'{id:0>8}-*.jpg')):
+            os.unlink(fn)
+
+    def generate(self, rows, processes=None):
+        """Make the missing thumbnails for ROWS of (id, filename,
+        is_still) in parallel. Returns the number of thumbnails made."""
+        os.makedirs(self.root, exist_ok=True)
+        todo = []
+        for id, source, is_still in rows:
+            target = self.filename(id, source)
+            if target is not None and not path.exists(target):
+                self.invalidate(id)
+                todo.append((source, target, is_still))
+        if not todo:
+            return 0
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = pool.map(_make, todo, chunksize=16)
+            return sum(tqdm(results, total=len(todo), desc='Thumbnails', leave=False))
@@ -0,0 +1,118 @@
+"""Timing spans around the phases of butter.
+
+A phase is timed by wrapping it in a span, or by decorating a function
+with traced():
+
+    with trace.span('sync.pull'):
+        ...
+
+Tracing is off unless enabled. A disabled span is a shared object whose
+enter and exit do nothing, so spans can stay in hot paths. While
+tracing is on, every finished span is recorded with its thread, and the
+records can be written as Chrome trace events, to be opened in
+chrome://tracing or Perfetto, or summarised in a table.
+"""
+
+import functools
+import json
+import os
+import threading
+from time import perf_counter_ns
+
+
+_events = None
+
+
+class NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL = NullSpan()
+
+
+class Span:
+
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = perf_counter_ns()
+        if _events is not None:
+            _events.append((self.name, self.start, end - self.start, threading.get_ident(), self.args))
+        return False
+
+
+def span(name, **args):
+    """Return a context manager timing the phase NAME, with ARGS as
+    extra information for the trace."""
+    if _events is None:
+        return NULL
+    return Span(name, args)
+
+
+def traced(name=None):
+    """Decorator timing every call to a function."""
+    def decorator(func):
+        label = name or func.__qualname__
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            if _events is None:
+                return func(*args, **kwargs)
+            with Span(label, {}):
+                return func(*args, **kwargs)
+        return inner
+    return decorator
+
+
+def enable():
+    global _events
+    _events = []
+
+
+def disable():
+    """Stop tracing and return the recorded spans."""
+    global _events
+    events, _events = _events or [], None
+    return events
+
+
+def write_chrome(events, filename):
+    """Write EVENTS in the Chrome trace event format."""
+    pid = os.getpid()
+    data = [
+        {
+            'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+            'ts': start / 1000, 'dur': duration / 1000,
+            'args': {key: str(value) for key, value in args.items()},
+        }
+        for name, start, duration, tid, args in events
+    ]
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': data, 'displayTimeUnit': 'ms'}, f)
+
+
+def summary(events):
+    """Print the number of calls and the total, mean and maximal time of
+    each kind of span, slowest first."""
+    totals = {}
+    for name, _, duration, _, _ in events:
+        count, total, longest = totals.get(name, (0, 0, 0))
+        totals[name] = (count + 1, total + duration, max(longest, duration))
+    if not totals:
+        return
+    width = max(len(name) for name in totals)
+    print(f'{"span":<{width}}  {"calls":>7}  {"total ms":>10}  {"mean ms":>9}  {"max ms":>9}')
+    for name, (count, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        print(f'{name:<{width}}  {count:>7}  {total / 1e6:>10.2f}  {total / count / 1e6:>9.3f}  {longest / 1e6:>9.3f}')
@@ -0,0 +1,281 @@
+"""Transports for synchronizing a database with its remote.
+
+The rsync transport works with anything rsync can reach. The local
+transport handles remotes that are plain or mounted directories
+natively: it copies many files concurrently, resumes interrupted
+copies, verifies sizes and checksums, and reports per-file progress.
+Files are considered unchanged if their sizes agree and their mtimes
+are within a tolerance window, since mounted filesystems such as SMB
+or FAT store mtimes with a coarse resolution.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import os
+import os.path as path
+import re
+import shutil
+from subprocess import run, CalledProcessError, PIPE
+import tempfile
+from threading import Lock
+
+from tqdm import tqdm
+
+from butter import trace
+
+
+Progress = namedtuple('Progress', ['kind', 'filename', 'size'])
+
+CHUNK = 1 << 20
+
+MTIME_WINDOW = 2
+
+
+class TransportError(Exception):
+    pass
+
+
+def rsync_copy(source, destination):
+    """Copy SOURCE to DESTINATION with rsync, without deleting anything.
+    Returns the number of files created."""
+    try:
+        ret = run(['rsync', '-a', '--info=stats2', source, destination], check=True, stdout=PIPE)
+    except CalledProcessError as e:
+        raise TransportError(str(e)) from e
+    found = re.search(r'Number of created files: (?P<n>[\d,]+)', ret.stdout.decode())
+    return int(found.group('n').replace(',', '')) if found else 0
+
+
+def rsync_exists(target):
+    ret = run(['rsync', '--list-only', target], stdout=PIPE, stderr=PIPE)
+    if ret.returncode == 0:
+        return True
+    stderr = ret.stderr.decode()
+    if 'No such file or directory' in stderr:
+        return False
+    raise TransportError(stderr.strip())
+
+
+def rsync_remove(root, names):
+    """Delete the files NAMES directly in the directory ROOT, by syncing
+    an empty directory to it with only those names included."""
+    if not names:
+        return
+    with tempfile.TemporaryDirectory() as empty, tempfile.NamedTemporaryFile('w') as patterns:
+        patterns.write(''.join(f'/{name}\n' for name in names))
+        patterns.flush()
+        try:
+            run(['rsync', '-r', '--delete', f'--include-from={patterns.name}', '--exclude=*',
+                 path.join(empty, ''), root], check=True, stdout=PIPE)
+        except CalledProcessError as e:
+            raise TransportError(str(e)) from e
+
+
+class RsyncTransport:
+
+    @trace.traced('rsync.copy')
+    def copy(self, source, destination):
+        return rsync_copy(source, destination)
+
+    def exists(self, target):
+        return rsync_exists(target)
+
+    @trace.traced('rsync.remove')
+    def remove(self, root, names):
+        rsync_remove(root, names)
+
+
+def checksum(filename):
+    digest = hashlib.blake2b()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def prefix_digest(f, length):
+    """Return a blake2b hash object of the first LENGTH bytes of the open
+    file F, which is left at that position."""
+    digest = hashlib.blake2b()
+    f.seek(0)
+    while length > 0:
+        chunk = f.read(min(CHUNK, length))
+        if not chunk:
+            break
+        digest.update(chunk)
+        length -= len(chunk)
+    return digest
+
+
+def listing(root):
+    """Return a dictionary mapping relative filenames under ROOT to
+    (size, mtime) pairs."""
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for fn in filenames:
+            if fn.endswith('.part'):
+                continue
+            full = path.join(dirpath, fn)
+            st = os.stat(full)
+            files[path.relpath(full, root)] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+class LocalTransport:
+
+    def __init__(self, jobs=8, verify=True, mtime_window=MTIME_WINDOW, progress=None):
+        self.jobs = jobs
+        self.verify = verify
+        self.window = int(mtime_window * 1e9)
+        self.progress = progress or (lambda event: None)
+
+    def unchanged(self, theirs, ours):
+        """Whether two (size, mtime) pairs describe the same file."""
+        return ours is not None and ours[0] == theirs[0] and abs(ours[1] - theirs[1]) <= self.window
+
+    @trace.traced('transport.copy')
+    def copy(self, source, destination):
+        """Copy a file or a directory tree, without deleting anything.
+        Returns the number of files created."""
+        if not path.exists(source):
+            raise TransportError(f'No such file or directory: {source}')
+        if path.isdir(source):
+            return self.transfer(source, destination)
+        if destination.endswith(os.sep) or path.isdir(destination):
+            destination = path.join(destination, path.basename(source))
+        new = not path.exists(destination)
+        self.progress(Progress('plan', source, os.stat(source).st_size))
+        try:
+            self.copy_file(source, destination)
+        finally:
+            self.progress(Progress('finish', source, 0))
+        return int(new)
+
+    def exists(self, target):
+        return path.exists(target)
+
+    @trace.traced('transport.remove')
+    def remove(self, root, names):
+        """Delete the files NAMES in the directory ROOT, if they exist."""
+        for name in names:
+            try:
+                os.unlink(path.join(root, name))
+            except FileNotFoundError:
+                pass
+
+    def transfer(self, source, destination):
+        os.makedirs(destination, exist_ok=True)
+        theirs = listing(source)
+        ours = listing(destination)
+        todo = [fn for fn, stat in theirs.items() if not self.unchanged(stat, ours.get(fn))]
+        nnew = sum(1 for fn in todo if fn not in ours)
+        self.progress(Progress('plan', source, sum(theirs[fn][0] for fn in todo)))
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = {
+                pool.submit(self.copy_file, path.join(source, fn), path.join(destination, fn)): fn
+                for fn in todo
+            }
+            errors = []
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except (OSError, TransportError) as e:
+                    errors.append(f'{futures[future]}: {e}')
+                    self.progress(Progress('error', futures[future], 0))
+        self.progress(Progress('finish', source, 0))
+        if errors:
+            raise TransportError('\n'.join(errors))
+
+        return nnew
+
+    def copy_file(self, source, destination):
+        """Copy a single file through a .part file, resuming a previous
+        partial copy if it agrees with the start of the source. With
+        verification, the copy is read back and compared to the hash of
+        the source."""
+        os.makedirs(path.dirname(destination) or '.', exist_ok=True)
+        size = os.stat(source).st_size
+        part = destination + '.part'
+        offset = path.getsize(part) if path.exists(part) else 0
+        if offset > size:
+            offset = 0
+
+        self.progress(Progress('start', source, size))
+        with open(source, 'rb') as src, open(part, 'r+b' if offset else 'wb') as dst:
+            digest = hashlib.blake2b()
+            if offset:
+                digest = prefix_digest(src, offset)
+                if prefix_digest(dst, offset).digest() != digest.digest():
+                    # Left over from an older version of the source
+                    offset, digest = 0, hashlib.blake2b()
+                    dst.truncate(0)
+                else:
+                    self.progress(Progress('data', source, offset))
+            src.seek(offset)
+            dst.seek(offset)
+            for chunk in iter(lambda: src.read(CHUNK), b''):
+                dst.write(chunk)
+                digest.update(chunk)
+                self.progress(Progress('data', source, len(chunk)))
+
+        if path.getsize(part) != size:
+            os.unlink(part)
+            raise TransportError(f'Size mismatch copying {source}')
+        if self.verify and checksum(part) != digest.digest():
+            os.unlink(part)
+            raise TransportError(f'Checksum mismatch copying {source}')
+        shutil.copystat(source, part)
+        os.replace(part, destination)
+        self.progress(Progress('done', source, size))
+
+
+class ProgressBar:
+    """Render transport progress events as a byte-counting progress bar,
+    whose total is planned before the first file starts."""
+
+    def __init__(self):
+        self.bar = None
+        self.lock = Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            self.update(event)
+
+    def update(self, event):
+        if self.bar is None:
+            if event.kind == 'finish' or event.kind == 'plan' and not event.size:
+                return
+            self.bar = tqdm(unit='B', unit_scale=True, desc='Transferring', leave=False)
+        if event.kind == 'plan':
+            self.bar.total = event.size
+            self.bar.refresh()
+        elif event.kind == 'data':
+            self.bar.update(event.size)
+        elif event.kind == 'error':
+            self.bar.write(f'Failed: {event.filename}')
+        elif event.kind == 'finish':
+            self.bar.close()
+            self.bar = None
+
+
+def is_local(remote):
+    return path.isdir(remote) and not re.match(r'^[^/]*:', remote)
+
+
+def make_transport(remote, cfg):
+    """Return the transport configured for REMOTE. The 'transport' key of
+    the sync configuration may be 'rsync', 'local' or 'auto' (the
+    default), which chooses the local transport for directories. The
+    local transport also reads 'jobs', 'verify' and 'mtime_window', in
+    seconds."""
+    kind = cfg.get('transport', 'auto')
+    if kind == 'auto':
+        kind = 'local' if is_local(remote) else 'rsync'
+    if kind == 'local':
+        return LocalTransport(
+            jobs=cfg.get('jobs', 8), verify=cfg.get('verify', True),
+            mtime_window=cfg.get('mtime_window', MTIME_WINDOW), progress=ProgressBar(),
+        )
+    return RsyncTransport()
@@ -0,0 +1,31 @@
+"""Triggers kept in step with the SQL that creates them.
+
+Loading a database only runs DDL for the triggers whose SQL differs
+from what is stored in sqlite_master, like the automatic indexes of the
+advisor, so that the triggers are not rebuilt on every load.
+"""
+
+from sqlalchemy.sql import text
+
+
+def existing(session):
+    """Map the names of all triggers to their SQL."""
+    rows = session.execute(text("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'"))
+    return dict(rows.fetchall())
+
+
+def install(session, wanted):
+    """Create or replace the triggers in WANTED, a dictionary mapping
+    names to CREATE TRIGGER statements, or to None for triggers that
+    should not exist. Returns whether anything changed."""
+    current = existing(session)
+    changed = False
+    for name, sql in wanted.items():
+        if current.get(name) == sql:
+            continue
+        if name in current:
+            session.execute(text(f'DROP TRIGGER {name}'))
+        if sql is not None:
+            session.execute(text(sql))
+        changed = True
+    return changed
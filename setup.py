@@ -25,6 +25,5 @@ setup(
         'selenium',
         'tqdm',
         'xdg',
-        'yapsy',
     ],
 )
@@ -0,0 +1,66 @@
+import os
+import tempfile
+
+# The configuration paths are fixed when butter.config is imported
+_home = tempfile.mkdtemp(prefix='butter-tests-')
+os.environ['XDG_CONFIG_HOME'] = os.path.join(_home, 'config')
+os.environ['XDG_CACHE_HOME'] = os.path.join(_home, 'cache')
+
+import pytest
+import yaml
+
+
+FIELDS = [
+    {'key': 'color', 'type': 'bool', 'aliases': ['c']},
+    {'key': 'score', 'type': 'int'},
+]
+
+PICKERS = [{'colored': ['color == True']}]
+
+
+def make_database(root, remote=None, fields=FIELDS, pickers=PICKERS):
+    """Create an empty database directory under ROOT and return a loader
+    for it."""
+    from butter.db import DatabaseLoader
+    os.makedirs(os.path.join(root, 'contents'))
+    os.makedirs(os.path.join(root, 'staging'))
+    cfg = {'fields': fields, 'pickers': pickers}
+    if remote is not None:
+        cfg['sync'] = {'remote': os.path.join(str(remote), ''), 'sync_config': False}
+    with open(os.path.join(root, 'config.yaml'), 'w') as f:
+        yaml.safe_dump(cfg, f)
+    return DatabaseLoader(str(root))
+
+
+@pytest.fixture
+def loader(tmp_path):
+    loader = make_database(tmp_path / 'db')
+    yield loader
+    loader.close()
+
+
+def add_picture(db, hash, extension='png', is_still=True, **fields):
+    """Insert a picture with an empty file, and return it."""
+    from datetime import datetime
+    pic = db.Picture()
+    pic.extension, pic.hash, pic.is_still = extension, hash, is_still
+    pic.added = pic.updated = datetime.now()
+    for key, value in fields.items():
+        setattr(pic, key, value)
+    with db.files.transaction():
+        db.session.add(pic)
+        db.session.flush()
+        db.hash_index.add(pic)
+        open(pic.filename, 'wb').close()
+    return pic
+
+
+def make_image(filename, seed, size=64):
+    """Write a PNG of random blocks, so that different seeds give
+    pictures far apart in perceptual hash."""
+    import numpy as np
+    from PIL import Image
+    blocks = np.random.RandomState(seed).randint(0, 256, (8, 8), dtype=np.uint8)
+    pixels = np.kron(blocks, np.ones((size // 8, size // 8), dtype=np.uint8))
+    Image.fromarray(pixels).save(str(filename))
+    return str(filename)
@@ -0,0 +1,30 @@
+import builtins
+
+from butter import bench
+from conftest import make_database
+
+
+def test_generated_remote_can_be_cloned(tmp_path):
+    bench.generate(str(tmp_path), 50, nfields=2, staged=0)
+    clone = make_database(tmp_path / 'clone', remote=tmp_path / 'remote',
+                          fields=bench.fields(2), pickers=[])
+    try:
+        clone.sync(stage=False)
+        with clone.database() as db:
+            assert db.query().count() == 50
+        clone.sync(stage=False)
+        with clone.database() as db:
+            assert db.query().count() == 50
+    finally:
+        clone.close()
+    assert len(list((tmp_path / 'remote' / 'contents').iterdir())) == 50
+
+
+def test_run_is_not_interactive(tmp_path, monkeypatch):
+    def refuse(*args):
+        raise AssertionError('asked for input')
+    monkeypatch.setattr(builtins, 'input', refuse)
+    monkeypatch.setattr(bench, 'startup', lambda root: (0.0, []))
+    bench.generate(str(tmp_path), 50, staged=2)
+    results, problems = bench.run(str(tmp_path))
+    assert 'similar' in results and not problems
@@ -0,0 +1,70 @@
+import pytest
+
+from butter import dedupe
+from conftest import add_picture
+
+
+def test_union_find_groups():
+    clusters = dedupe.UnionFind()
+    for a, b in [(5, 3), (3, 9), (1, 2), (7, 7)]:
+        clusters.union(a, b)
+    assert clusters.groups() == [[1, 2], [3, 5, 9]]
+
+
+def test_checkpoint_is_kept_per_threshold(tmp_path):
+    filename = str(tmp_path / 'dedupe.json')
+    checkpoint = dedupe.Checkpoint(filename, 9)
+    checkpoint.reset('key')
+    checkpoint.next, checkpoint.pairs = 4, [(1, 2)]
+    checkpoint.save()
+    again = dedupe.Checkpoint(filename, 9)
+    assert (again.key, again.next, again.pairs) == ('key', 4, [[1, 2]])
+    other = dedupe.Checkpoint(filename, 5)
+    assert (other.key, other.next, other.pairs) == (None, 0, [])
+
+
+def populate(db):
+    # Three clusters of near-duplicates, spread over several blocks
+    ids = []
+    for base in (0, 0x0f0f0f0f0f0f0f0f, 0x3333333333333333):
+        for bit in (0, 1, 40):
+            ids.append(add_picture(db, base ^ (1 << bit)).id)
+    db.session.commit()
+    return ids
+
+
+def test_interrupted_search_resumes(loader, tmp_path, monkeypatch):
+    with loader.database() as db:
+        populate(db)
+        expected = dedupe.search(db, dedupe.Checkpoint(str(tmp_path / 'full.json'), 2), chunk=2)
+        assert [len(c) for c in expected] == [3, 3, 3]
+
+        checkpoint = dedupe.Checkpoint(str(tmp_path / 'partial.json'), 2)
+        save = checkpoint.save
+        calls = []
+
+        def interrupted():
+            save()
+            calls.append(checkpoint.next)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+
+        monkeypatch.setattr(checkpoint, 'save', interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            dedupe.search(db, checkpoint, chunk=2)
+
+        resumed = dedupe.Checkpoint(str(tmp_path / 'partial.json'), 2)
+        assert resumed.next == 4 and not resumed.done
+        assert dedupe.search(db, resumed, chunk=2) == expected
+
+
+def test_changed_hashes_restart_the_search(loader, tmp_path):
+    with loader.database() as db:
+        ids = populate(db)
+        checkpoint = dedupe.Checkpoint(str(tmp_path / 'dedupe.json'), 2)
+        checkpoint.reset(dedupe.fingerprint(dedupe.collection(db)))
+        checkpoint.next, checkpoint.pairs = 4, [(ids[0], ids[-1])]
+        db.delete(db.pic_by_id(ids[1]))
+        clusters = dedupe.search(db, checkpoint, chunk=2)
+        assert [ids[0], ids[-1]] not in clusters
+        assert [len(c) for c in clusters] == [2, 3, 3]
@@ -0,0 +1,34 @@
+from sqlalchemy.sql import text
+
+from conftest import add_picture
+
+
+def test_new_database_uses_wal(loader):
+    with loader.database() as db:
+        assert db.session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert db.session.execute(text('PRAGMA synchronous')).scalar() == 1
+
+
+def test_deferred_edits_are_flushed(loader):
+    with loader.database() as db:
+        pic = add_picture(db, 1)
+        db.session.commit()
+        db.edits.deferred = True
+        db.edits.set(pic, score=3)
+        assert len(db.edits) == 1
+        db.edits.flush()
+        assert len(db.edits) == 0
+        assert db.session.execute(text('SELECT score FROM pictures')).scalar() == 3
+
+
+def test_unchanged_session_is_not_committed(loader):
+    with loader.database() as db:
+        add_picture(db, 1)
+    generation = db.generation
+    with loader.database() as db:
+        db.pickers['colored'].count()
+    assert db.generation == generation
+    with loader.database() as db:
+        db.session.execute(text('UPDATE pictures SET score = 2'))
+    with loader.database() as db:
+        assert db.session.execute(text('SELECT score FROM pictures')).scalar() == 2
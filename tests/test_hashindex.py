@@ -0,0 +1,26 @@
+from sqlalchemy.sql import text
+
+from conftest import add_picture
+
+
+def test_changed_hash_is_detected(loader):
+    with loader.database() as db:
+        pic = add_picture(db, 0x0f0f)
+        other = add_picture(db, -1)
+        db.session.execute(text('UPDATE pictures SET hash = 12345 WHERE id = :id'), {'id': pic.id})
+        db.session.commit()
+        index = db.hash_index
+        assert index.stale()
+        index.sidecar.invalidate()
+        index.checked = False
+        index.ensure()
+        assert not index.stale()
+        assert [id for _, id in index.candidates(12345, 0).within(12345, 0)] == [pic.id]
+        assert [id for _, id in index.candidates(-1, 0).within(-1, 0)] == [other.id]
+
+
+def test_deleted_row_is_detected(loader):
+    with loader.database() as db:
+        pic = add_picture(db, 1)
+        db.session.execute(text('DELETE FROM pictures WHERE id = :id'), {'id': pic.id})
+        assert db.hash_index.stale()
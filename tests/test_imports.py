@@ -0,0 +1,40 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+HEAVY = ['PyQt5', 'PIL', 'numpy', 'sqlalchemy', 'imagehash', 'av']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loaded(module):
+    """Import MODULE in a fresh interpreter and return the top-level
+    packages it loaded."""
+    code = f'import sys, json, {module}; print(json.dumps(sorted({{m.split(".")[0] for m in sys.modules}})))'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    output = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return set(json.loads(output))
+
+
+def test_cli_imports_are_lazy():
+    assert not loaded('butter.__main__') & set(HEAVY)
+
+
+def test_list_starts_quickly(tmp_path):
+    """Run 'butter list' as a user would. The time bound is generous, to
+    catch a heavy import creeping back in rather than to benchmark."""
+    os.makedirs(str(tmp_path / 'butter' / 'databases' / 'pics'))
+    env = dict(os.environ, XDG_CONFIG_HOME=str(tmp_path),
+               PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    start = time.monotonic()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'butter', 'list'], env=env, check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.monotonic() - start
+    assert result.stdout.split() == ['pics']
+    imported = {line.split('|')[-1].strip() for line in result.stderr.splitlines()
+                if line.startswith('import time:')}
+    assert not imported & set(HEAVY)
+    assert elapsed < 5
@@ -0,0 +1,174 @@
+import os
+
+import pytest
+
+from conftest import make_database, make_image
+
+
+def import_dir(loader, directory, **kwargs):
+    from butter import ingest
+    with loader.database() as db:
+        importer = ingest.Importer(db, processes=1, **kwargs)
+        return importer.run(ingest.find_files(str(directory)))
+
+
+def test_import_then_sync_keeps_files(tmp_path):
+    remote = tmp_path / 'remote'
+    remote.mkdir()
+    loader = make_database(tmp_path / 'db', remote=remote)
+    incoming = tmp_path / 'incoming'
+    incoming.mkdir()
+    for seed in range(3):
+        make_image(incoming / f'{seed}.png', seed)
+    try:
+        assert import_dir(loader, incoming)['imported'] == 3
+        loader.sync(stage=False)
+        contents = os.listdir(os.path.join(loader.path, 'contents'))
+        assert len(contents) == 3
+        assert sorted(os.listdir(str(remote / 'contents'))) == sorted(contents)
+        loader.sync(stage=False)
+        assert len(os.listdir(os.path.join(loader.path, 'contents'))) == 3
+        with loader.database() as db:
+            assert db.query().count() == 3
+    finally:
+        loader.close()
+
+    clone = make_database(tmp_path / 'clone', remote=remote)
+    try:
+        clone.sync(stage=False)
+        with clone.database() as db:
+            assert db.query().count() == 3
+        assert len(os.listdir(os.path.join(clone.path, 'contents'))) == 3
+    finally:
+        clone.close()
+
+
+def test_metadata_formats(tmp_path):
+    from butter import ingest
+    csv = tmp_path / 'meta.csv'
+    csv.write_text('filename,color,score\na/1.png,yes,3\n2.png,,\n')
+    jsonl = tmp_path / 'meta.jsonl'
+    jsonl.write_text('{"filename": "a/1.png", "color": true, "score": 3}\n\n{"filename": "2.png"}\n')
+    yml = tmp_path / 'meta.yaml'
+    yml.write_text('a/1.png: {color: true, score: 3}\n2.png:\n')
+    for filename in (csv, jsonl, yml):
+        metadata = ingest.read_metadata(str(filename))
+        assert sorted(metadata) == ['2.png', os.path.join('a', '1.png')]
+
+    (tmp_path / 'bad.jsonl').write_text('{"color": true}\n')
+    with pytest.raises(ingest.MetadataError):
+        ingest.read_metadata(str(tmp_path / 'bad.jsonl'))
+
+
+def test_fields_are_converted(loader):
+    from butter import ingest
+    with loader.database() as db:
+        fields = db.Picture.fields
+        assert ingest.resolve_fields(fields, {'c': 'yes', 'score': '3'}) == {'color': True, 'score': 3}
+        with pytest.raises(ingest.MetadataError):
+            ingest.resolve_fields(fields, {'color': 'maybe'})
+        with pytest.raises(ingest.MetadataError):
+            ingest.resolve_fields(fields, {'size': 1})
+
+
+def test_find_files_by_path_or_name(tmp_path):
+    from butter import ingest
+    (tmp_path / 'a').mkdir()
+    for name in ('a/1.png', 'a/2.png', '3.png'):
+        (tmp_path / name).write_bytes(b'')
+    metadata = {os.path.join('a', '1.png'): {'score': 1}, '2.png': {'score': 2}}
+    found = ingest.find_files(str(tmp_path), metadata)
+    assert [(os.path.relpath(fn, str(tmp_path)), values) for fn, values in found] == [
+        (os.path.join('a', '1.png'), {'score': 1}), (os.path.join('a', '2.png'), {'score': 2}),
+    ]
+
+
+@pytest.fixture
+def collection(loader, tmp_path):
+    """A database holding the picture of seed 0, and a directory with a
+    near-copy of it, a duplicate pair and a new picture."""
+    incoming = tmp_path / 'incoming'
+    incoming.mkdir()
+    make_image(incoming / 'existing.png', 0)
+    assert import_dir(loader, incoming)['imported'] == 1
+    make_image(incoming / 'a-collides.png', 0)
+    make_image(incoming / 'b-new.png', 1)
+    make_image(incoming / 'c-twin.png', 1)
+    make_image(incoming / 'd-other.png', 2)
+    with loader.database() as db:
+        existing = db.query().one().id
+    return incoming, existing
+
+
+def remaining(incoming):
+    return sorted(os.listdir(str(incoming)))
+
+
+def test_skip_policy(loader, collection):
+    incoming, existing = collection
+    counts = import_dir(loader, incoming, policy='skip')
+    assert (counts['imported'], counts['skipped']) == (2, 2)
+    assert remaining(incoming) == ['a-collides.png', 'c-twin.png']
+
+
+def test_delete_policy(loader, collection):
+    incoming, existing = collection
+    counts = import_dir(loader, incoming, policy='delete')
+    assert (counts['imported'], counts['deleted']) == (2, 2)
+    assert remaining(incoming) == []
+    with loader.database() as db:
+        assert db.query().count() == 3
+
+
+def test_replace_policy(loader, collection):
+    incoming, existing = collection
+    counts = import_dir(loader, incoming, policy='replace')
+    assert (counts['imported'], counts['replaced'], counts['skipped']) == (3, 1, 1)
+    assert remaining(incoming) == ['c-twin.png']
+    with loader.database() as db:
+        assert db.pic_by_id(existing) is None
+        assert db.query().count() == 3
+
+
+def test_add_policy(loader, collection):
+    incoming, existing = collection
+    counts = import_dir(loader, incoming, policy='add')
+    assert counts['imported'] == 4
+    with loader.database() as db:
+        assert db.query().count() == 5
+
+
+def test_dry_run_changes_nothing(loader, collection):
+    from butter import ingest
+    incoming, existing = collection
+    with loader.database() as db:
+        importer = ingest.Importer(db, policy='replace', processes=1)
+        counts = importer.run(ingest.find_files(str(incoming)), dry_run=True)
+        assert (counts['imported'], counts['replaced']) == (3, 1)
+        assert db.query().count() == 1
+    assert len(remaining(incoming)) == 4
+
+
+def test_undecodable_files_fail_alone(loader, tmp_path, monkeypatch):
+    from PIL import Image
+    from butter.staging import StagingCache
+    incoming = tmp_path / 'incoming'
+    incoming.mkdir()
+    make_image(incoming / 'a-bomb.png', 0, size=128)
+    make_image(incoming / 'b-fine.png', 1)
+    # Images over twice this many pixels raise DecompressionBombError
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 64 * 64)
+    counts = import_dir(loader, incoming)
+    assert (counts['imported'], counts['failed']) == (1, 1)
+    with loader.database() as db:
+        cache = StagingCache(db.staging_cache)
+        entries = cache.analyse([str(incoming / 'a-bomb.png')], processes=1)
+        assert entries[str(incoming / 'a-bomb.png')].hash is None
+
+
+def test_unmatched_metadata(tmp_path):
+    from butter import ingest
+    (tmp_path / '1.png').write_bytes(b'')
+    metadata = {'1.png': {}, os.path.join('a', '2.png'): {}, '3.png': {}}
+    found = ingest.find_files(str(tmp_path), metadata)
+    assert ingest.unmatched(str(tmp_path), metadata, found) == sorted([os.path.join('a', '2.png'), '3.png'])
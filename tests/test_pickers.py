@@ -0,0 +1,83 @@
+from conftest import add_picture
+
+
+def test_generation_follows_picture_writes(loader):
+    with loader.database() as db:
+        pic = add_picture(db, 1)
+        db.session.commit()
+        generation = db.generation
+        db.signatures.set(pic.id, [1, 2])
+        db.session.commit()
+        assert db.generation == generation
+        pic.score = 4
+        db.session.commit()
+        assert db.generation == generation + 1
+        pic.score = 5
+        db.session.flush()
+        db.session.rollback()
+        assert db.generation == generation + 2
+
+
+def test_filter_picker_skips_deleted(loader):
+    with loader.database() as db:
+        pics = [add_picture(db, i, color=True) for i in range(3)]
+        db.session.commit()
+        picker = db.pickers['colored']
+        assert picker.get() in pics
+        db.session.delete(pics[0])
+        db.session.delete(pics[1])
+        for _ in range(20):
+            assert picker.get() is pics[2]
+
+
+def test_filter_picker_survives_closed_sessions(loader):
+    with loader.database() as db:
+        add_picture(db, 1, color=True)
+    for _ in range(3):
+        with loader.database() as db:
+            pic = db.pickers['colored'].get()
+            assert pic in db.session
+            pic.score = 1
+    with loader.database() as db:
+        assert db.pickers['colored'].get().score == 1
+
+
+def test_membership_is_kept_between_loads(loader, monkeypatch):
+    from butter import triggers
+    with loader.database() as db:
+        add_picture(db, 1, color=True)
+    loader.unload()
+    install, changed = triggers.install, []
+    monkeypatch.setattr(triggers, 'install', lambda *args: changed.append(install(*args)) or changed[-1])
+    with loader.database() as db:
+        add_picture(db, 2, color=True)
+        assert db.pickers['colored'].count() == 2
+    assert changed and not any(changed)
+
+
+def test_optimize_leaves_config_alone(loader):
+    from butter import advisor
+    with open(loader.local_config, 'a') as f:
+        f.write('# hand-written\n')
+    with open(loader.local_config) as f:
+        before = f.read()
+    with loader.database() as db:
+        for hash in range(1, 50):
+            add_picture(db, hash, color=hash % 2 == 0, score=hash)
+        advisor.optimize(db)
+        specs = db.load_indexes()
+    with open(loader.local_config) as f:
+        assert f.read() == before
+    loader.unload()
+    with loader.database() as db:
+        assert db.load_indexes() == specs
+
+
+def test_file_rows_of_picker(loader):
+    with loader.database() as db:
+        for hash in range(1, 12):
+            add_picture(db, hash, color=hash % 3 == 0)
+        ids = db.pickers['colored'].ids().tolist()
+        rows = list(db.file_rows(reversed(ids), chunk=2))
+        assert [id for id, _, _ in rows] == sorted(ids) and len(ids) == 3
+        assert all(is_still and filename.endswith('.png') for _, filename, is_still in rows)
@@ -0,0 +1,85 @@
+from PIL import Image
+import pytest
+
+from butter.probe import probe
+from conftest import make_image
+
+
+def frames(seeds, size=(40, 30)):
+    return [Image.new('RGB', size, (seed * 60, 255 - seed * 60, 0)) for seed in seeds]
+
+
+def write_video(filename, codec, size=(64, 48), count=5):
+    av = pytest.importorskip('av')
+    with av.open(str(filename), 'w') as container:
+        stream = container.add_stream(codec, rate=5)
+        stream.width, stream.height = size
+        stream.pix_fmt = 'yuv420p'
+        for image in frames(range(count), size):
+            for packet in stream.encode(av.VideoFrame.from_image(image)):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    return filename
+
+
+def test_png(tmp_path):
+    info = probe(str(make_image(tmp_path / 'still.png', 0, size=48)))
+    assert info == ('PNG', 'png', True, False, 48, 48)
+
+    first, *rest = frames([0, 1, 2])
+    first.save(tmp_path / 'animated.png', save_all=True, append_images=rest)
+    assert probe(str(tmp_path / 'animated.png')) == ('PNG', 'png', True, True, 40, 30)
+
+
+def test_gif(tmp_path):
+    first, *rest = frames([0, 1, 2])
+    first.save(tmp_path / 'still.gif')
+    first.save(tmp_path / 'animated.gif', save_all=True, append_images=rest)
+    assert probe(str(tmp_path / 'still.gif')) == ('GIF', 'gif', True, False, 40, 30)
+    assert probe(str(tmp_path / 'animated.gif')) == ('GIF', 'gif', True, True, 40, 30)
+
+
+def test_webp(tmp_path):
+    first, *rest = frames([0, 1, 2])
+    first.save(tmp_path / 'lossy.webp')
+    first.save(tmp_path / 'lossless.webp', lossless=True)
+    first.save(tmp_path / 'animated.webp', save_all=True, append_images=rest)
+    assert probe(str(tmp_path / 'lossy.webp')) == ('WebP', 'webp', True, False, 40, 30)
+    assert probe(str(tmp_path / 'lossless.webp')) == ('WebP', 'webp', True, False, 40, 30)
+    assert probe(str(tmp_path / 'animated.webp')) == ('WebP', 'webp', True, True, 40, 30)
+
+
+def test_jpeg(tmp_path):
+    frames([0])[0].save(tmp_path / 'still.jpg', quality=90)
+    assert probe(str(tmp_path / 'still.jpg')) == ('JPEG', 'jpg', True, False, 40, 30)
+
+
+def test_videos(tmp_path):
+    mp4 = write_video(tmp_path / 'video.mp4', 'mpeg4')
+    webm = write_video(tmp_path / 'video.webm', 'libvpx')
+    assert probe(str(mp4)) == ('MP4', 'mp4', False, True, 64, 48)
+    assert probe(str(webm)) == ('WebM', 'webm', False, True, 64, 48)
+
+
+def test_truncated_and_unknown(tmp_path):
+    first, *rest = frames([0, 1])
+    first.save(tmp_path / 'f.png', save_all=True, append_images=rest)
+    first.save(tmp_path / 'f.gif', save_all=True, append_images=rest)
+    first.save(tmp_path / 'f.webp', save_all=True, append_images=rest)
+    first.save(tmp_path / 'f.jpg')
+    files = [tmp_path / name for name in ('f.png', 'f.gif', 'f.webp', 'f.jpg')]
+    files.append(write_video(tmp_path / 'f.mp4', 'mpeg4'))
+    for filename in files:
+        data = filename.read_bytes()
+        expected = probe(str(filename))
+        for length in (16, 32, 64, len(data) // 2):
+            filename.write_bytes(data[:length])
+            info = probe(str(filename))
+            assert info is not None and info[:3] == expected[:3]
+
+    (tmp_path / 'text.png').write_bytes(b'not a picture at all')
+    (tmp_path / 'empty.png').write_bytes(b'')
+    assert probe(str(tmp_path / 'text.png')) is None
+    assert probe(str(tmp_path / 'empty.png')) is None
+    assert probe(str(tmp_path / 'missing.png')) is None
@@ -0,0 +1,62 @@
+import numpy as np
+
+from butter.sidecar import HashSidecar, RECORD, HEADER
+
+
+def sidecar(tmp_path, rows=()):
+    sql = tmp_path / 'db.sqlite3'
+    sql.write_bytes(b'x')
+    car = HashSidecar(str(tmp_path / 'hashes.bin'), str(sql))
+    car.rebuild(rows)
+    car.restamp()
+    return car
+
+
+def ids(car):
+    return sorted(car.array().ids.tolist())
+
+
+def records_on_disk(car):
+    with open(car.filename, 'rb') as f:
+        return (len(f.read()) - HEADER.size) // RECORD.itemsize
+
+
+def test_append_is_written_at_commit(tmp_path):
+    car = sidecar(tmp_path, [(1, 10, True)])
+    for id in range(2, 100):
+        car.append(id, id * 10, True)
+    assert records_on_disk(car) == 1
+    assert ids(car) == list(range(1, 100))
+    car.restamp()
+    assert records_on_disk(car) == 99
+    assert HashSidecar(car.filename, car.sql).valid
+
+
+def test_replace_and_remove(tmp_path):
+    car = sidecar(tmp_path, [(1, 10, True), (2, 20, False)])
+    car.append(1, 11, True)
+    car.remove(2)
+    car.append(3, 30, True)
+    car.remove(3)
+    car.restamp()
+    array = car.array()
+    assert array.ids.tolist() == [1]
+    assert array.hashes.view(np.int64).tolist() == [11]
+
+
+def test_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr('butter.sidecar.COMPACT_MIN', 0)
+    car = sidecar(tmp_path, [(id, id, True) for id in range(1, 9)])
+    for id in range(1, 6):
+        car.remove(id)
+    car.restamp()
+    assert records_on_disk(car) == 3
+    assert ids(HashSidecar(car.filename, car.sql)) == [6, 7, 8]
+
+
+def test_missing_file(tmp_path):
+    car = sidecar(tmp_path, [(1, 10, True)])
+    (tmp_path / 'hashes.bin').unlink()
+    car.append(2, 20, True)
+    assert not car.valid
+    car.restamp()
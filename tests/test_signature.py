@@ -0,0 +1,69 @@
+import os
+import time
+
+from PIL import Image
+
+from butter import signature
+from conftest import add_picture, make_image
+
+
+def test_missing_finds_animated_png(loader):
+    with loader.database() as db:
+        still = add_picture(db, 1)
+        animated = add_picture(db, 2)
+        video = add_picture(db, 3, extension='mp4', is_still=False)
+        make_image(still.filename, 1)
+        frames = [Image.open(make_image(animated.filename, seed)) for seed in (2, 3)]
+        frames[0].save(animated.filename, save_all=True, append_images=frames[1:], format='PNG')
+        assert sorted(id for id, _, _ in db.signatures.missing()) == sorted([animated.id, video.id])
+
+
+def test_similar_compares_signatures(loader):
+    near, far = [0, 0, 0], [-1, -1, -1]
+    with loader.database() as db:
+        same = add_picture(db, 0, extension='mp4', is_still=False)
+        other = add_picture(db, 0, extension='mp4', is_still=False)
+        still = add_picture(db, 0)
+        db.signatures.set(same.id, near)
+        db.signatures.set(other.id, far)
+        found = db.similar(0, 9, frames=[0, 1, 0])
+        assert sorted(pic.id for pic in found) == sorted([same.id, still.id])
+        assert len(db.similar(0, 9)) == 3
+
+
+def test_signatures_match_clips():
+    video = [0, 0xff, 0xffff, -1]
+    clip = [0xff, 0xffff]
+    assert signature.distance(clip, video) == 0
+    assert signature.distance(video, clip) > 9
+    assert signature.matches(video, clip, 9)
+    assert signature.matches(video, None, 0)
+    assert not signature.matches([0], [-1], 9)
+
+
+def hang(filename, is_still, timeout=None):
+    if filename.endswith('.mp4'):
+        time.sleep(60)
+    return [1, 2]
+
+
+def test_stuck_workers_are_killed(loader, monkeypatch):
+    monkeypatch.setattr(signature, 'compute', hang)
+    monkeypatch.setattr(signature, 'GRACE', 0)
+    with loader.database() as db:
+        stuck = add_picture(db, 1, extension='mp4', is_still=False)
+        fine = add_picture(db, 2, extension='webm', is_still=False)
+        start = time.monotonic()
+        assert db.signatures.generate(processes=2, timeout=1) == 1
+        assert time.monotonic() - start < 30
+        assert db.signatures.get(fine.id) == [1, 2]
+        assert [id for id, _, _ in db.signatures.missing()] == []
+
+        os.utime(stuck.filename, ns=(0, 0))
+        assert [id for id, _, _ in db.signatures.missing()] == [stuck.id]
+        monkeypatch.setattr(signature, 'compute', lambda *args, **kwargs: None)
+        assert db.signatures.generate(processes=1, timeout=1) == 0
+        assert [id for id, _, _ in db.signatures.missing()] == []
+        monkeypatch.setattr(signature, 'compute', lambda *args, **kwargs: [3])
+        assert db.signatures.generate(processes=1, timeout=1, retry=True) == 1
+        assert db.signatures.get(stuck.id) == [3]
@@ -0,0 +1,170 @@
+import os
+import shutil
+
+import pytest
+from sqlalchemy.sql import select
+
+from conftest import add_picture, make_database
+
+
+@pytest.fixture
+def replicas(tmp_path):
+    remote = tmp_path / 'remote'
+    remote.mkdir()
+    loaders = [make_database(tmp_path / name, remote=remote) for name in ('a', 'b')]
+    yield remote, loaders
+    for loader in loaders:
+        loader.close()
+
+
+def sync(loader):
+    loader.sync(stage=False)
+
+
+def pictures(loader):
+    with loader.database() as db:
+        c = db.pictures.c
+        return {id: ext for id, ext in db.session.execute(select([c.id, c.extension]))}
+
+
+def files(root):
+    return set(os.listdir(os.path.join(str(root), 'contents')))
+
+
+def test_concurrent_adds_get_distinct_ids(replicas):
+    remote, (a, b) = replicas
+    with a.database() as db:
+        first = add_picture(db, 1).filename
+    with b.database() as db:
+        second = add_picture(db, 2).filename
+    assert first != second
+    sync(a)
+    sync(b)
+    sync(a)
+    names = {os.path.basename(first), os.path.basename(second)}
+    assert len(pictures(a)) == len(pictures(b)) == 2
+    assert files(remote) == files(a.path) == files(b.path) == names
+
+
+def test_pull_keeps_unpushed_pictures(replicas):
+    remote, (a, b) = replicas
+    with b.database() as db:
+        add_picture(db, 2)
+    sync(b)
+    with a.database() as db:
+        ours = os.path.basename(add_picture(db, 1).filename)
+    a.sync(stage=False, push=False)
+    assert ours in files(a.path)
+    assert len(pictures(a)) == 2
+    sync(a)
+    sync(b)
+    assert ours in files(b.path)
+    assert len(pictures(b)) == 2
+
+
+def test_ids_are_not_reused(replicas):
+    remote, (a, b) = replicas
+    with a.database() as db:
+        pic = add_picture(db, 1)
+        id = pic.id
+        db.delete(pic)
+    with a.database() as db:
+        assert add_picture(db, 2).id > id
+
+
+def test_deletes_remove_exactly_the_deleted_files(replicas):
+    remote, (a, b) = replicas
+    with a.database() as db:
+        doomed, kept = add_picture(db, 1), add_picture(db, 2)
+        name, kept_name = os.path.basename(doomed.filename), os.path.basename(kept.filename)
+    sync(a)
+    sync(b)
+    assert name in files(b.path)
+    with a.database() as db:
+        db.delete(db.pic_by_id(doomed.id))
+    sync(a)
+    assert name not in files(remote)
+    sync(b)
+    assert files(b.path) == files(remote) == {kept_name}
+    assert list(pictures(b)) == [kept.id]
+    with b.database() as db:
+        assert not db.changelog.dead()
+
+
+def test_renamed_file_is_replaced(replicas):
+    remote, (a, b) = replicas
+    with a.database() as db:
+        pic = add_picture(db, 1, extension='png')
+    sync(a)
+    sync(b)
+    with a.database() as db:
+        pic = db.pic_by_id(pic.id)
+        old = pic.filename
+        pic.extension = 'jpg'
+        os.rename(old, pic.filename)
+        new = os.path.basename(pic.filename)
+    sync(a)
+    sync(b)
+    assert files(remote) == files(b.path) == {new}
+
+
+def test_fresh_remote_gets_a_changelog(replicas):
+    remote, (a, b) = replicas
+    assert not a.transport.exists(a.remote_changelog)
+    sync(a)
+    assert os.path.isdir(a.remote_changelog)
+    assert not os.path.exists(a.remote_sql)
+
+
+def test_legacy_remote_is_pulled_whole(replicas):
+    remote, (a, b) = replicas
+    with a.database() as db:
+        pic = add_picture(db, 1)
+    a.close()
+    shutil.copy(a.local_sql, str(remote / 'db.sqlite3'))
+    shutil.copytree(os.path.join(a.path, 'contents'), str(remote / 'contents'))
+    sync(b)
+    assert list(pictures(b)) == [pic.id]
+    assert os.path.isdir(b.remote_changelog)
+    assert os.listdir(os.path.join(b.remote_changelog, os.listdir(b.remote_changelog)[0]))
+
+
+def test_delete_applied_before_insert_sticks(tmp_path):
+    remote = tmp_path / 'remote'
+    remote.mkdir()
+    # Replicas are applied in the order of their ids, so c sees the
+    # delete by b before the insert by a
+    loaders = {}
+    for name, replica in [('a', 'f' * 32), ('b', '0' * 32), ('c', '8' * 32)]:
+        loaders[name] = make_database(tmp_path / name, remote=remote)
+        with open(os.path.join(str(tmp_path / name), 'replica'), 'w') as f:
+            f.write(replica)
+    a, b, c = loaders['a'], loaders['b'], loaders['c']
+    try:
+        with a.database() as db:
+            id = add_picture(db, 1).id
+        sync(a)
+        sync(b)
+        with b.database() as db:
+            db.delete(db.pic_by_id(id))
+        sync(b)
+        sync(c)
+        assert pictures(c) == {}
+        assert files(c.path) == files(remote) == set()
+        sync(a)
+        assert pictures(a) == {}
+    finally:
+        for loader in loaders.values():
+            loader.close()
+
+
+def test_triggers_are_only_created_once(loader, monkeypatch):
+    from butter import triggers
+    with loader.database() as db:
+        add_picture(db, 1)
+    loader.unload()
+    install, changed = triggers.install, []
+    monkeypatch.setattr(triggers, 'install', lambda *args: changed.append(install(*args)) or changed[-1])
+    with loader.database() as db:
+        add_picture(db, 2)
+    assert changed and not any(changed)
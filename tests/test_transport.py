@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from butter import transport
+from butter.transport import LocalTransport, TransportError
+
+
+def write(filename, data):
+    with open(str(filename), 'wb') as f:
+        f.write(data)
+    return str(filename)
+
+
+def read(filename):
+    with open(str(filename), 'rb') as f:
+        return f.read()
+
+
+def test_corrupt_copy_is_detected(tmp_path, monkeypatch):
+    source = write(tmp_path / 'source', b'abcdef' * 1000)
+    checksum = transport.checksum
+
+    def corrupting(filename):
+        with open(filename, 'r+b') as f:
+            f.write(b'X')
+        return checksum(filename)
+
+    monkeypatch.setattr(transport, 'checksum', corrupting)
+    with pytest.raises(TransportError):
+        LocalTransport().copy_file(source, str(tmp_path / 'copy'))
+    assert not os.path.exists(str(tmp_path / 'copy'))
+
+
+def test_resume_checks_the_partial_copy(tmp_path):
+    data = os.urandom(3 * transport.CHUNK + 17)
+    source = write(tmp_path / 'source', data)
+    write(tmp_path / 'good.part', data[:transport.CHUNK + 5])
+    write(tmp_path / 'bad.part', b'x' * (transport.CHUNK + 5))
+    events = []
+    t = LocalTransport(progress=events.append)
+    t.copy_file(source, str(tmp_path / 'good'))
+    assert read(tmp_path / 'good') == data
+    assert sum(e.size for e in events if e.kind == 'data') == len(data)
+    t.copy_file(source, str(tmp_path / 'bad'))
+    assert read(tmp_path / 'bad') == data
+
+
+def test_mtime_window(tmp_path):
+    source, destination = tmp_path / 'source', tmp_path / 'destination'
+    source.mkdir()
+    destination.mkdir()
+    for name in ('near', 'far'):
+        write(source / name, b'new')
+        write(destination / name, b'old')
+        st = os.stat(str(source / name))
+    os.utime(str(destination / 'near'), ns=(st.st_atime_ns, st.st_mtime_ns - 1500000000))
+    os.utime(str(destination / 'far'), ns=(st.st_atime_ns, st.st_mtime_ns - 5000000000))
+    LocalTransport().copy(str(source), str(destination))
+    assert read(destination / 'near') == b'old'
+    assert read(destination / 'far') == b'new'
+
+
+def test_total_is_planned_first(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    for i in range(5):
+        write(source / str(i), b'x' * (i + 1))
+    events = []
+    t = LocalTransport(jobs=2, progress=events.append)
+    assert t.copy(str(source), str(tmp_path / 'destination')) == 5
+    assert t.copy(str(source), str(tmp_path / 'destination')) == 0
+    assert events[0].kind == 'plan' and events[0].size == 15
+    assert events[-1].kind == 'finish'